@@ -1,11 +1,11 @@
-from flask import Flask, render_template, Response
-import cv2
-from video_test import MotionDetector
+from flask import Flask, render_template, Response, request, stream_with_context
+from frame_broadcaster import get_broadcaster
+from src.utils.elevenlabs_tts import ElevenLabsClient
 import firebase_admin
 from firebase_admin import db
-import json
-import requests
+import itertools
 import os
+import threading
 from dotenv import load_dotenv
 
 # .env.localファイルの読み込み
@@ -23,40 +23,33 @@ CAMERA_URL = 'http://192.168.0.90:8080/video.mjpg'
 # Eleven Labs API設定
 ELEVEN_LABS_API_KEY = os.getenv('ELEVEN_LABS_API_KEY')
 VOICE_ID = "iP95p4xoKVk53GoZ742B"  # Eleven Labsで選択した音声のID
+# 合成した音声の保存先（同じ文言は再合成せずにここから返す）
+TTS_CACHE_DIR = os.path.join('static', 'tts')
 
-def generate_frames():
-    detector = MotionDetector(CAMERA_URL)
-    while True:
-        success, frame = detector.capture.read()
-        if not success:
-            break
-        else:
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+_tts_client = None
+_tts_client_lock = threading.Lock()
 
-def text_to_speech(text):
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{VOICE_ID}"
-    headers = {
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-        "xi-api-key": ELEVEN_LABS_API_KEY
-    }
-    data = {
-        "text": text,
-        "model_id": "eleven_monolingual_v1",
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0.5
-        }
-    }
-    response = requests.post(url, json=data, headers=headers)
-    if response.status_code == 200:
-        with open("static/output.mp3", "wb") as f:
-            f.write(response.content)
-        return True
-    return False
+def get_tts_client():
+    # HTTP セッションとキャッシュをリクエスト間で共有する
+    global _tts_client
+    with _tts_client_lock:
+        if _tts_client is None:
+            _tts_client = ElevenLabsClient(
+                api_key=ELEVEN_LABS_API_KEY,
+                model_id="eleven_monolingual_v1",
+                voice_settings={
+                    "stability": 0.5,
+                    "similarity_boost": 0.5
+                },
+                cache_dir=TTS_CACHE_DIR,
+            )
+        return _tts_client
+
+def generate_frames(width=None, quality=None):
+    # カメラへの接続とJPEGエンコードは全クライアントで共有する
+    for frame in get_broadcaster(CAMERA_URL).frames(width, quality):
+        yield (b'--frame\r\n'
+               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
 
 @app.route('/')
 def index():
@@ -64,8 +57,26 @@ def index():
 
 @app.route('/video_feed')
 def video_feed():
-    return Response(generate_frames(),
+    # 多数の視聴者に配信する場合は stream_server.py（ASGI）を使う
+    width = request.args.get('width', type=int)
+    quality = request.args.get('quality', type=int)
+    return Response(generate_frames(width, quality),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/tts')
+def tts():
+    # 合成しながら返すので、全体の合成を待たずに再生が始まる
+    text = request.args.get('text', '')
+    if not text:
+        return {"error": "text is required"}, 400
+    chunks = get_tts_client().stream_speech(text, VOICE_ID)
+    try:
+        # 合成に失敗した場合はレスポンスを返し始める前にエラーにする
+        first = next(chunks, b'')
+    except Exception as e:
+        return {"error": str(e)}, 502
+    return Response(stream_with_context(itertools.chain([first], chunks)),
+                    mimetype='audio/mpeg')
+
 if __name__ == '__main__':
     app.run(debug=True)
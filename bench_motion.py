@@ -0,0 +1,388 @@
+"""
+MotionDetector のオフラインベンチマーク
+
+録画済みの動画ファイル（なければ合成した動画）をファイル URL として MotionDetector に
+流し、解像度・検知方式（motion_backends.py）・検知パラメーターの組み合わせごとに
+以下を計測する。
+
+- 処理できたフレーム数/秒（キャプチャループのスループット）
+- 1 フレームあたりの検知時間のパーセンタイル（p50 / p90 / p99 / 最大）
+- ピーク RSS（組み合わせごとに別プロセスで実行して測る）
+- クリップごとのエンコード時間（VideoWriter の処理時間、うち release() の時間）とアップロード時間
+  （telemetry のスパンから集計）
+
+アップロード先は LocalUploadBackend（一時ディレクトリ）なので GCS には接続しない。
+
+    python bench_motion.py                                  # 合成動画で既定の組み合わせを計測
+    python bench_motion.py recorded.mp4 --resolutions 1280x720,1920x1080 \\
+        --backend mog2,knn,frame_diff --min-area 500,2000 --history 200,500 \\
+        --detect-width 0,320 --json result.json
+
+--realtime を付けると元の FPS に合わせて読み込む（クールダウンや録画終了の判定が
+実運用と同じ時間軸になる）。付けない場合はできるだけ速く読み込み、スループットを測る。
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# 合成動画の既定値
+SYNTHETIC_SECONDS = 20
+SYNTHETIC_FPS = 15
+
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def parse_list(value, cast=int):
+    return [cast(item) for item in value.split(',') if item]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return float(np.percentile(np.asarray(values), q))
+
+
+def make_synthetic_video(path, resolution, seconds=SYNTHETIC_SECONDS, fps=SYNTHETIC_FPS, seed=0):
+    """
+    ノイズの乗った静止背景の中を矩形が横切る動画を作る
+
+    動きがあるのは 1/4〜1/2 と 3/4〜終了直前の 2 区間で、動体イベントが 2 回起きる。
+    """
+    width, height = resolution
+    rng = np.random.default_rng(seed)
+    background = rng.integers(60, 120, size=(height, width, 3), dtype=np.uint8)
+    background = cv2.GaussianBlur(background, (0, 0), 3)
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f'VideoWriterを開けませんでした: {path}')
+
+    total = seconds * fps
+    box = (max(8, width // 8), max(8, height // 4))
+    active = [(total // 4, total // 2), (total * 3 // 4, total - fps)]
+    try:
+        for index in range(total):
+            frame = background.copy()
+            # センサーノイズ
+            noise = rng.integers(-6, 7, size=(height, width, 1), dtype=np.int16)
+            frame = np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+            for start, end in active:
+                if start <= index < end:
+                    progress = (index - start) / max(1, end - start - 1)
+                    x = int(progress * (width - box[0]))
+                    y = height // 2 - box[1] // 2
+                    cv2.rectangle(frame, (x, y), (x + box[0], y + box[1]), (230, 230, 230), -1)
+            writer.write(frame)
+    finally:
+        writer.release()
+    return path
+
+
+def resize_video(source, path, resolution):
+    """録画済みの動画を指定した解像度に変換する"""
+    capture = cv2.VideoCapture(str(source))
+    if not capture.isOpened():
+        raise RuntimeError(f'動画を開けませんでした: {source}')
+    fps = capture.get(cv2.CAP_PROP_FPS) or SYNTHETIC_FPS
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, resolution)
+    try:
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            if (frame.shape[1], frame.shape[0]) != resolution:
+                frame = cv2.resize(frame, resolution, interpolation=cv2.INTER_AREA)
+            writer.write(frame)
+    finally:
+        capture.release()
+        writer.release()
+    return path
+
+
+class ThrottledCapture:
+    """元の FPS に合わせて read() を待たせる VideoCapture のラッパー（--realtime 用）"""
+
+    def __init__(self, capture, fps):
+        self._capture = capture
+        self._interval = 1.0 / fps
+        self._next = None
+
+    def read(self, image=None):
+        now = time.perf_counter()
+        if self._next is not None and now < self._next:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next or now) + self._interval
+        return self._capture.read(image=image) if image is not None else self._capture.read()
+
+    def __getattr__(self, name):
+        return getattr(self._capture, name)
+
+
+def _collect_clips(telemetry_path):
+    """
+    telemetry のスパンからクリップごとのエンコード時間・アップロード時間を集計する
+
+    エンコード時間は clip_segment スパンの encode_seconds（VideoWriter の処理時間の
+    合計）で、録画の長さ（スパンの duration）ではない。
+    """
+    clips = {}
+    if not os.path.exists(telemetry_path):
+        return []
+    with open(telemetry_path, encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('name') not in ('clip_segment', 'clip_upload') or not record.get('clip_id'):
+                continue
+            clip = clips.setdefault(record['clip_id'], {
+                'clip_id': record['clip_id'], 'segments': 0, 'frames': 0, 'bytes': 0,
+                'encode_seconds': 0.0, 'finalize_seconds': 0.0, 'upload_seconds': 0.0, 'errors': 0,
+            })
+            if record['status'] != 'ok':
+                clip['errors'] += 1
+            if record['name'] == 'clip_segment':
+                clip['segments'] += 1
+                clip['frames'] += record.get('frames', 0)
+                clip['bytes'] += record.get('bytes', 0)
+                clip['encode_seconds'] += record.get('encode_seconds', 0.0)
+                clip['finalize_seconds'] += record.get('finalize_seconds', 0.0)
+            else:
+                clip['upload_seconds'] += record['duration']
+    return sorted(clips.values(), key=lambda clip: clip['clip_id'])
+
+
+def run_case(case, result_queue):
+    """
+    1 つの組み合わせを計測する（別プロセスで実行し、結果を result_queue に入れる）
+
+    作業ディレクトリを一時ディレクトリに移し、クリップ・アップロードキュー・
+    アップロード先をすべてその中に作る。
+    """
+    work_dir = Path(tempfile.mkdtemp(prefix='bench_motion_'))
+    os.chdir(work_dir)
+    telemetry_path = str(work_dir / 'telemetry.jsonl')
+    # get_telemetry() は最初の呼び出しで環境変数を読むので、import より前に設定する
+    os.environ['TELEMETRY_FILE'] = telemetry_path
+    os.environ.pop('TELEMETRY_LOG', None)
+    os.environ.pop('TELEMETRY_PROMETHEUS_PORT', None)
+    sys.path.insert(0, case['repo_dir'])
+
+    from motion_detect import MotionDetector
+    from upload_queue import LocalUploadBackend, UploadQueue
+
+    messages = []
+    upload_queue = UploadQueue(work_dir / 'spool', LocalUploadBackend(work_dir / 'bucket'),
+                               initial_delay=0.1, log=messages.append)
+    backend_options = {'history': case['history']} if case['history'] else {}
+    detector = MotionDetector(
+        case['video'], min_area=case['min_area'],
+        detect_width=case['detect_width'] or None, detect_every=case['detect_every'],
+        camera_id='bench', upload_queue=upload_queue,
+        # 最後まで読んだら再接続せずに止めたいので、再接続の待ち時間を長くしておく
+        reconnect_initial_delay=3600, segment_seconds=case['segment_seconds'],
+        backend=case['backend'], backend_options=backend_options,
+    )
+    detector.log = messages.append
+    if case['fourcc']:
+        detector.fourcc = cv2.VideoWriter_fourcc(*case['fourcc'])
+    if case['realtime']:
+        detector.capture = ThrottledCapture(detector.capture, detector.fps)
+
+    # 1 フレームごとの検知時間を記録する
+    latencies = []
+    find_motion = detector.find_motion
+
+    def timed_find_motion(frame):
+        started = time.perf_counter()
+        try:
+            return find_motion(frame)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    detector.find_motion = timed_find_motion
+
+    started = time.perf_counter()
+    detector.start()
+    # 読み込みに失敗した（= 最後まで読んだ）ら止める
+    while detector._read_failures == 0 and detector._capture_thread.is_alive():
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    frames = detector._frame_index
+    detector.stop()
+    upload_queue.join(timeout=60)
+    upload_queue.stop()
+    drain_seconds = time.perf_counter() - started - elapsed
+
+    clips = _collect_clips(telemetry_path)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    result_queue.put({
+        **{key: case[key] for key in (
+            'name', 'resolution', 'backend', 'min_area', 'history', 'detect_width',
+            'detect_every')},
+        'frames': frames,
+        'seconds': elapsed,
+        'fps': frames / elapsed if elapsed else None,
+        'detections': len(latencies),
+        'dropped_detections': detector.dropped_detections,
+        'dropped_frames': detector.dropped_frames,
+        'detect_p50_ms': _ms(percentile(latencies, 50)),
+        'detect_p90_ms': _ms(percentile(latencies, 90)),
+        'detect_p99_ms': _ms(percentile(latencies, 99)),
+        'detect_max_ms': _ms(max(latencies) if latencies else None),
+        # Linux の ru_maxrss は KB 単位
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'drain_seconds': drain_seconds,
+        'clips': clips,
+        'uploaded': upload_queue.uploaded,
+        'upload_failed': upload_queue.failed,
+    })
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def build_cases(args, video_dir):
+    """解像度ごとの入力動画を用意し、パラメーターの組み合わせを並べる"""
+    sources = args.videos or [None]
+    repo_dir = str(Path(__file__).resolve().parent)
+    cases = []
+    for source_index, source in enumerate(sources):
+        for resolution in args.resolutions:
+            name = Path(source).stem if source else 'synthetic'
+            video = Path(video_dir) / f'{source_index}_{name}_{resolution[0]}x{resolution[1]}.mp4'
+            if source is None:
+                make_synthetic_video(video, resolution, seconds=args.seconds)
+            else:
+                resize_video(source, video, resolution)
+            for backend, min_area, history, detect_width in itertools.product(
+                    args.backend, args.min_area, args.history, args.detect_width):
+                # frame_diff には history がないので 1 通りだけ計測する
+                if backend == 'frame_diff':
+                    if history != args.history[0]:
+                        continue
+                    history = None
+                cases.append({
+                    'backend': backend,
+                    'name': name,
+                    'video': str(video),
+                    'resolution': f'{resolution[0]}x{resolution[1]}',
+                    'min_area': min_area,
+                    'history': history,
+                    'detect_width': detect_width,
+                    'detect_every': args.detect_every,
+                    'segment_seconds': args.segment_seconds,
+                    'fourcc': args.fourcc,
+                    'realtime': args.realtime,
+                    'repo_dir': repo_dir,
+                })
+    return cases
+
+
+def run_cases(cases):
+    # 組み合わせごとに新しいプロセスで実行する（ピーク RSS と背景モデルを持ち越さない）
+    context = multiprocessing.get_context('spawn')
+    for case in cases:
+        result_queue = context.Queue()
+        process = context.Process(target=run_case, args=(case, result_queue))
+        process.start()
+        result = None
+        while True:
+            try:
+                result = result_queue.get(timeout=1)
+                break
+            except queue.Empty:
+                # 子プロセスが結果を返さずに終了した
+                if not process.is_alive():
+                    break
+        process.join()
+        if result is None:
+            print(f'Error: 計測に失敗しました: {case["name"]} {case["resolution"]}', file=sys.stderr)
+            continue
+        yield result
+
+
+def format_row(result):
+    def fmt(value, spec='.1f'):
+        return '-' if value is None else format(value, spec)
+
+    clips = result['clips']
+    encode = [clip['encode_seconds'] for clip in clips]
+    finalize = [clip['finalize_seconds'] for clip in clips]
+    upload = [clip['upload_seconds'] for clip in clips]
+    return (
+        f'{result["name"]:<12} {result["resolution"]:>9} {result["backend"]:>10} '
+        f'{result["min_area"]:>6} {result["history"] or "-":>5} {result["detect_width"] or "-":>5} '
+        f'{fmt(result["fps"]):>7} {fmt(result["detect_p50_ms"], ".2f"):>7} '
+        f'{fmt(result["detect_p90_ms"], ".2f"):>7} {fmt(result["detect_p99_ms"], ".2f"):>7} '
+        f'{fmt(result["peak_rss_mb"]):>7} {len(clips):>5} '
+        f'{fmt(sum(encode) / len(encode) if encode else None, ".3f"):>7} '
+        f'{fmt(sum(finalize) / len(finalize) if finalize else None, ".3f"):>7} '
+        f'{fmt(sum(upload) / len(upload) if upload else None, ".3f"):>7}'
+    )
+
+
+HEADER = (
+    f'{"input":<12} {"size":>9} {"backend":>10} {"area":>6} {"hist":>5} {"dw":>5} '
+    f'{"fps":>7} {"p50ms":>7} {"p90ms":>7} {"p99ms":>7} '
+    f'{"rssMB":>7} {"clips":>5} {"enc_s":>7} {"fin_s":>7} {"upl_s":>7}'
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MotionDetector のオフラインベンチマーク')
+    parser.add_argument('videos', nargs='*',
+                        help='入力動画（省略時は合成動画を使う）')
+    parser.add_argument('--resolutions', type=lambda v: [parse_resolution(r) for r in v.split(',')],
+                        default=[(640, 360), (1280, 720), (1920, 1080)],
+                        help='計測する解像度（例: 640x360,1280x720）')
+    parser.add_argument('--min-area', type=parse_list, default=[500],
+                        help='min_area の候補（カンマ区切り）')
+    parser.add_argument('--backend', type=lambda v: parse_list(v, str), default=['mog2'],
+                        help='検知方式の候補（mog2,knn,frame_diff）')
+    parser.add_argument('--history', type=parse_list, default=[500],
+                        help='mog2 / knn の history の候補（カンマ区切り）')
+    parser.add_argument('--detect-width', type=parse_list, default=[0, 320],
+                        help='detect_width の候補（0 は縮小しない）')
+    parser.add_argument('--detect-every', type=int, default=1)
+    parser.add_argument('--segment-seconds', type=float, default=None)
+    parser.add_argument('--seconds', type=int, default=SYNTHETIC_SECONDS,
+                        help='合成動画の長さ（秒）')
+    parser.add_argument('--fourcc', default=None,
+                        help='クリップのコーデック（既定は MotionDetector と同じ avc1）')
+    parser.add_argument('--realtime', action='store_true',
+                        help='元の FPS に合わせて読み込む')
+    parser.add_argument('--json', dest='json_path', default=None,
+                        help='結果（クリップごとの内訳を含む）を書き出す JSON ファイル')
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench_motion_videos_') as video_dir:
+        cases = build_cases(args, video_dir)
+        print(f'{len(cases)} 通りの組み合わせを計測します', file=sys.stderr)
+        print(HEADER)
+        for result in run_cases(cases):
+            results.append(result)
+            print(format_row(result), flush=True)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from src.utils.telemetry import get_telemetry
+
+
+class StreamingClipWriter:
+    """
+    動体イベントを逐次エンコードするクリップライター
+
+    イベント開始時に start() でプリロールを渡し、以降のフレームは write() で
+    到着順に渡す。エンコードは専用スレッドで行うため、呼び出し側（キャプチャ
+    スレッド）はブロックしない。キューが満杯のときはそのフレームを捨てる。
+
+    segment_seconds を指定すると、その長さごとに別ファイル
+    （<path_prefix>_000.mp4, <path_prefix>_001.mp4, ...）へ切り替え、
+    書き終えたセグメントから on_segment(path) を呼ぶ。イベントの終了を
+    待たずにアップロードを始められる。指定しない場合は <path_prefix>.mp4 に
+    イベント全体を書き出す。
+
+    write() に渡すフレームはリングバッファ上のビューでよい。キューの長さが
+    リングバッファの容量より十分小さければ、上書きされる前に書き出される。
+
+    セグメントごとに clip_segment スパン（開いてから書き終えるまで、つまり録画の
+    長さ）を記録し、encode_seconds に VideoWriter の書き込みと release() にかかった
+    時間の合計、finalize_seconds に release() の時間を付ける（clip_id を付ける）。
+    エンコードの時間は clip_encode_seconds ヒストグラムにも記録する。
+
+    on_close はすべてのセグメントを書き終えてスレッドが終わる直前に呼ぶ
+    （同時に動くライターの数を制限する枠の返却などに使う）。
+    """
+
+    def __init__(self, path_prefix, fourcc, fps, segment_seconds=None,
+                 max_queue=30, on_segment=None, log=print, clip_id=None, labels=None,
+                 on_close=None):
+        self.path_prefix = str(path_prefix)
+        self.clip_id = clip_id
+        self.labels = labels or {}
+        self.telemetry = get_telemetry()
+        self.fourcc = fourcc
+        self.fps = fps
+        self.segment_frames = int(segment_seconds * fps) if segment_seconds else None
+        self.on_segment = on_segment
+        self.on_close = on_close
+        self.log = log
+        self.segments = []  # 書き終えたファイルのパス
+        self.frames_written = 0
+        self.dropped_frames = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closing = threading.Event()
+        self._thread = None
+        self._writer = None
+        self._path = None
+        self._segment_index = 0
+        self._segment_count = 0
+        self._segment_span = None
+        self._encode_seconds = 0.0
+
+    def start(self, preroll=None):
+        """
+        エンコードスレッドを開始する
+
+        preroll には FrameRingBuffer.detach() の戻り値（またはフレームのリスト）を
+        渡す。DetachedFrames の場合は書き出し後に release() する。
+        """
+        self._thread = threading.Thread(
+            target=self._run, args=(preroll,), name='clip-writer', daemon=True)
+        self._thread.start()
+        return self
+
+    def write(self, frame):
+        """フレームを書き込みキューへ追加する（満杯なら捨てて False を返す）"""
+        try:
+            self._queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.dropped_frames += 1
+            return False
+
+    def close(self):
+        """キューに残ったフレームを書き出してから終了するよう指示する（ブロックしない）"""
+        self._closing.set()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _segment_path(self):
+        if self.segment_frames is None:
+            return f'{self.path_prefix}.mp4'
+        return f'{self.path_prefix}_{self._segment_index:03d}.mp4'
+
+    def _open(self, frame):
+        height, width = frame.shape[:2]
+        self._path = self._segment_path()
+        self._writer = cv2.VideoWriter(self._path, self.fourcc, self.fps, (width, height))
+        if not self._writer.isOpened():
+            self._writer = None
+            raise RuntimeError(f'VideoWriterを開けませんでした: {self._path}')
+        self._segment_count = 0
+        self._encode_seconds = 0.0
+        self._segment_span = self.telemetry.span(
+            'clip_segment', clip_id=self.clip_id, segment=self._segment_index, **self.labels)
+
+    def _finish_segment(self):
+        if self._writer is None:
+            return
+        start = time.perf_counter()
+        self._writer.release()
+        finalize_seconds = time.perf_counter() - start
+        encode_seconds = self._encode_seconds + finalize_seconds
+        self._writer = None
+        self._segment_index += 1
+        path = self._path
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        status = 'ok' if size > 0 else 'error'
+        self._segment_span.end(
+            status=status, frames=self._segment_count, bytes=size,
+            encode_seconds=encode_seconds, finalize_seconds=finalize_seconds)
+        self.telemetry.observe('clip_encode_seconds', encode_seconds, status=status, **self.labels)
+        self.telemetry.counter('clip_encoded_bytes', size, **self.labels)
+
+        # 保存された動画ファイルが正しく作成されたか確認
+        if size == 0:
+            self.log(f'Error: 動画ファイルの保存に失敗した可能性があります: {path}')
+            return
+        self.log(f'動画クリップを保存しました: {path}')
+        self.segments.append(path)
+        if self.on_segment is not None:
+            try:
+                self.on_segment(path)
+            except Exception as e:
+                self.log(f'セグメントの後処理中にエラーが発生しました: {e}')
+
+    def _write_frame(self, frame):
+        # キューの待ち時間を除き、VideoWriter の処理だけをエンコード時間として数える
+        start = time.perf_counter()
+        if self._writer is None:
+            self._open(frame)
+        self._writer.write(frame)
+        self._encode_seconds += time.perf_counter() - start
+        self.frames_written += 1
+        self._segment_count += 1
+        if self.segment_frames and self._segment_count >= self.segment_frames:
+            self._finish_segment()
+
+    def _run(self, preroll):
+        try:
+            if preroll is not None:
+                try:
+                    frames = preroll.frames if hasattr(preroll, 'release') else preroll
+                    with self.telemetry.span('clip_preroll_flush', clip_id=self.clip_id,
+                                             frames=len(frames), **self.labels):
+                        for frame in frames:
+                            self._write_frame(frame)
+                finally:
+                    # プリロールのアリーナを早めに返却する
+                    if hasattr(preroll, 'release'):
+                        preroll.release()
+
+            while True:
+                try:
+                    frame = self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    if self._closing.is_set():
+                        break
+                    continue
+                self._write_frame(frame)
+        except Exception as e:
+            self.log(f'動画保存中にエラーが発生しました: {e}')
+            # 以降のフレームは書き出せないので捨てる
+            while not self._closing.is_set() or not self._queue.empty():
+                try:
+                    self._queue.get(timeout=0.1)
+                    self.dropped_frames += 1
+                except queue.Empty:
+                    pass
+        finally:
+            try:
+                self._finish_segment()
+            finally:
+                if self.on_close is not None:
+                    self.on_close()
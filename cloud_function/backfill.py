@@ -0,0 +1,283 @@
+"""
+保存済みのクリップをまとめて（再）分析するコマンド
+
+GCS のプレフィックス（またはバケットに見立てたローカルディレクトリ）にあるクリップを
+一覧し、分析結果（<クリップ名>_analysis.txt）がまだないものを Cloud Storage トリガーと
+同じ手順（キーフレーム選択 → 動体領域での切り出し → GeminiAnalyzer）で分析する。
+
+    python cloud_function/backfill.py gs://my_video_bucket-1/motion_clips/
+    python cloud_function/backfill.py gs://my_video_bucket-1/motion_clips/gate/ --force --workers 8 --rpm 120
+    python cloud_function/backfill.py ./local_bucket/motion_clips/ --dry-run
+
+- 同時に分析するのは --workers 件まで、Gemini へのリクエストは --rpm 件/分まで
+- 処理したクリップはチェックポイント（--checkpoint、JSON Lines）に 1 件ずつ追記する。
+  中断しても同じチェックポイントで再実行すれば、成功したクリップは飛ばして再開する
+  （失敗したクリップは再実行時にもう一度試す）
+- プロンプトやモデルを変えたときは --force で既存の結果を上書きする
+  （チェックポイントは実行ごとに分けること）
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from main import (
+    CROP_TO_MOTION, clip_images, get_storage_client, parse_motion_region,
+    result_name, sidecar_name,
+)
+from gcs_ingest import blob_tempfile
+from utils.gemini_analysis import get_analyzer
+from utils.telemetry import clip_context, clip_id_from_path, get_telemetry
+
+
+class GCSClipStore:
+    """GCS のバケット上のクリップと分析結果"""
+
+    def __init__(self, bucket_name):
+        self.bucket = get_storage_client().bucket(bucket_name)
+
+    def list(self, prefix):
+        return [blob.name for blob in self.bucket.list_blobs(prefix=prefix)]
+
+    @contextlib.contextmanager
+    def local_path(self, name):
+        with blob_tempfile(self.bucket.blob(name)) as path:
+            yield path
+
+    def read_bytes(self, name):
+        return self.bucket.blob(name).download_as_bytes()
+
+    def write_text(self, name, text):
+        self.bucket.blob(name).upload_from_string(text)
+
+    def __str__(self):
+        return f'gs://{self.bucket.name}'
+
+
+class LocalClipStore:
+    """ローカルディレクトリをバケットに見立てたクリップと分析結果（upload_queue.LocalUploadBackend と同じ配置）"""
+
+    def __init__(self, root_dir):
+        self.root_dir = Path(root_dir)
+
+    def list(self, prefix):
+        base = self.root_dir / prefix
+        directory = base if base.is_dir() else base.parent
+        names = []
+        for path in directory.rglob('*'):
+            name = path.relative_to(self.root_dir).as_posix()
+            if path.is_file() and name.startswith(prefix):
+                names.append(name)
+        return names
+
+    @contextlib.contextmanager
+    def local_path(self, name):
+        yield str(self.root_dir / name)
+
+    def read_bytes(self, name):
+        return (self.root_dir / name).read_bytes()
+
+    def write_text(self, name, text):
+        path = self.root_dir / name
+        # 並列の書き込みが同じ一時ファイルを使わないよう、名前を一意にする
+        temp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+        temp_path.write_text(text, encoding='utf-8')
+        os.replace(temp_path, path)
+
+    def __str__(self):
+        return str(self.root_dir)
+
+
+def open_store(location):
+    """
+    gs://bucket/prefix またはローカルのパスから (ストア, プレフィックス) を返す
+
+    ローカルのパスは motion_clips/ を含む場合、その手前をバケットのルートとみなす。
+    """
+    if location.startswith('gs://'):
+        bucket_name, _, prefix = location[len('gs://'):].partition('/')
+        return GCSClipStore(bucket_name), prefix
+    path = Path(location).resolve()
+    parts = path.parts
+    if 'motion_clips' in parts:
+        index = parts.index('motion_clips')
+        root = Path(*parts[:index])
+        prefix = '/'.join(parts[index:])
+        if location.endswith(('/', os.sep)) or path.is_dir():
+            prefix += '/'
+        return LocalClipStore(root), prefix
+    return LocalClipStore(path), ''
+
+
+class RateLimiter:
+    """1 分あたりの呼び出し回数を制限する（呼び出しの間隔を一定以上あける）"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait_seconds = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+class Checkpoint:
+    """処理したクリップを JSON Lines で追記するチェックポイント"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.failed = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 中断時に書きかけた行
+                        continue
+                    if record.get('status') == 'ok':
+                        self.done.add(record['name'])
+                        self.failed.pop(record['name'], None)
+                    else:
+                        self.failed[record['name']] = record.get('error')
+
+    def record(self, name, status, **fields):
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(dict(name=name, status=status, time=time.time(), **fields),
+                                   ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if status == 'ok':
+                self.done.add(name)
+                self.failed.pop(name, None)
+            else:
+                self.failed[name] = fields.get('error')
+
+
+def find_pending(names, checkpoint, force=False):
+    """分析するクリップを返す（結果があるもの・チェックポイントで完了済みのものを除く）"""
+    existing = set(names)
+    pending = []
+    for name in sorted(names):
+        if not name.endswith('.mp4'):
+            continue
+        if name in checkpoint.done:
+            continue
+        if not force and result_name(name) in existing:
+            continue
+        pending.append(name)
+    return pending, existing
+
+
+def analyze_one(store, name, existing, limiter):
+    """1 件のクリップを分析して結果を保存し、結果のファイル名を返す"""
+    with clip_context(clip_id_from_path(name)):
+        with get_telemetry().span('backfill_clip'):
+            motion_region = None
+            sidecar = sidecar_name(name)
+            if CROP_TO_MOTION and sidecar in existing:
+                motion_region = parse_motion_region(store.read_bytes(sidecar))
+            with store.local_path(name) as path:
+                images = clip_images(path, motion_region)
+            limiter.acquire()
+            analysis_result = get_analyzer().analyze_images(images)
+            store.write_text(result_name(name), analysis_result)
+            return result_name(name)
+
+
+def run(store, names, existing, checkpoint, workers=4, rpm=60, log=print):
+    """
+    クリップを並行して分析する
+
+    実行中のタスクは workers 件までに抑え（一覧が大きくてもタスクを一度に作らない）、
+    Ctrl+C で新しいクリップの投入をやめ、実行中のものが終わるのを待って返る。
+    """
+    limiter = RateLimiter(rpm)
+    succeeded = failed = 0
+    remaining = iter(names)
+    running = {}
+    interrupted = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while not interrupted and len(running) < workers:
+                name = next(remaining, None)
+                if name is None:
+                    break
+                running[executor.submit(analyze_one, store, name, existing, limiter)] = name
+            if not running:
+                break
+            try:
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            except KeyboardInterrupt:
+                log('中断します（実行中のクリップが終わるまで待ちます）...')
+                interrupted = True
+                continue
+            for future in completed:
+                name = running.pop(future)
+                try:
+                    output = future.result()
+                except Exception as e:
+                    failed += 1
+                    checkpoint.record(name, 'error', error=str(e))
+                    log(f'Error: {name}: {e}')
+                else:
+                    succeeded += 1
+                    checkpoint.record(name, 'ok', result=output)
+                    log(f'[{succeeded + failed}/{len(names)}] {name} -> {output}')
+    return succeeded, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='保存済みのクリップをまとめて（再）分析する')
+    parser.add_argument('location',
+                        help='gs://bucket/motion_clips/... またはローカルのディレクトリ')
+    parser.add_argument('--workers', type=int, default=4, help='同時に分析するクリップ数')
+    parser.add_argument('--rpm', type=float, default=60,
+                        help='Gemini へのリクエスト数の上限（件/分、0 で無制限）')
+    parser.add_argument('--checkpoint', default='backfill_checkpoint.jsonl',
+                        help='進捗を記録するファイル（再実行時に続きから再開する）')
+    parser.add_argument('--force', action='store_true',
+                        help='分析結果があるクリップも分析し直す')
+    parser.add_argument('--limit', type=int, default=None, help='分析するクリップ数の上限')
+    parser.add_argument('--dry-run', action='store_true', help='分析するクリップを表示するだけ')
+    args = parser.parse_args(argv)
+
+    store, prefix = open_store(args.location)
+    checkpoint = Checkpoint(args.checkpoint)
+    names = store.list(prefix)
+    pending, existing = find_pending(names, checkpoint, force=args.force)
+    if args.limit is not None:
+        pending = pending[:args.limit]
+    clips = sum(1 for name in names if name.endswith('.mp4'))
+    print(f'{store}/{prefix}: クリップ {clips} 件、分析するもの {len(pending)} 件'
+          f'（チェックポイントで完了済み {len(checkpoint.done)} 件）', file=sys.stderr)
+
+    if args.dry_run:
+        for name in pending:
+            print(name)
+        return 0
+
+    succeeded, failed = run(store, pending, existing, checkpoint,
+                            workers=args.workers, rpm=args.rpm)
+    print(f'完了: 成功 {succeeded} 件、失敗 {failed} 件', file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
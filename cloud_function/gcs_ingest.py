@@ -0,0 +1,87 @@
+import contextlib
+import os
+import shutil
+import tempfile
+
+# GCS から一度に読み込むサイズ（256KB の倍数）
+CHUNK_SIZE = 4 * 1024 * 1024
+
+_tmpfs_warned = set()
+
+
+def _filesystem_type(path):
+    """path があるファイルシステムの種類を返す（/proc/mounts を読めなければ None）"""
+    try:
+        with open('/proc/mounts', encoding='utf-8') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    best = None
+    for mount_point, fs_type in mounts:
+        if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+            if best is None or len(mount_point) > len(best[0]):
+                best = (mount_point, fs_type)
+    return best[1] if best else None
+
+
+def _warn_if_tmpfs(temp_dir):
+    directory = temp_dir or tempfile.gettempdir()
+    if directory in _tmpfs_warned:
+        return
+    _tmpfs_warned.add(directory)
+    if _filesystem_type(directory) == 'tmpfs':
+        print(f'Warning: 一時ディレクトリ {directory} はメモリ上（tmpfs）にあるため、'
+              'クリップの大きさだけメモリを使います。INGEST_MOUNT_DIR か INGEST_TMPDIR を設定してください')
+
+
+@contextlib.contextmanager
+def blob_tempfile(blob, suffix='.mp4', chunk_size=CHUNK_SIZE, temp_dir=None,
+                  mount_dir=None, max_bytes=None):
+    """
+    Blob をローカルのファイルとして読めるようにし、そのパスを返す
+
+    Cloud Functions / Cloud Run の /tmp はメモリ上（tmpfs）にあるため、/tmp に
+    コピーするとクリップの大きさだけインスタンスのメモリを使う。次の順で置き場所を選ぶ。
+
+    - mount_dir（省略時は環境変数 INGEST_MOUNT_DIR）: バケットを Cloud Storage FUSE で
+      マウントしたディレクトリ。<mount_dir>/<Blob 名> があればコピーせずにそのパスを返す
+    - temp_dir（省略時は環境変数 INGEST_TMPDIR、未設定なら OS の既定）: リクエストごとに
+      一意な一時ファイルへ blob.open() のチャンク単位の読み込みでコピーする
+      （メモリに載るのは chunk_size 分だけだが、tmpfs ならファイルもメモリに載る。
+      ディスクのボリュームをマウントしたディレクトリを指定すること）
+
+    max_bytes（省略時は環境変数 INGEST_MAX_BYTES）を超える Blob はコピーせずに
+    ValueError にする。コピーした一時ファイルは with ブロックを抜けると削除される。
+    """
+    mount_dir = mount_dir or os.environ.get('INGEST_MOUNT_DIR') or None
+    if mount_dir:
+        mounted_path = os.path.join(mount_dir, blob.name)
+        if os.path.isfile(mounted_path):
+            yield mounted_path
+            return
+
+    if max_bytes is None and os.environ.get('INGEST_MAX_BYTES'):
+        max_bytes = int(os.environ['INGEST_MAX_BYTES'])
+    temp_dir = temp_dir or os.environ.get('INGEST_TMPDIR') or None
+    _warn_if_tmpfs(temp_dir)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=temp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f, blob.open('rb', chunk_size=chunk_size) as reader:
+            if max_bytes is None:
+                shutil.copyfileobj(reader, f, chunk_size)
+            else:
+                copied = 0
+                while True:
+                    chunk = reader.read(chunk_size)
+                    if not chunk:
+                        break
+                    copied += len(chunk)
+                    if copied > max_bytes:
+                        raise ValueError(
+                            f'{blob.name} が INGEST_MAX_BYTES（{max_bytes} バイト）を超えています')
+                    f.write(chunk)
+        yield path
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
@@ -0,0 +1,167 @@
+import cv2
+import numpy as np
+
+
+def _sample_step(frame_count, max_samples):
+    """スコアを計算するフレームの間隔（クリップ全体から等間隔に max_samples 枚まで）"""
+    return max(1, frame_count // max_samples) if frame_count > 0 else 1
+
+
+def _score(previous, current, method):
+    if previous is None:
+        return 0.0
+    if method == 'motion':
+        # 動きの量：前のサンプルとの平均絶対差分
+        return float(cv2.absdiff(previous, current).mean())
+    if method == 'scene':
+        # 場面の変化：輝度ヒストグラムの Bhattacharyya 距離
+        hist_a = cv2.calcHist([previous], [0], None, [32], [0, 256])
+        hist_b = cv2.calcHist([current], [0], None, [32], [0, 256])
+        cv2.normalize(hist_a, hist_a)
+        cv2.normalize(hist_b, hist_b)
+        return float(cv2.compareHist(hist_a, hist_b, cv2.HISTCMP_BHATTACHARYYA))
+    raise ValueError(f'Unknown keyframe method: {method}')
+
+
+def score_frames(capture, method='motion', sample_width=160, max_samples=120):
+    """
+    クリップ全体を低解像度で走査し、(フレーム番号, スコア) のリストを返す
+
+    スコアを計算しないフレームは grab() で読み飛ばし、色変換とコピーを省く。
+    サンプルしたフレームだけを retrieve() して sample_width 幅のグレースケールに縮小する。
+    """
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    step = _sample_step(frame_count, max_samples)
+
+    scores = []
+    previous = None
+    index = -1
+    while capture.grab():
+        index += 1
+        if index % step:
+            continue
+        ret, frame = capture.retrieve()
+        if not ret:
+            break
+        height, width = frame.shape[:2]
+        if width > sample_width:
+            size = (sample_width, max(1, int(round(height * sample_width / width))))
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        scores.append((index, _score(previous, gray, method)))
+        previous = gray
+    return scores
+
+
+def pick_keyframes(scores, k):
+    """
+    スコアの高いフレームを k 枚選び、フレーム番号の昇順で返す
+
+    似た瞬間ばかり選ばないよう、選んだフレームの近く（最初はサンプル数 / (2k) 以内）は
+    候補から外す。変化がほとんどないクリップでは等間隔に選ぶ。
+    """
+    if not scores or k <= 0:
+        return []
+    if len(scores) <= k:
+        return [index for index, _ in scores]
+
+    ranked = sorted(range(len(scores)), key=lambda i: scores[i][1], reverse=True)
+    if scores[ranked[0]][1] <= 0:
+        positions = np.linspace(0, len(scores) - 1, k).round().astype(int)
+        return sorted({scores[i][0] for i in positions})
+
+    # 動きのある区間が短いと k 枚選べないので、間隔を半分ずつ緩めて選び足す
+    separation = max(1, len(scores) // (2 * k))
+    chosen = []
+    while len(chosen) < k:
+        for i in ranked:
+            if scores[i][1] <= 0 or len(chosen) >= k:
+                break
+            if i not in chosen and all(abs(i - j) >= separation for j in chosen):
+                chosen.append(i)
+        if separation == 1:
+            break
+        separation = max(1, separation // 2)
+    return sorted(scores[i][0] for i in chosen)
+
+
+def read_frames(capture, indices):
+    """指定したフレーム番号のフレームをシークして読み出す（読めなかったものは飛ばす）"""
+    frames = []
+    for index in indices:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+        ret, frame = capture.read()
+        if ret:
+            frames.append((index, frame))
+    return frames
+
+
+def select_keyframes(video_path, k=4, method='motion', sample_width=160, max_samples=120):
+    """
+    動画から情報量の多いフレームを k 枚選んで [(フレーム番号, フレーム), ...] を返す
+
+    method:
+        'motion': 前後のサンプルとの差分が大きい（動きの多い）フレーム
+        'scene': 輝度分布の変化が大きい（場面が切り替わった）フレーム
+    """
+    capture = cv2.VideoCapture(video_path)
+    try:
+        if not capture.isOpened():
+            raise RuntimeError(f'Failed to open video: {video_path}')
+        indices = pick_keyframes(
+            score_frames(capture, method, sample_width, max_samples), k)
+        return read_frames(capture, indices)
+    finally:
+        capture.release()
+
+
+def crop_region(region, region_frame_size, frame_size, margin=0.15, min_size=256, max_ratio=0.8):
+    """
+    動体領域を実際のフレームでの切り出し範囲 (x, y, w, h) に変換する
+
+    region はサイドカーの矩形（region_frame_size の解像度での座標）。周囲に margin
+    （矩形の幅・高さに対する割合）の余白を付け、min_size ピクセル未満にならないよう
+    中心から広げる。切り出してもフレームの max_ratio 以上の面積が残る場合は
+    切り出す意味がないので None を返す。
+    """
+    if not region:
+        return None
+    width, height = frame_size
+    scale_x = width / region_frame_size[0] if region_frame_size and region_frame_size[0] else 1.0
+    scale_y = height / region_frame_size[1] if region_frame_size and region_frame_size[1] else 1.0
+    x, y, w, h = region
+    center_x = (x + w / 2) * scale_x
+    center_y = (y + h / 2) * scale_y
+    crop_w = min(width, max(min_size, w * scale_x * (1 + 2 * margin)))
+    crop_h = min(height, max(min_size, h * scale_y * (1 + 2 * margin)))
+    if crop_w * crop_h >= width * height * max_ratio:
+        return None
+    left = int(round(min(max(0, center_x - crop_w / 2), width - crop_w)))
+    top = int(round(min(max(0, center_y - crop_h / 2), height - crop_h)))
+    return left, top, int(round(crop_w)), int(round(crop_h))
+
+
+def crop_frames(frames, region, region_frame_size, **kwargs):
+    """(フレーム番号, フレーム) のリストを動体領域で切り出す（切り出さない場合はそのまま返す）"""
+    if not frames:
+        return frames
+    height, width = frames[0][1].shape[:2]
+    rect = crop_region(region, region_frame_size, (width, height), **kwargs)
+    if rect is None:
+        return frames
+    x, y, w, h = rect
+    return [(index, frame[y:y + h, x:x + w]) for index, frame in frames]
+
+
+def encode_frames(frames, max_width=1024, quality=85):
+    """フレームを max_width 幅以下に縮小して JPEG のバイト列のリストにする"""
+    images = []
+    for _, frame in frames:
+        height, width = frame.shape[:2]
+        if width > max_width:
+            size = (max_width, int(round(height * max_width / width)))
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if ret:
+            images.append(buffer.tobytes())
+    return images
@@ -1,11 +1,11 @@
-import functions_framework
 from google.cloud import storage
+from datetime import datetime
+import json
 import os
 import sys
+import threading
+import time
 from pathlib import Path
-import cv2
-import numpy as np
-import json
 from flask import Flask, request
 
 app = Flask(__name__)
@@ -15,19 +15,116 @@ current_dir = Path(__file__).resolve().parent
 src_dir = current_dir.parent / 'src'
 sys.path.append(str(src_dir))
 
-from utils.gemini_analysis import GeminiAnalyzer
+from utils.gemini_analysis import get_analyzer
+from utils.telemetry import SIDECAR_SUFFIX, clip_context, clip_id_from_path, get_telemetry
+from gcs_ingest import blob_tempfile
+from keyframes import crop_frames, encode_frames, select_keyframes
+
+# Gemini に送るフレーム数と選び方（'motion' または 'scene'）
+KEYFRAME_COUNT = int(os.environ.get('KEYFRAME_COUNT', 4))
+KEYFRAME_METHOD = os.environ.get('KEYFRAME_METHOD', 'motion')
+# カメラ側がクリップと一緒にアップロードする動体領域（motion_track.py）で切り出すか
+CROP_TO_MOTION = os.environ.get('CROP_TO_MOTION', '1') == '1'
+
+# インスタンス内で使い回す GCS クライアント（最初のリクエストで作成する）
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def get_storage_client():
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+        return _storage_client
+
+
+def result_name(file_name):
+    """クリップの分析結果のファイル名（motion_<日時>.mp4 → motion_<日時>_analysis.txt）"""
+    return f"{os.path.splitext(file_name)[0]}_analysis.txt"
+
+
+def sidecar_name(file_name):
+    """クリップの動体領域のサイドカーのファイル名（セグメントに分割したクリップでも共通）"""
+    return f"motion_clips/{clip_id_from_path(file_name)}{SIDECAR_SUFFIX}"
+
+
+def parse_motion_region(data):
+    """サイドカーの内容から (矩形, 元の解像度) を返す（矩形がなければ None）"""
+    sidecar = json.loads(data)
+    if not sidecar.get("region"):
+        return None
+    return sidecar["region"], sidecar.get("frame_size")
+
+
+def load_motion_region(bucket, file_name):
+    """
+    クリップの動体領域のサイドカーを読み、(矩形, 元の解像度) を返す
+
+    サイドカーはイベントの終了時にアップロードされるため、セグメントに分割した
+    クリップの途中のセグメントなどでは見つからないことがある（その場合は None）。
+    """
+    blob = bucket.blob(sidecar_name(file_name))
+    try:
+        return parse_motion_region(blob.download_as_bytes())
+    except Exception as e:
+        print(f"Motion region not available for {file_name}: {e}")
+        return None
+
+
+def clip_images(video_path, motion_region=None):
+    """
+    ローカルのクリップからキーフレームを選び、Gemini に送る JPEG のリストを返す
+
+    motion_region（load_motion_region() の戻り値）を渡すと、フレームをその領域で
+    切り出す（CROP_TO_MOTION=0 の場合は切り出さない）。
+    """
+    telemetry = get_telemetry()
+    # 動きの多いフレームを選んで抽出（先頭はプリロールで動きがないことが多い）
+    with telemetry.span('keyframe_select', k=KEYFRAME_COUNT, method=KEYFRAME_METHOD):
+        frames = select_keyframes(video_path, k=KEYFRAME_COUNT, method=KEYFRAME_METHOD)
+    if not frames:
+        raise Exception("Failed to read video frame")
+    print(f"Selected frames: {[index for index, _ in frames]}")
+    
+    # 動きのあった領域だけを切り出す（広角カメラでは送る画像がかなり小さくなる）
+    if CROP_TO_MOTION and motion_region is not None:
+        frames = crop_frames(frames, *motion_region)
+        print(f"Cropped frames to motion region: {frames[0][1].shape[1]}x{frames[0][1].shape[0]}")
+    
+    # フレームをJPEG形式に変換
+    return encode_frames(frames)
+
+
+def _observe_trigger_delay(data):
+    """オブジェクトの作成からこの関数が呼ばれるまでの時間を記録する"""
+    created = data.get("timeCreated")
+    if not created:
+        return
+    try:
+        created_at = datetime.fromisoformat(created.replace("Z", "+00:00"))
+    except ValueError:
+        return
+    get_telemetry().observe('gcs_trigger_delay_seconds', time.time() - created_at.timestamp())
 
 @app.route('/', methods=['POST'])
 def analyze_video():
     """Cloud Storageのトリガーで実行される関数"""
-    try:
-        # Cloud Storageトリガーからのデータを取得
-        request_json = request.get_json(silent=True)
-        if not request_json:
-            return {"error": "No JSON data received"}, 400
+    # Cloud Storageトリガーからのデータを取得
+    request_json = request.get_json(silent=True)
+    if not request_json:
+        return {"error": "No JSON data received"}, 400
+    # 処理全体をクリップ ID 付きのスパンとして記録する（カメラ側の記録と突き合わせるため）
+    with clip_context(clip_id_from_path(request_json.get("name", ""))):
+        with get_telemetry().span('handler', function='analyze_video') as span:
+            result, status = _analyze(request_json)
+            span.set(http_status=status)
+            return result, status
 
-        data = request_json
 
+def _analyze(data):
+    telemetry = get_telemetry()
+    try:
         bucket_name = data["bucket"]
         file_name = data["name"]
         
@@ -35,49 +132,37 @@ def analyze_video():
         if not file_name.startswith("motion_clips/"):
             print(f"Skipping file not in motion_clips directory: {file_name}")
             return ({"message": "Skipped non-motion_clips file"}, 200)
+        # 動体領域のサイドカーや分析結果のファイルは処理しない
+        if not file_name.endswith(".mp4"):
+            print(f"Skipping non-video file: {file_name}")
+            return ({"message": "Skipped non-video file"}, 200)
+        _observe_trigger_delay(data)
         
-        # GCSクライアントの初期化
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
+        bucket = get_storage_client().bucket(bucket_name)
         blob = bucket.blob(file_name)
         
-        # 一時ファイルとして動画を保存
-        temp_video_path = "/tmp/temp_video.mp4"
-        blob.download_to_filename(temp_video_path)
+        motion_region = load_motion_region(bucket, file_name) if CROP_TO_MOTION else None
+        
+        # リクエストごとの一時ファイルへチャンク単位でストリーミングする
+        # （同じインスタンスで同時に処理しても衝突しない。抜けると削除される）
+        download_span = telemetry.span('gcs_download')
+        with blob_tempfile(blob) as temp_video_path:
+            download_span.end(bytes=os.path.getsize(temp_video_path))
+            images = clip_images(temp_video_path, motion_region)
         
-        try:
-            # 動画から最初のフレームを抽出
-            cap = cv2.VideoCapture(temp_video_path)
-            ret, frame = cap.read()
-            if not ret:
-                raise Exception("Failed to read video frame")
-            
-            # フレームをJPEG形式に変換
-            _, buffer = cv2.imencode('.jpg', frame)
-            image_data = buffer.tobytes()
-            
-            # Gemini分析の実行
-            analyzer = GeminiAnalyzer()
-            analysis_result = analyzer.analyze_image(image_data)
-            
-            # 分析結果をテキストファイルとして保存
-            result_filename = f"{os.path.splitext(file_name)[0]}_analysis.txt"
-            result_blob = bucket.blob(result_filename)
+        # Gemini分析の実行（選んだフレームを 1 回のリクエストにまとめる）
+        analysis_result = get_analyzer().analyze_images(images)
+        
+        # 分析結果をテキストファイルとして保存
+        result_filename = result_name(file_name)
+        result_blob = bucket.blob(result_filename)
+        with telemetry.span('result_upload', bytes=len(analysis_result.encode('utf-8'))):
             result_blob.upload_from_string(analysis_result)
-            
-            print(f"Analysis completed for {file_name}")
-            print(f"Results saved to {result_filename}")
-            
-            return ({"message": "Analysis completed successfully", "result_file": result_filename}, 200)
-            
-        finally:
-            # 一時ファイルの削除
-            if os.path.exists(temp_video_path):
-                os.remove(temp_video_path)
-            
-            # VideoCaptureのリリース
-            if 'cap' in locals():
-                cap.release()
+        
+        print(f"Analysis completed for {file_name}")
+        print(f"Results saved to {result_filename}")
+        
+        return ({"message": "Analysis completed successfully", "result_file": result_filename}, 200)
                 
     except Exception as e:
         print(f"Error in analyze_video: {str(e)}")
@@ -0,0 +1,298 @@
+import asyncio
+import threading
+import time
+
+import cv2
+
+
+class JpegFanout:
+    """
+    1 つの JPEG ストリームを複数の購読者へ配信する
+
+    購読者ごとのキューは持たず、最新の JPEG と連番だけを共有する。
+    遅い購読者は追いつけなかったフレームを飛ばして最新のものを受け取るので、
+    他の購読者や配信元が待たされることはない。
+
+    購読者がいなくなったとき（と reset() で）最新の JPEG を捨てるので、
+    新しい購読者に前回の配信の古いフレームが送られることはない。
+
+    スレッドからは subscribe()、asyncio のイベントループからは asubscribe() で
+    購読する（後者は購読者ごとにスレッドを消費しない）。
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._jpeg = None
+        self._seq = 0
+        self._subscribers = 0
+        self._closed = False
+        self._async_waiters = set()  # (イベントループ, asyncio.Event)
+
+    @property
+    def subscribers(self):
+        with self._condition:
+            return self._subscribers
+
+    def publish(self, jpeg):
+        with self._condition:
+            if self._subscribers == 0:
+                # 購読者がいない間のフレームは残さない
+                return
+            self._jpeg = jpeg
+            self._seq += 1
+            self._condition.notify_all()
+            waiters = list(self._async_waiters)
+        self._wake_async(waiters)
+
+    @staticmethod
+    def _wake_async(waiters):
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # イベントループが既に閉じている
+                pass
+
+    def wait_for_subscribers(self, timeout=None):
+        """購読者が現れるまで待つ（いれば True）"""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._subscribers > 0 or self._closed, timeout=timeout
+            ) and not self._closed
+
+    def subscribe(self, on_subscribe=None, timeout=1.0):
+        """
+        JPEG のバイト列を順に返すジェネレーター（close() されると終了する）
+
+        on_subscribe は購読者数に数えられた直後に呼ばれる。
+        """
+        with self._condition:
+            self._subscribers += 1
+            self._condition.notify_all()
+        try:
+            if on_subscribe is not None:
+                on_subscribe()
+            seq = 0
+            while True:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._has_new(seq) or self._closed, timeout=timeout)
+                    if self._closed:
+                        return
+                    if not self._has_new(seq):
+                        continue
+                    seq, jpeg = self._seq, self._jpeg
+                yield jpeg
+        finally:
+            self._unsubscribe()
+
+    async def asubscribe(self, on_subscribe=None):
+        """subscribe() の非同期版（async for で使う）"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._condition:
+            self._subscribers += 1
+            self._async_waiters.add(waiter)
+            self._condition.notify_all()
+        try:
+            if on_subscribe is not None:
+                on_subscribe()
+            seq = 0
+            while True:
+                waiter[1].clear()
+                with self._condition:
+                    if self._closed:
+                        return
+                    changed = self._has_new(seq)
+                    if changed:
+                        seq, jpeg = self._seq, self._jpeg
+                if not changed:
+                    # clear() の後に publish() されていれば即座に戻る
+                    await waiter[1].wait()
+                    continue
+                yield jpeg
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+            self._unsubscribe()
+
+    def _unsubscribe(self):
+        with self._condition:
+            self._subscribers -= 1
+            if self._subscribers == 0:
+                self._clear()
+
+    def _has_new(self, seq):
+        # reset() の直後は連番が戻るが、JPEG がないので新しいフレームとはみなさない
+        return self._seq != seq and self._jpeg is not None
+
+    def _clear(self):
+        self._jpeg = None
+        self._seq = 0
+
+    def reset(self):
+        """最新の JPEG を捨てる（カメラとの接続を閉じたときなど）"""
+        with self._condition:
+            self._clear()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            waiters = list(self._async_waiters)
+        self._wake_async(waiters)
+
+
+# 配信する画像幅の段階（視聴者ごとの指定はこのいずれかに丸める）
+VARIANT_WIDTHS = (320, 480, 640, 960, 1280, 1920)
+MIN_QUALITY = 30
+MAX_QUALITY = 95
+
+
+def normalize_variant(width=None, quality=80):
+    """
+    (幅, 画質) を配信用の段階に丸める
+
+    同じ段階を指定した視聴者同士でエンコード結果を共有できるよう、幅は
+    VARIANT_WIDTHS のうち指定値以下で最大のもの、画質は 5 刻みに丸める。
+    幅が None の場合は元の解像度のまま配信する。
+    """
+    if width is not None:
+        candidates = [w for w in VARIANT_WIDTHS if w <= width]
+        width = candidates[-1] if candidates else VARIANT_WIDTHS[0]
+    quality = int(round(quality / 5.0) * 5)
+    quality = max(MIN_QUALITY, min(MAX_QUALITY, quality))
+    return width, quality
+
+
+class FrameBroadcaster:
+    """
+    カメラ 1 台につき 1 つだけキャプチャと JPEG エンコードを行い、
+    同じバイト列を全視聴者へ配信するクラス
+
+    視聴者は画像幅と画質を指定でき、同じ (幅, 画質) の視聴者には 1 回の
+    エンコード結果を配信する。エンコードするのは視聴者がいる組み合わせだけ。
+    キャプチャは最初の視聴者が来たときに開始し、視聴者がいない状態が
+    idle_timeout 秒続いたらカメラとの接続を閉じる。
+    """
+
+    def __init__(self, url, quality=80, idle_timeout=10.0, reconnect_max_delay=30.0):
+        self.url = url
+        self.quality = quality
+        self.idle_timeout = idle_timeout
+        self.reconnect_max_delay = reconnect_max_delay
+        self._fanouts = {}  # (幅, 画質) -> JpegFanout
+        self._lock = threading.Lock()
+        self._thread = None
+        # 最後に取得したフレームの幅（取得する前は None）
+        self.frame_width = None
+
+    def _fanout(self, width, quality):
+        key = normalize_variant(width, self.quality if quality is None else quality)
+        with self._lock:
+            fanout = self._fanouts.get(key)
+            if fanout is None:
+                fanout = self._fanouts[key] = JpegFanout()
+            return fanout
+
+    def frames(self, width=None, quality=None):
+        """このカメラの JPEG を順に返すジェネレーター"""
+        return self._fanout(width, quality).subscribe(on_subscribe=self._ensure_started)
+
+    def aframes(self, width=None, quality=None):
+        """frames() の非同期版"""
+        return self._fanout(width, quality).asubscribe(on_subscribe=self._ensure_started)
+
+    def _active_variants(self):
+        with self._lock:
+            return [(key, fanout) for key, fanout in self._fanouts.items()
+                    if fanout.subscribers > 0]
+
+    def _encode(self, frame, variants):
+        """視聴者のいる (幅, 画質) ごとに 1 回だけエンコードして配信する"""
+        resized = {}
+        height, width = frame.shape[:2]
+        for (target_width, quality), fanout in variants:
+            if target_width is None or target_width >= width:
+                image = frame
+            else:
+                image = resized.get(target_width)
+                if image is None:
+                    size = (target_width, int(round(height * target_width / width)))
+                    image = resized[target_width] = cv2.resize(
+                        frame, size, interpolation=cv2.INTER_AREA)
+            ret, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ret:
+                fanout.publish(buffer.tobytes())
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._capture_loop, name='broadcaster', daemon=True)
+                self._thread.start()
+
+    def _capture_loop(self):
+        capture = None
+        failures = 0
+        idle_since = None
+        try:
+            while True:
+                variants = self._active_variants()
+                if not variants:
+                    idle_since = idle_since or time.monotonic()
+                    if time.monotonic() - idle_since > self.idle_timeout:
+                        # 終了の判定と新しい視聴者の開始処理が競合しないようロックを取る
+                        with self._lock:
+                            if not any(f.subscribers for f in self._fanouts.values()):
+                                self._thread = None
+                                return
+                else:
+                    idle_since = None
+
+                if capture is None:
+                    capture = cv2.VideoCapture(self.url)
+
+                success, frame = capture.read()
+                if not success:
+                    # 指数バックオフで開き直す
+                    failures += 1
+                    delay = min(self.reconnect_max_delay, 0.5 * 2 ** (failures - 1))
+                    print(f'フレームの取得に失敗しました。{delay:.1f} 秒後に再接続します...')
+                    capture.release()
+                    capture = None
+                    self._reset_fanouts()
+                    time.sleep(delay)
+                    continue
+                failures = 0
+                self.frame_width = frame.shape[1]
+
+                # 視聴者が何人いてもエンコードは (幅, 画質) ごとに 1 回だけ
+                if variants:
+                    self._encode(frame, variants)
+        finally:
+            if capture is not None:
+                capture.release()
+            self._reset_fanouts()
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _reset_fanouts(self):
+        """カメラとの接続を閉じたら、次の視聴者に古いフレームを送らないよう捨てる"""
+        with self._lock:
+            fanouts = list(self._fanouts.values())
+        for fanout in fanouts:
+            fanout.reset()
+
+
+_broadcasters = {}
+_broadcasters_lock = threading.Lock()
+
+
+def get_broadcaster(url, **kwargs):
+    """URL ごとに 1 つの FrameBroadcaster を返す"""
+    with _broadcasters_lock:
+        broadcaster = _broadcasters.get(url)
+        if broadcaster is None:
+            broadcaster = _broadcasters[url] = FrameBroadcaster(url, **kwargs)
+        return broadcaster
@@ -0,0 +1,158 @@
+import queue
+
+import numpy as np
+
+
+class DetachedFrames:
+    """
+    リングバッファから切り離したフレーム列
+
+    frames は切り離したアリーナ上のビューなので、使い終わったら release() で
+    アリーナをリングバッファへ返却する。
+    """
+
+    def __init__(self, frames, arena, release_fn):
+        self.frames = frames
+        self._arena = arena
+        self._release_fn = release_fn
+
+    def __len__(self):
+        return len(self.frames)
+
+    def release(self):
+        if self._arena is None:
+            return
+        arena, self._arena = self._arena, None
+        self.frames = []
+        self._release_fn(arena)
+
+
+class FrameRingBuffer:
+    """
+    プリロール用の固定長リングバッファ
+
+    フレームは事前確保したアリーナ（capacity x H x W x C の配列）のスロットへ
+    直接読み込み、古いフレームは上書きする。追加・破棄ともに O(1) で、
+    フレームごとの配列確保が発生しないためメモリ使用量は一定に保たれる。
+
+    max_arenas を 2 以上にすると detach() でバッファの中身をアリーナごと
+    別スレッドへ引き渡せる（コピーなし）。アリーナは最大 max_arenas 個まで
+    確保され、release() で返却されたものを使い回す。
+    """
+
+    def __init__(self, capacity, frame_shape=None, dtype=np.uint8, max_arenas=1):
+        if capacity <= 0:
+            raise ValueError('capacity must be positive')
+        self.capacity = int(capacity)
+        self.dtype = dtype
+        self.max_arenas = max(1, int(max_arenas))
+        self.frame_shape = None
+        self._arena = None
+        self._arena_count = 0
+        self._free_arenas = queue.SimpleQueue()  # 返却されたアリーナ
+        self._start = 0  # 最も古いフレームのスロット
+        self._size = 0
+        if frame_shape is not None:
+            self._allocate(frame_shape)
+
+    def _allocate(self, frame_shape):
+        self.frame_shape = tuple(frame_shape)
+        # サイズが変わった場合は返却済みのアリーナも使えないので破棄する
+        self._drain_free_arenas()
+        if self._arena is None:
+            self._arena_count += 1
+        self._arena = np.empty((self.capacity,) + self.frame_shape, dtype=self.dtype)
+        self._start = 0
+        self._size = 0
+
+    def _drain_free_arenas(self):
+        while True:
+            try:
+                self._free_arenas.get_nowait()
+            except queue.Empty:
+                return
+            self._arena_count -= 1
+
+    def _take_spare_arena(self):
+        while True:
+            try:
+                arena = self._free_arenas.get_nowait()
+            except queue.Empty:
+                break
+            if arena.shape[1:] == self.frame_shape:
+                return arena
+            self._arena_count -= 1
+        if self._arena_count >= self.max_arenas:
+            return None
+        self._arena_count += 1
+        return np.empty((self.capacity,) + self.frame_shape, dtype=self.dtype)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def allocated(self):
+        return self._arena is not None
+
+    def next_slot(self):
+        """
+        次に書き込むスロットのビューを返す（未確保の場合は None）
+
+        返したビューへ書き込んだ後に commit() を呼ぶとバッファへ追加される。
+        バッファが満杯の場合、このスロットは最も古いフレームのものになる。
+        """
+        if self._arena is None:
+            return None
+        return self._arena[(self._start + self._size) % self.capacity]
+
+    def commit(self, frame=None):
+        """
+        next_slot() に書き込んだフレームを確定する
+
+        frame がスロット外の配列だった場合（cv2 がサイズ不一致などで新しい配列を
+        返した場合）はスロットへコピーする。フレームサイズが変わった場合は
+        アリーナを確保し直す。
+        """
+        if frame is not None and (self._arena is None or frame.shape != self.frame_shape):
+            self._allocate(frame.shape)
+
+        slot = self.next_slot()
+        if frame is not None and frame.ctypes.data != slot.ctypes.data:
+            np.copyto(slot, frame)
+
+        if self._size < self.capacity:
+            self._size += 1
+        else:
+            self._start = (self._start + 1) % self.capacity
+        return slot
+
+    def append(self, frame):
+        """フレームをコピーして追加する"""
+        return self.commit(frame)
+
+    def frames(self):
+        """古い順に並んだフレームのビューのリストを返す（コピーはしない）"""
+        return [self._arena[(self._start + i) % self.capacity] for i in range(self._size)]
+
+    def clear(self):
+        self._start = 0
+        self._size = 0
+
+    def detach(self):
+        """
+        現在のフレーム列をアリーナごと切り離して返す
+
+        バッファは空になり、以降の書き込みは予備のアリーナへ行われる。
+        予備のアリーナがない（すべて使用中の）場合は何もせずに None を返す。
+        このメソッドは書き込みを行うスレッドから呼ぶこと。release() は任意の
+        スレッドから呼んでよい。
+        """
+        if self._arena is None or self._size == 0:
+            return None
+        spare = self._take_spare_arena()
+        if spare is None:
+            return None
+        detached = DetachedFrames(self.frames(), self._arena, self._free_arenas.put)
+        self._arena = spare
+        self.clear()
+        return detached
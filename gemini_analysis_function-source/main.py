@@ -1,18 +1,46 @@
 import os
+import re
 import json
 import logging
-import tempfile
-from pathlib import Path
-from typing import Optional
+import threading
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from typing import Optional, Union
 
-import base64
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import GenerationConfig, GenerativeModel, Part
+
+from telemetry import clip_context, clip_id_from_path, get_telemetry
 
 # ロギング設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+RESULT_KEYS = ("environment", "safety", "informative_message")
+
+# 3 項目を 1 回の呼び出しで得る場合の構造化出力スキーマ
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {key: {"type": "string"} for key in RESULT_KEYS},
+    "required": list(RESULT_KEYS),
+}
+
+STRUCTURED_PROMPT = """
+        あなたは、作業現場の映像から作業内容・環境と潜在する危険性を分析し、安全のための一言を提案するエージェントです。
+        与えられた映像に基づき、以下の 3 項目を JSON で出力してください。
+
+        environment:
+            作業内容： 映像内で実施されている具体的な作業や活動を記述してください。
+            場所： 映像から推測される場所や環境（屋内、屋外、特定の施設など）を記述してください。
+            天候： 屋外の場合、映像から読み取れる天候（例：晴れ、曇り、雨など）を記述してください。
+        safety:
+            environment の内容に基づいて、この状況下で作業を行う場合に考えられる具体的な危険を、簡潔かつ明確に説明してください。
+            潜在危険： 具体的な危険要因やリスク（例：転倒、機械的事故、感電、滑りやすい床、悪天候による視界不良など）を記述してください。
+            理由： それぞれの危険が発生する可能性の背景や理由を、簡潔に説明してください。
+        informative_message:
+            safety の内容を踏まえて、優しい口調でシンプルかつ親しみやすい一言で安全対策を提案してください。
+        """
+
 # === GeminiAnalyzer クラス（動画解析版） ===
 class GeminiAnalyzer:
     """
@@ -31,26 +59,86 @@ class GeminiAnalyzer:
         # ※Gemini 1.5 Flash-002（安定版例）を使用しています。必要に応じて変更してください。
         self.model = GenerativeModel("gemini-1.5-flash-002")
     
-    def _analyze_with_prompt(self, video_data: bytes, prompt: str) -> str:
+    @staticmethod
+    def _video_part(video: Union[bytes, str, Part]) -> Part:
+        """
+        動画を Part に変換する
+
+        "gs://" で始まる文字列は GCS 上のオブジェクトへの参照として渡す
+        （動画のバイト列をリクエストに含めない）。作成済みの Part はそのまま返す。
+        """
+        if isinstance(video, Part):
+            return video
+        if isinstance(video, str):
+            if not video.startswith('gs://'):
+                raise ValueError(f"GCS の URI（gs://...）を指定してください: {video}")
+            return Part.from_uri(video, mime_type='video/mp4')
+        return Part.from_data(video, mime_type='video/mp4')
+    
+    def _analyze_with_prompt(self, video: Union[bytes, str, Part], prompt: str, name: str = "") -> str:
         """指定されたプロンプトで動画解析を実行（動画の MIME は "video/mp4" とする）"""
-        response = self.model.generate_content(
-            [
-                prompt,
-                Part.from_data(video_data, mime_type='video/mp4')
-            ]
-        )
+        with get_telemetry().span('gemini_call', prompt=name) as span:
+            response = self.model.generate_content(
+                [
+                    prompt,
+                    self._video_part(video)
+                ]
+            )
+            span.set(response_chars=len(response.text))
         return response.text.strip()
     
-    def analyze_video(self, video_data: bytes) -> str:
+    def _analyze_structured(self, video_part: Part) -> Optional[dict]:
+        """3 項目を 1 回の呼び出しで取得する（応答が不正な場合は None）"""
+        with get_telemetry().span('gemini_call', prompt='structured') as span:
+            response = self.model.generate_content(
+                [STRUCTURED_PROMPT, video_part],
+                generation_config=GenerationConfig(
+                    response_mime_type="application/json",
+                    response_schema=RESPONSE_SCHEMA,
+                ),
+            )
+            span.set(response_chars=len(response.text))
+        try:
+            data = json.loads(response.text)
+            return {key: data[key].strip() for key in RESULT_KEYS}
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.warning("構造化出力を解析できなかったため、プロンプトを順に実行します。")
+            return None
+    
+    def analyze_video(self, video: Union[bytes, str], mode: str = "chained") -> str:
         """
         動画を解析し、作業内容、危険性、メッセージを抽出して JSON 文字列で返す
+
+        辞書のまま使う場合は analyze_video_data() を呼ぶ（文字列への変換と解析を省ける）。
+        """
+        return json.dumps(self.analyze_video_data(video, mode), ensure_ascii=False, indent=2)
+
+    def analyze_video_data(self, video: Union[bytes, str], mode: str = "chained") -> dict:
+        """
+        動画を解析し、作業内容、危険性、メッセージを抽出して辞書で返す
         
         Args:
-            video_data: 解析対象動画のバイナリデータ（動画に音声は含まれていない）
+            video: 解析対象動画のバイナリデータ、または GCS 上の URI（gs://bucket/name）
+                （動画に音声は含まれていない）
+            mode: "chained" は 3 つのプロンプトを順に実行し、前の結果を次のプロンプトに渡す。
+                "structured" は 3 項目を 1 回の呼び出し（JSON スキーマ指定）で取得する
         
         Returns:
-            JSON 形式の文字列（キー: "作業内容", "危険性", "メッセージ"）
+            キーが "environment", "safety", "informative_message" の辞書
         """
+        if mode not in ("chained", "structured"):
+            raise ValueError(f"Unknown analysis mode: {mode}")
+        with get_telemetry().span('gemini_analyze', mode=mode):
+            return self._analyze_video(video, mode)
+    
+    def _analyze_video(self, video: Union[bytes, str, Part], mode: str) -> dict:
+        # 動画への参照は 1 つだけ作り、すべてのプロンプトで使い回す
+        video_part = self._video_part(video)
+        if mode == "structured":
+            result = self._analyze_structured(video_part)
+            if result is not None:
+                return result
+
         # ① 作業内容の抽出
         work_prompt = """
         あなたは、映像から作業内容およびその周辺環境を抽出することに特化したエージェントです。
@@ -63,7 +151,7 @@ class GeminiAnalyzer:
         天候： 屋外の場合、映像から読み取れる天候（例：晴れ、曇り、雨など）を記述してください。
 
         """
-        work_content = self._analyze_with_prompt(video_data, work_prompt)
+        work_content = self._analyze_with_prompt(video_part, work_prompt, 'environment')
         
         # ② 危険性の抽出
         danger_prompt = f"""
@@ -76,21 +164,173 @@ class GeminiAnalyzer:
         理由： それぞれの危険が発生する可能性の背景や理由を、簡潔に説明してください。
 
         """
-        danger_content = self._analyze_with_prompt(video_data, danger_prompt)
+        danger_content = self._analyze_with_prompt(video_part, danger_prompt, 'safety')
         
         # ③ メッセージの抽出
         message_prompt = f"""
         あなたは、抽出された危険性情報に基づき、優しい口調でこの状況下で気をつけるべきことを一言で提案するエージェントです。
         以下の「危険性」情報（{danger_content}）を踏まえて、シンプルかつ親しみやすい一言で安全対策を提案してください。
         """
-        message_content = self._analyze_with_prompt(video_data, message_prompt)
+        message_content = self._analyze_with_prompt(video_part, message_prompt, 'informative')
         
         result = {
             "environment": work_content,
             "safety": danger_content,
             "informative_message": message_content
         }
-        return json.dumps(result, ensure_ascii=False, indent=2)
+        return result
+
+# === インスタンス内で使い回すクライアント ===
+# 呼び出しごとに vertexai.init() やモデル・接続を作り直さないよう、最初に必要になったときに作る
+_analyzer = None
+_firebase_db = None
+_clients_lock = threading.Lock()
+
+
+def get_analyzer() -> GeminiAnalyzer:
+    global _analyzer
+    with _clients_lock:
+        if _analyzer is None:
+            _analyzer = GeminiAnalyzer()
+        return _analyzer
+
+
+def get_firebase_db():
+    """初期化済みの firebase_admin.db モジュールを返す"""
+    global _firebase_db
+    with _clients_lock:
+        if _firebase_db is None:
+            # firebase_admin の読み込みは重いので、最初に保存するときまで遅らせる
+            import firebase_admin
+            from firebase_admin import credentials, db
+            if not firebase_admin._apps:
+                # GCP環境の場合は Application Default Credentials を使用できます。
+                # 自前のサービスアカウントキーを使う場合は credentials.Certificate("path/to/serviceAccountKey.json") としてください。
+                cred = credentials.ApplicationDefault()
+                firebase_admin.initialize_app(cred, {
+                    'databaseURL': 'https://ai-agent-449514-default-rtdb.firebaseio.com/'
+                })
+            _firebase_db = db
+        return _firebase_db
+
+# === Realtime Database への結果の書き込み ===
+# 保存先のノード
+#   gemini_results/<カメラID>/<日付>/<キー>: 解析結果の全体
+#   gemini_index/<日付>/<キー>_<カメラID>: 全カメラの結果の一覧（時刻順、本文を含まない）
+#   gemini_latest/<カメラID>: カメラごとの最新の結果の要約
+# キーは "<時刻>_<クリップ名>"（例: 120000_motion_20240101_120000_000）で、キー順が時刻順になる。
+# ダッシュボード（src/app/page.tsx）は gemini_latest を監視し、本文は path から読む。
+# 過去の結果は gemini_index/<日付> を orderByKey() で範囲指定した一部だけを読む。
+RESULTS_NODE = 'gemini_results'
+INDEX_NODE = 'gemini_index'
+LATEST_NODE = 'gemini_latest'
+
+# カメラ ID のないクリップ（motion_clips/motion_<日時>.mp4）のカメラ ID
+DEFAULT_CAMERA = 'default'
+
+# クリップ名の日時（カメラ側の現地時刻）のタイムゾーン。アップロード日時（UTC）も
+# このタイムゾーンに直してから日付のバケットとキーを決める
+CLIP_TIMEZONE = ZoneInfo(os.getenv('CLIP_TIMEZONE', 'Asia/Tokyo'))
+
+_CLIP_TIME = re.compile(r'(\d{8})_(\d{6})')
+# Realtime Database のキーに使えない文字
+_INVALID_KEY_CHARS = re.compile(r'[.#$\[\]/\x00-\x1f\x7f]')
+
+
+def _db_key(value: str) -> str:
+    return _INVALID_KEY_CHARS.sub('_', value) or '_'
+
+
+def result_location(file_name: str, time_created: Optional[str] = None) -> dict:
+    """
+    Blob 名から結果の保存先（カメラ ID・日付・キー）を求める
+
+    録画日時はクリップ名（motion_<YYYYMMDD>_<HHMMSS>、CLIP_TIMEZONE の時刻）から取る。
+    クリップ名に日時がない場合はアップロード日時（イベントの timeCreated）、それもなければ
+    現在時刻を CLIP_TIMEZONE に直して使う（同じ日付のバケットに別のタイムゾーンの時刻が混ざらないよう）。
+    """
+    clip_id = clip_id_from_path(file_name)
+    camera, _, _ = clip_id.rpartition('/')
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+
+    recorded_at = None
+    match = _CLIP_TIME.search(stem)
+    if match:
+        try:
+            recorded_at = datetime.strptime(''.join(match.groups()), '%Y%m%d%H%M%S')
+            recorded_at = recorded_at.replace(tzinfo=CLIP_TIMEZONE)
+        except ValueError:
+            pass
+    if recorded_at is None and time_created:
+        try:
+            recorded_at = datetime.fromisoformat(time_created.replace('Z', '+00:00'))
+            if recorded_at.tzinfo is None:
+                recorded_at = recorded_at.replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    if recorded_at is None:
+        recorded_at = datetime.now(timezone.utc)
+    recorded_at = recorded_at.astimezone(CLIP_TIMEZONE).replace(microsecond=0)
+    day, clock = recorded_at.strftime('%Y%m%d'), recorded_at.strftime('%H%M%S')
+
+    return {
+        'clip_id': clip_id,
+        'camera': _db_key(camera.replace('/', '_') or DEFAULT_CAMERA),
+        'day': day,
+        'key': _db_key(f'{clock}_{stem}'),
+        'recorded_at': recorded_at.isoformat(),
+    }
+
+
+def result_updates(file_name: str, result: dict, source: Optional[str] = None,
+                   time_created: Optional[str] = None) -> tuple:
+    """
+    1 件の結果を書き込む複数パスの update() の内容を作り、(本体のパス, 内容) を返す
+
+    本体・一覧・最新の要約の 3 か所を同じ update() で書くので、どれかだけが
+    書かれることはない。gemini_latest は後から届いた結果で上書きする（同じカメラの
+    クリップのイベントが前後して届いた場合は古い結果になることがある）。
+    """
+    location = result_location(file_name, time_created)
+    camera, day, key = location['camera'], location['day'], location['key']
+    path = f"{RESULTS_NODE}/{camera}/{day}/{key}"
+    analyzed_at = {'.sv': 'timestamp'}  # サーバーの時刻（ミリ秒）
+
+    record = dict(result)
+    record.update(
+        clip_id=location['clip_id'],
+        camera=camera,
+        recorded_at=location['recorded_at'],
+        analyzed_at=analyzed_at,
+    )
+    if source:
+        record['source'] = source
+
+    updates = {
+        path: record,
+        f"{INDEX_NODE}/{day}/{key}_{camera}": {
+            'camera': camera,
+            'recorded_at': location['recorded_at'],
+            'path': path,
+        },
+        f"{LATEST_NODE}/{camera}": {
+            'clip_id': location['clip_id'],
+            'recorded_at': location['recorded_at'],
+            'analyzed_at': analyzed_at,
+            'informative_message': result.get('informative_message', ''),
+            'path': path,
+        },
+    }
+    return path, updates
+
+
+def write_result(db, file_name: str, result: dict, source: Optional[str] = None,
+                 time_created: Optional[str] = None) -> str:
+    """結果を 1 回の複数パスの update() で書き込み、本体のパスを返す"""
+    path, updates = result_updates(file_name, result, source, time_created)
+    with get_telemetry().span('firebase_write', paths=len(updates)):
+        db.reference().update(updates)
+    return path
 
 # === Cloud Function ハンドラー ===
 def analyze_video_to_json(event, context):
@@ -99,6 +339,13 @@ def analyze_video_to_json(event, context):
     動画ファイルから Gemini API を使い、作業内容・危険性・メッセージの３項目を抽出し、
     結果を JSON 形式で Firebase Realtime Database に保存します。
     """
+    # 処理全体をクリップ ID 付きのスパンとして記録する（カメラ側の記録と突き合わせるため）
+    with clip_context(clip_id_from_path(event.get('name', ''))):
+        with get_telemetry().span('handler', function='analyze_video_to_json'):
+            _handle_event(event)
+
+
+def _handle_event(event):
     try:
         bucket_name = event['bucket']
         file_name = event['name']
@@ -112,61 +359,29 @@ def analyze_video_to_json(event, context):
         logger.info("対象ファイルは mp4 ではないため、処理をスキップします。")
         return
 
-    # GCS から動画ファイルを /tmp にダウンロード
-    from google.cloud import storage
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file_name)
-    temp_dir = tempfile.gettempdir()
-    local_video_path = os.path.join(temp_dir, os.path.basename(file_name))
-    try:
-        blob.download_to_filename(local_video_path)
-        logger.info(f"動画ファイルを {local_video_path} にダウンロードしました。")
-    except Exception as e:
-        logger.error(f"動画ファイルのダウンロードに失敗しました: {e}")
-        return
-
-    # 動画ファイルをバイナリデータとして読み込む
-    try:
-        with open(local_video_path, "rb") as f:
-            video_data = f.read()
-    except Exception as e:
-        logger.error(f"動画ファイルの読み込みに失敗しました: {e}")
-        return
+    # 動画はダウンロードせず、GCS 上の URI を Gemini に渡す
+    video_uri = f"gs://{bucket_name}/{file_name}"
 
     # GeminiAnalyzer を使って動画解析
     try:
-        analyzer = GeminiAnalyzer()
-        analysis_result_json = analyzer.analyze_video(video_data)
-        logger.info(f"解析結果: {analysis_result_json}")
+        analysis_result = get_analyzer().analyze_video_data(
+            video_uri, mode=os.getenv('GEMINI_ANALYSIS_MODE', 'chained'))
+        logger.info(f"解析結果: {analysis_result}")
     except Exception as e:
         logger.error(f"動画解析中にエラーが発生しました: {e}")
         return
 
     # Firebase Admin SDK を利用して、解析結果を Realtime Database に保存する
     try:
-        import firebase_admin
-        from firebase_admin import credentials, db
-        # 初期化済みか確認。未初期化の場合は初期化
-        if not firebase_admin._apps:
-            # GCP環境の場合は Application Default Credentials を使用できます。
-            # 自前のサービスアカウントキーを使う場合は credentials.Certificate("path/to/serviceAccountKey.json") としてください。
-            cred = credentials.ApplicationDefault()
-            firebase_admin.initialize_app(cred, {
-                'databaseURL': 'https://ai-agent-449514-default-rtdb.firebaseio.com/'
-            })
+        db = get_firebase_db()
     except Exception as e:
         logger.error(f"Firebase Admin SDK の初期化に失敗しました: {e}")
         return
 
     try:
-        # JSON文字列を辞書型に変換
-        result_data = json.loads(analysis_result_json)
-        key = os.path.splitext(os.path.basename(file_name))[0]
-        # Realtime Database の "gemini_outputs" ノード配下に書き込む
-        ref = db.reference('gemini_outputs')
-        ref.child(key).set(result_data)
-        logger.info(f"Realtime Database に結果を保存しました: {key}")
+        path = write_result(db, file_name, analysis_result, source=video_uri,
+                            time_created=event.get('timeCreated'))
+        logger.info(f"Realtime Database に結果を保存しました: {path}")
     except Exception as e:
         logger.error(f"Realtime Database への保存に失敗しました: {e}")
         return
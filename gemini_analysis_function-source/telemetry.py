@@ -0,0 +1,302 @@
+"""
+動体検知から音声通知までの処理時間を計測するための簡易テレメトリー
+
+スパン（処理区間）とメトリクス（カウンター・ゲージ・ヒストグラム）を記録する。
+スパンには clip_id を付け、カメラ側の録画・アップロードからクラウド側の分析・
+保存・音声合成までを同じクリップの処理として突き合わせられるようにする。
+
+    from telemetry import span, clip_context, counter
+
+    with clip_context(clip_id_from_path(path)):
+        with span('gemini_call', prompt='environment') as s:
+            ...
+            s.set(bytes=len(data))
+
+出力先は環境変数で指定する。
+    TELEMETRY_FILE: スパンを JSON Lines で追記するファイル
+    TELEMETRY_LOG: 1 ならスパンを標準エラーに JSON で出力する（Cloud Logging 向け）
+    TELEMETRY_PROMETHEUS_PORT: メトリクスを Prometheus 形式で公開するポート（/metrics）
+"""
+import contextlib
+import contextvars
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+# 処理時間のヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_clip_id = contextvars.ContextVar('telemetry_clip_id', default=None)
+_parent_span = contextvars.ContextVar('telemetry_parent_span', default=None)
+
+_SEGMENT_SUFFIX = re.compile(r'_(\d{3})$')
+
+# クリップと一緒にアップロードする動体領域のファイル名の接尾辞
+# （motion_<日時>.mp4 / motion_<日時>_000.mp4 → motion_<日時>_boxes.json）
+SIDECAR_SUFFIX = '_boxes.json'
+
+
+def clip_id_from_path(path: str) -> str:
+    """
+    ファイルパスや Blob 名からクリップ ID を作る
+
+    motion_clips/<カメラID>/motion_<日時>_000.mp4 → <カメラID>/motion_<日時>
+    （セグメント番号と拡張子を除き、カメラ側とクラウド側で同じ ID になる）
+    """
+    path = str(path).replace('\\', '/')
+    if path.startswith('gs://'):
+        path = path.split('/', 3)[-1]
+    if 'motion_clips/' in path:
+        path = path.split('motion_clips/', 1)[1]
+    else:
+        path = path.rsplit('/', 1)[-1]
+    path = os.path.splitext(path)[0]
+    for suffix in ('_analysis', os.path.splitext(SIDECAR_SUFFIX)[0]):
+        if path.endswith(suffix):
+            path = path[:-len(suffix)]
+    return _SEGMENT_SUFFIX.sub('', path)
+
+
+def _label_key(labels: Dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Span:
+    """1 つの処理区間（end() または with ブロックの終了で記録される）"""
+
+    def __init__(self, telemetry, name, clip_id=None, attributes=None):
+        self.telemetry = telemetry
+        self.name = name
+        self.clip_id = clip_id if clip_id is not None else _clip_id.get()
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = _parent_span.get()
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def end(self, status='ok', **attributes):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._start
+        self.attributes.update(attributes)
+        self.telemetry._finish_span(self, status)
+
+    def __enter__(self):
+        self._token = _parent_span.set(self.span_id)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _parent_span.reset(self._token)
+        if exc_type is not None:
+            self.end(status='error', error=str(exc))
+        else:
+            self.end()
+        return False
+
+
+class Telemetry:
+    """スパンとメトリクスの記録先"""
+
+    def __init__(self, jsonl_path: Optional[str] = None, log_stream=None,
+                 service: Optional[str] = None):
+        self.jsonl_path = jsonl_path
+        self.log_stream = log_stream
+        self.service = service
+        self._lock = threading.Lock()
+        self._counters = {}  # (名前, ラベル) -> 値
+        self._gauges = {}
+        self._histograms = {}  # (名前, ラベル) -> [バケットごとの件数, 合計, 件数]
+        self._server = None
+
+    # --- スパン ---
+
+    def span(self, name: str, clip_id: Optional[str] = None, **attributes) -> Span:
+        """with で使うか、end() を呼ぶまでの区間を記録する"""
+        return Span(self, name, clip_id, attributes)
+
+    def event(self, name: str, clip_id: Optional[str] = None, **attributes):
+        """長さのない出来事（動体を検知した時刻など）を記録する"""
+        span = Span(self, name, clip_id, attributes)
+        span.duration = 0.0
+        self._export(self._span_record(span, 'ok', kind='event'))
+
+    def _span_record(self, span: Span, status: str, kind: str = 'span') -> Dict:
+        record = {
+            'kind': kind,
+            'name': span.name,
+            'clip_id': span.clip_id,
+            'span_id': span.span_id,
+            'parent_id': span.parent_id,
+            'start': span.start_time,
+            'duration': span.duration,
+            'status': status,
+        }
+        if self.service:
+            record['service'] = self.service
+        record.update(span.attributes)
+        return record
+
+    def _finish_span(self, span: Span, status: str):
+        self.observe(f'{span.name}_seconds', span.duration, status=status)
+        self._export(self._span_record(span, status))
+
+    def _export(self, record: Dict):
+        if not self.jsonl_path and self.log_stream is None:
+            return
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            if self.jsonl_path:
+                try:
+                    with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                        f.write(line + '\n')
+                except OSError as e:
+                    print(f'Warning: テレメトリーを書き込めませんでした: {e}', file=sys.stderr)
+            if self.log_stream is not None:
+                print(line, file=self.log_stream, flush=True)
+
+    # --- メトリクス ---
+
+    def counter(self, name: str, value: float = 1, **labels):
+        """累積値を増やす（処理件数、転送したバイト数など）"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        """現在値を設定する（キューの長さなど）"""
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name: str, value: float, buckets=DEFAULT_BUCKETS, **labels):
+        """ヒストグラムに値を追加する（1 フレームの処理時間など、件数の多い計測向け）"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(histogram[0]):
+                if value <= bound:
+                    histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def snapshot(self) -> Dict:
+        """現在のメトリクスを辞書で返す（ベンチマークやテスト向け）"""
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': {key: {'sum': h[2], 'count': h[3]}
+                               for key, h in self._histograms.items()},
+            }
+
+    def render_prometheus(self) -> str:
+        """Prometheus のテキスト形式でメトリクスを返す"""
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f'{name}_total{fmt(labels)} {value}')
+            for (name, labels), value in sorted(self._gauges.items()):
+                lines.append(f'{name}{fmt(labels)} {value}')
+            for (name, labels), (buckets, counts, total, count) in sorted(self._histograms.items()):
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f'{name}_bucket{fmt(labels, [("le", bound)])} {bucket_count}')
+                lines.append(f'{name}_bucket{fmt(labels, [("le", "+Inf")])} {count}')
+                lines.append(f'{name}_sum{fmt(labels)} {total}')
+                lines.append(f'{name}_count{fmt(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def start_http_server(self, port: int, host: str = '0.0.0.0'):
+        """/metrics でメトリクスを公開する HTTP サーバーを起動する"""
+        if self._server is not None:
+            return self._server
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = telemetry.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='telemetry-metrics',
+                         daemon=True).start()
+        return self._server
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_telemetry() -> Telemetry:
+    """環境変数の設定で作ったプロセス共通の Telemetry を返す"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Telemetry(
+                jsonl_path=os.getenv('TELEMETRY_FILE') or None,
+                log_stream=sys.stderr if os.getenv('TELEMETRY_LOG') == '1' else None,
+                service=os.getenv('TELEMETRY_SERVICE') or None,
+            )
+            port = os.getenv('TELEMETRY_PROMETHEUS_PORT')
+            if port:
+                _default.start_http_server(int(port))
+        return _default
+
+
+def span(name: str, clip_id: Optional[str] = None, **attributes) -> Span:
+    return get_telemetry().span(name, clip_id, **attributes)
+
+
+def event(name: str, clip_id: Optional[str] = None, **attributes):
+    get_telemetry().event(name, clip_id, **attributes)
+
+
+def counter(name: str, value: float = 1, **labels):
+    get_telemetry().counter(name, value, **labels)
+
+
+def gauge(name: str, value: float, **labels):
+    get_telemetry().gauge(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    get_telemetry().observe(name, value, **labels)
+
+
+@contextlib.contextmanager
+def clip_context(clip_id: Optional[str]):
+    """ブロック内で作るスパンに clip_id を付ける"""
+    token = _clip_id.set(clip_id)
+    try:
+        yield
+    finally:
+        _clip_id.reset(token)
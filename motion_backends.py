@@ -0,0 +1,114 @@
+import cv2
+import numpy as np
+
+
+class MotionBackend:
+    """
+    動体検知のバックエンドの基底クラス
+
+    サブクラスは foreground() で前景マスク（動いた画素が 255 の 8 ビット画像）を返す。
+    detect() はマスクから輪郭を求め、(スコア, 矩形のリスト) を返す。スコアは
+    前景の画素の割合（0.0〜1.0）、矩形は面積が min_area を超える輪郭の外接矩形
+    (x, y, w, h)（渡したフレームの座標）。
+    """
+
+    # ノイズ除去の収縮・膨張の回数
+    erode_iterations = 2
+    dilate_iterations = 2
+
+    def foreground(self, frame):
+        raise NotImplementedError
+
+    def detect(self, frame, min_area, mask=None):
+        fg_mask = self.foreground(frame)
+        if mask is not None:
+            fg_mask = cv2.bitwise_and(fg_mask, mask)
+
+        # ノイズ除去
+        if self.erode_iterations:
+            fg_mask = cv2.erode(fg_mask, None, iterations=self.erode_iterations)
+        if self.dilate_iterations:
+            fg_mask = cv2.dilate(fg_mask, None, iterations=self.dilate_iterations)
+
+        score = cv2.countNonZero(fg_mask) / fg_mask.size if fg_mask.size else 0.0
+        if score == 0.0:
+            return 0.0, []
+
+        # 輪郭を検出
+        contours, _ = cv2.findContours(
+            fg_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        boxes = [cv2.boundingRect(contour) for contour in contours
+                 if cv2.contourArea(contour) > min_area]
+        return score, boxes
+
+
+class MOG2Backend(MotionBackend):
+    """混合ガウス分布による背景差分（従来の検知。精度が必要なカメラ向け）"""
+
+    def __init__(self, history=500, var_threshold=16):
+        self.subtractor = cv2.createBackgroundSubtractorMOG2(
+            history=history, varThreshold=var_threshold, detectShadows=False)
+
+    def foreground(self, frame):
+        return self.subtractor.apply(frame)
+
+
+class KNNBackend(MotionBackend):
+    """k 近傍法による背景差分（MOG2 より照明の揺らぎに強いことがある）"""
+
+    def __init__(self, history=500, dist2_threshold=400.0):
+        self.subtractor = cv2.createBackgroundSubtractorKNN(
+            history=history, dist2Threshold=dist2_threshold, detectShadows=False)
+
+    def foreground(self, frame):
+        return self.subtractor.apply(frame)
+
+
+class FrameDiffBackend(MotionBackend):
+    """
+    移動平均の背景との差分による軽量な検知
+
+    グレースケールの背景を accumulateWeighted で更新し（alpha が大きいほど早く
+    背景に溶け込む）、差分が threshold を超えた画素を前景とする。画素ごとの
+    モデルを持たないため MOG2 よりかなり軽い。detect_width で縮小した小さな
+    フレームと組み合わせる前提で、重要度の低いカメラ向け。
+    """
+
+    erode_iterations = 1
+
+    def __init__(self, alpha=0.05, threshold=25, blur=5):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.blur = blur
+        self._background = None
+
+    def foreground(self, frame):
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.blur:
+            frame = cv2.GaussianBlur(frame, (self.blur, self.blur), 0)
+
+        if self._background is None or self._background.shape != frame.shape:
+            self._background = frame.astype(np.float32)
+            return np.zeros(frame.shape, dtype=np.uint8)
+
+        diff = cv2.absdiff(frame, cv2.convertScaleAbs(self._background))
+        cv2.accumulateWeighted(frame, self._background, self.alpha)
+        _, fg_mask = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+        return fg_mask
+
+
+BACKENDS = {
+    'mog2': MOG2Backend,
+    'knn': KNNBackend,
+    'frame_diff': FrameDiffBackend,
+}
+
+
+def create_backend(name='mog2', **options):
+    """名前（'mog2'、'knn'、'frame_diff'）と設定からバックエンドを作る"""
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown motion backend: {name}') from None
+    return backend_class(**options)
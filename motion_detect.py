@@ -1,11 +1,22 @@
 import cv2
+import numpy as np
 import time
 import os
+import queue
+import threading
 from datetime import datetime
-from google.cloud import storage
 from pathlib import Path
 from dotenv import load_dotenv
 
+from clip_writer import StreamingClipWriter
+from frame_buffer import FrameRingBuffer
+from motion_backends import create_backend
+from motion_pipeline import BoundedSlots, WorkerPool
+from motion_track import MotionTrack
+from preview_server import PreviewServer
+from src.utils.telemetry import SIDECAR_SUFFIX, clip_id_from_path, get_telemetry
+from upload_queue import GCSUploadBackend, UploadQueue
+
 # Load environment variables from .env.local
 load_dotenv('.env.local')
 import dotenv
@@ -13,177 +24,614 @@ import dotenv
 dotenv.load_dotenv()
 
 class MotionDetector:
-    def __init__(self, url, buffer_seconds=5, motion_threshold=1000, min_area=500):
+    """
+    IPカメラの映像から動体を検知し、クリップを保存・アップロードするクラス
+
+    処理は以下のステージに分かれており、キャプチャが他の処理で止まることはない。
+
+    - キャプチャスレッド: フレームをリングバッファへ読み込み、検知結果に応じて
+      イベントの開始・終了を判定する
+    - 検知ワーカー（detect_pool）: backend で選んだ方式（'mog2'、'knn'、
+      'frame_diff'。motion_backends.py 参照）による動体検知。処理中に届いた
+      フレームは最新の 1 枚だけを保持し、古いものは捨てる。detect_width を
+      指定すると縮小したグレースケール画像で検知し（min_area も縮小率に合わせる）、
+      roi_polygons（元解像度の座標による多角形のリスト）を指定するとその内側だけを
+      検知対象にする。detect_every で N フレームに 1 回だけ検知する
+    - クリップライター（StreamingClipWriter）: 動体検知の開始時にプリロールを
+      引き渡して録画を始め、以降のフレームを到着順にエンコードする。
+      segment_seconds を指定するとその長さごとにファイルを分割する。
+      同時に動くライターの数は clip_slots（複数カメラで共有する場合は外から渡す）で
+      制限し、枠が空いていない・プリロールを渡せない場合はその動体イベントを破棄して
+      dropped_clips と clips_dropped メトリクスに数える
+    - アップロードキュー（upload_queue）: 書き終えたクリップ（セグメント）を
+      ディスクに永続化したキューへ積み、GCS へアップロードする。失敗したものは
+      指数バックオフで再試行し、プロセスを再起動しても再開する
+
+    動体イベントごとに、検知した動体の矩形（元の解像度の座標）とその和を
+    サイドカーの JSON（motion_<日時>_boxes.json、motion_track.py 参照）に書き、
+    クリップの隣にアップロードする。録画中はクールダウン期間でも矩形を記録するために
+    検知を続ける（イベントの開始・終了の判定には使わない）。
+
+    detect_url にカメラのサブストリーム（低解像度）を指定すると、検知は専用の
+    スレッドでサブストリームに対して行い、メインストリーム（url）は録画と
+    プリロールにだけ使う（検知の結果や min_area・roi_polygons はメインストリームの
+    座標で扱う）。さらに main_preroll=False にすると、録画していない間は
+    メインストリームを grab() で読み進めるだけにして BGR への変換とリングバッファへの
+    コピーを省く（プリロールはなくなり、クリップは検知した時点から始まる）。
+
+    各ステージの処理時間・キューの長さ・転送量は telemetry に記録する
+    （クリップに関するものにはクリップ ID を付ける。src/utils/telemetry.py 参照）。
+    """
+
+    def __init__(self, url, buffer_seconds=5, motion_threshold=1000, min_area=500,
+                 detect_pool=None, clip_slots=None, upload_queue=None, max_pending_clips=1,
+                 detect_width=None, roi_polygons=None, detect_every=1,
+                 camera_id=None, storage_client=None,
+                 reconnect_initial_delay=0.5, reconnect_max_delay=30.0,
+                 segment_seconds=None, detect_url=None, main_preroll=True,
+                 backend='mog2', backend_options=None):
         self.url = url
+        self.camera_id = camera_id
         self.capture = cv2.VideoCapture(url)
+        # 検知用のサブストリーム（指定しなければメインストリームで検知する）
+        self.detect_url = detect_url
+        self.detect_capture = cv2.VideoCapture(detect_url) if detect_url else None
+        # 録画していない間もメインストリームをリングバッファへ読み込むか
+        # （サブストリームで検知する場合だけ False にできる）
+        self.main_preroll = main_preroll or detect_url is None
         self.buffer_seconds = buffer_seconds
         self.motion_threshold = motion_threshold
         self.min_area = min_area
-        
+
         # 動画保存用の設定
         self.frame_width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.frame_height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.fps = int(self.capture.get(cv2.CAP_PROP_FPS))
+        # ストリームによっては FPS が取得できない（0 になる）ため 30 とみなす
+        self.fps = int(self.capture.get(cv2.CAP_PROP_FPS)) or 30
         self.fourcc = cv2.VideoWriter_fourcc(*'avc1')
-        
+
         # 動体検知用の設定
-        self.bg_subtractor = cv2.createBackgroundSubtractorMOG2(
-            history=500, varThreshold=16, detectShadows=False)
-        
-        # フレームバッファ
-        self.frame_buffer = []
+        self.backend = create_backend(backend, **(backend_options or {}))
+        self.detect_width = detect_width
+        self.roi_polygons = roi_polygons
+        self.detect_every = max(1, int(detect_every))
+        self._roi_cache = None  # (検知画像のサイズ, マスク, 外接矩形)
+        self._frame_index = 0
+
+        # フレームバッファ（事前確保したアリーナを使うリングバッファ）
+        # 書き出し中のプリロールの数だけ予備のアリーナを持つ
+        frame_shape = None
+        if self.frame_width > 0 and self.frame_height > 0:
+            frame_shape = (self.frame_height, self.frame_width, 3)
+        self.frame_buffer = FrameRingBuffer(
+            self.fps * self.buffer_seconds, frame_shape,
+            max_arenas=1 + max_pending_clips)
         self.is_recording = False
+        self.segment_seconds = segment_seconds
+        self._writer = None
         self.motion_detected = False
         self.last_motion_time = None
         self.cooldown_period = 10  # 10秒のクールダウン期間
         self.last_detection_time = 0  # 最後に動体を検知した時刻
-        
-        # GCS設定
-        self.storage_client = storage.Client()
+
+        # ワーカープール（複数カメラで共有する場合は外から渡す）
+        self._owns_detect_pool = detect_pool is None
+        self.detect_pool = detect_pool or WorkerPool('detect', workers=1, max_pending=1)
+        # 同時に動くクリップライターの数（録画中の 1 つと、書き出し中のもの）
+        self.clip_slots = clip_slots or BoundedSlots('clip', 1 + max_pending_clips)
+        self.dropped_clips = 0
+
+        # 検知ワーカーとの受け渡し
+        self._detect_lock = threading.Lock()
+        self._detect_busy = False
+        self._detect_pending = None  # 検知中に届いた最新フレーム
+        self._detection_results = queue.SimpleQueue()
+        self.current_motion = False
+        self.dropped_detections = 0
+        self.dropped_frames = 0
+
+        # 計測（カメラごとにラベルを付ける）
+        self.telemetry = get_telemetry()
+        self.labels = {'camera': camera_id or 'default'}
+        self._clip_id = None
+        self._record_span = None
+        self._track = None
+        self._track_path = None
+        self._latest_boxes = []
+
+        # 終了処理中のクリップライター
+        self._finished_writers = []
+
+        # キャプチャスレッド
+        self._stop_event = threading.Event()
+        self._capture_thread = None
+        self._detect_capture_thread = None
+        self._latest_frame = None
+
+        # 再接続（指数バックオフ）
+        self.reconnect_initial_delay = reconnect_initial_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self._read_failures = 0
+
+        # GCS設定（複数カメラで共有する場合は外から渡す）
+        self.storage_client = storage_client
         self.bucket_name = 'my_video_bucket-1'  # GCSバケット名を設定してください
-        
+        self.blob_prefix = 'motion_clips/' + (f'{camera_id}/' if camera_id else '')
+        self._owns_upload_queue = upload_queue is None
+        if upload_queue is None:
+            upload_queue = UploadQueue(
+                Path('motion_clips') / '.upload_queue',
+                GCSUploadBackend(self.bucket_name, storage_client))
+        self.upload_queue = upload_queue.start()
+
         # 出力ディレクトリの作成
         self.output_dir = Path('motion_clips')
-        self.output_dir.mkdir(exist_ok=True)
+        if camera_id:
+            self.output_dir = self.output_dir / camera_id
+        self.output_dir.mkdir(parents=True, exist_ok=True)
 
-    def upload_to_gcs(self, local_path):
-        try:
-            bucket = self.storage_client.bucket(self.bucket_name)
-            blob_name = f'motion_clips/{os.path.basename(local_path)}'
-            blob = bucket.blob(blob_name)
-            blob.upload_from_filename(local_path)
-            print(f'Successfully uploaded {local_path} to GCS')
-            return True
-        except Exception as e:
-            print(f'Error uploading to GCS: {e}')
+    def log(self, message):
+        if self.camera_id:
+            message = f'[{self.camera_id}] {message}'
+        print(message)
+
+    def _upload_segment(self, path):
+        """クリップライターのスレッドから呼ばれる: アップロードキューへ積む"""
+        self.upload_queue.enqueue(path, f'{self.blob_prefix}{os.path.basename(path)}')
+
+    def _drop_clip(self, reason):
+        self.dropped_clips += 1
+        self.telemetry.counter('clips_dropped', reason=reason, **self.labels)
+
+    def _start_recording(self, detected_at=None):
+        """
+        プリロールを引き渡して録画を開始する（キャプチャスレッドから呼ぶ）
+
+        クリップライターの枠が空いていない、またはプリロールを渡せない
+        （前のクリップのプリロールを書き出し中）場合は録画せずに False を返す。
+        """
+        if not self.clip_slots.try_acquire():
+            self._drop_clip('writer_busy')
+            self.log('Warning: エンコード中のクリップが多いため、今回のクリップを破棄しました')
             return False
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        preroll = None
+        if self.main_preroll and len(self.frame_buffer) > 0:
+            preroll = self.frame_buffer.detach()
+            if preroll is None:
+                # 予備のアリーナがすべて書き出し中
+                self.clip_slots.release()
+                self._drop_clip('preroll_busy')
+                self.log('Warning: 前のクリップのプリロールを書き出し中のため、今回のクリップを破棄しました')
+                return False
+        # キューにはリングバッファ上のビューを積むので、書き出し待ちのフレームが
+        # 上書きされないようリングバッファの容量より短くする
+        # （プリロールを書き出している間のライブフレームもここで吸収する）
+        max_queue = max(1, self.frame_buffer.capacity - 2)
+        path_prefix = self.output_dir / f'motion_{timestamp}'
+        # カメラ側とクラウド側で同じ ID になるよう、アップロード先のパスから作る
+        self._clip_id = clip_id_from_path(path_prefix)
+        self.telemetry.event('motion_detected', clip_id=self._clip_id, **self.labels)
+        preroll_frames = len(preroll) if preroll is not None else 0
+        self._record_span = self.telemetry.span(
+            'clip_record', clip_id=self._clip_id, preroll_frames=preroll_frames, **self.labels)
+        self._track = MotionTrack(
+            self._clip_id, (self.frame_width, self.frame_height), detected_at or time.time(),
+            preroll_seconds=preroll_frames / self.fps)
+        self._track_path = self.output_dir / f'motion_{timestamp}{SIDECAR_SUFFIX}'
+        self._writer = StreamingClipWriter(
+            path_prefix, self.fourcc, self.fps,
+            segment_seconds=self.segment_seconds, max_queue=max_queue,
+            on_segment=self._upload_segment, log=self.log,
+            clip_id=self._clip_id, labels=self.labels, on_close=self.clip_slots.release,
+        ).start(preroll)
+        self.is_recording = True
+        return True
 
-    def save_buffer(self):
-        if not self.frame_buffer:
+    def _stop_recording(self):
+        """録画を終了する。残りのフレームの書き出しとアップロードはライターが行う"""
+        if self._writer is None:
             return
+        if self._record_span is not None:
+            self._record_span.end(dropped_frames=self._writer.dropped_frames)
+            self._record_span = None
+        # 動体の矩形は最後のセグメントより先にアップロードを予約する
+        # （クラウド側でクリップを分析するときに参照できるように）
+        if self._track is not None:
+            try:
+                self._upload_segment(self._track.write(self._track_path))
+            except OSError as e:
+                self.log(f'Warning: 動体領域を保存できませんでした: {e}')
+            self._track = None
+        self._writer.close()
+        self._finished_writers = [w for w in self._finished_writers if w.is_alive()]
+        self._finished_writers.append(self._writer)
+        self._writer = None
+        self.is_recording = False
 
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        output_path = str(self.output_dir / f'motion_{timestamp}.mp4')
-        
-        try:
-            out = cv2.VideoWriter(
-                output_path, self.fourcc, self.fps,
-                (self.frame_width, self.frame_height)
-            )
-            
-            if not out.isOpened():
-                print(f'Error: VideoWriterを開けませんでした: {output_path}')
-                return
-            
-            for frame in self.frame_buffer:
-                if frame is not None:
-                    out.write(frame)
-            
-            out.release()
-            
-            # 保存された動画ファイルが正しく作成されたか確認
-            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-                print(f'動画クリップを保存しました: {output_path}')
-            else:
-                print(f'Error: 動画ファイルの保存に失敗した可能性があります: {output_path}')
-        except Exception as e:
-            print(f'動画保存中にエラーが発生しました: {e}')
-            if 'out' in locals():
-                out.release()
-        print(f'Saved video clip: {output_path}')
-        
-        # GCSにアップロード
-        self.upload_to_gcs(output_path)
+    def _roi_mask(self, size, scale):
+        """検知画像のサイズに合わせた ROI マスクとその外接矩形を返す（キャッシュする）"""
+        if self._roi_cache is not None and self._roi_cache[0] == size:
+            return self._roi_cache[1], self._roi_cache[2]
+
+        width, height = size
+        mask = np.zeros((height, width), dtype=np.uint8)
+        polygons = [
+            np.round(np.asarray(polygon, dtype=np.float32) * scale).astype(np.int32)
+            for polygon in self.roi_polygons
+        ]
+        cv2.fillPoly(mask, polygons, 255)
+        x, y, w, h = cv2.boundingRect(mask)
+        rect = (x, y, max(w, 1), max(h, 1))
+        mask = mask[rect[1]:rect[1] + rect[3], rect[0]:rect[0] + rect[2]]
+        self._roi_cache = (size, mask, rect)
+        return mask, rect
+
+    def _prepare_detection_frame(self, frame):
+        """検知用の画像と縮小率を返す（縮小する場合はグレースケールにする）"""
+        if self.detect_width is None:
+            return frame, 1.0
+
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.detect_width / width)
+        if scale < 1.0:
+            size = (int(round(width * scale)), int(round(height * scale)))
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame, scale
 
     def detect_motion(self, frame):
-        # 背景差分を取得
-        fg_mask = self.bg_subtractor.apply(frame)
-        
-        # ノイズ除去
-        fg_mask = cv2.erode(fg_mask, None, iterations=2)
-        fg_mask = cv2.dilate(fg_mask, None, iterations=2)
-        
-        # 輪郭を検出
-        contours, _ = cv2.findContours(
-            fg_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        motion_detected = False
-        for contour in contours:
-            if cv2.contourArea(contour) > self.min_area:
-                motion_detected = True
-                break
-        
-        return motion_detected
+        return bool(self.find_motion_boxes(frame))
 
-    def run(self):
-        if not self.capture.isOpened():
-            print(f'Error: カメラストリームを開けませんでした。URL: {self.url}')
+    def find_motion_boxes(self, frame):
+        """動体の矩形 (x, y, w, h) のリストを返す（元の解像度の座標。動体がなければ空）"""
+        return self.find_motion(frame)[1]
+
+    def find_motion(self, frame):
+        """
+        (スコア, 動体の矩形のリスト) を返す
+
+        スコアは検知範囲のうち前景になった画素の割合。矩形は面積が min_area を
+        超える輪郭の外接矩形で、元の解像度の座標。サブストリームのフレームを
+        渡した場合もメインストリームの座標に換算する。
+        """
+        # メインストリームに対するこのフレームの縮小率
+        source_scale = 1.0
+        if self.frame_width > 0 and frame.shape[1] != self.frame_width:
+            source_scale = frame.shape[1] / self.frame_width
+        frame, scale = self._prepare_detection_frame(frame)
+        scale *= source_scale
+        min_area = self.min_area * scale * scale
+
+        # ROI の外接矩形だけを切り出して検知する
+        roi_mask = None
+        offset_x = offset_y = 0
+        if self.roi_polygons:
+            roi_mask, (x, y, w, h) = self._roi_mask(
+                (frame.shape[1], frame.shape[0]), scale)
+            frame = frame[y:y + h, x:x + w]
+            offset_x, offset_y = x, y
+
+        score, boxes = self.backend.detect(frame, min_area, roi_mask)
+        return score, [
+            (int((x + offset_x) / scale), int((y + offset_y) / scale),
+             int(np.ceil(w / scale)), int(np.ceil(h / scale)))
+            for x, y, w, h in boxes
+        ]
+
+    def _offer_detection(self, frame, timestamp):
+        """
+        フレームを検知ワーカーへ渡す（キャプチャスレッドから呼ぶ）
+
+        カメラごとに同時に検知するのは 1 フレームまでで、処理中に届いたフレームは
+        最新のものだけを保持する（背景モデルの更新順を保つため）。
+        渡すのはリングバッファ上のビューだが、検知はリングが一周するより十分早く
+        終わるため上書きされることはない。
+        """
+        with self._detect_lock:
+            if self._detect_busy:
+                if self._detect_pending is not None:
+                    self.dropped_detections += 1
+                self._detect_pending = (frame, timestamp)
+                return
+            self._detect_busy = True
+        if not self.detect_pool.try_submit(self._detection_task, frame, timestamp):
+            with self._detect_lock:
+                self._detect_busy = False
+            self.dropped_detections += 1
+
+    def _detection_task(self, frame, timestamp):
+        """detect_pool 上で実行: 1 フレームを検知し、保留中のフレームがあれば再投入する"""
+        try:
+            started = time.perf_counter()
+            score, boxes = self.find_motion(frame)
+            self.telemetry.observe(
+                'motion_detect_frame_seconds', time.perf_counter() - started, **self.labels)
+            self._detection_results.put((timestamp, score, boxes))
+        finally:
+            with self._detect_lock:
+                pending, self._detect_pending = self._detect_pending, None
+                if pending is None:
+                    self._detect_busy = False
+        if pending is not None and not self.detect_pool.try_submit(self._detection_task, *pending):
+            with self._detect_lock:
+                self._detect_busy = False
+            self.dropped_detections += 1
+
+    def _on_detection(self, timestamp, score, boxes):
+        """検知結果を反映する（キャプチャスレッドから呼ぶ）"""
+        self._latest_boxes = boxes
+        if self._track is not None:
+            self._track.add(timestamp, boxes, score)
+        # クールダウン期間中の結果は使わない
+        motion = bool(boxes)
+        if (timestamp - self.last_detection_time) < self.cooldown_period:
+            motion = False
+        self.current_motion = motion
+        if motion:
+            self.last_motion_time = timestamp
+            if not self.motion_detected:
+                self.log('動体を検知しました')
+                self.motion_detected = True
+                self.last_detection_time = timestamp  # 検知時刻を更新
+                if self._start_recording(timestamp):
+                    self._track.add(timestamp, boxes, score)
+                self.log(f'次の検知可能まで {self.cooldown_period} 秒待機します')
+
+    def _reconnect_delay(self, failures):
+        return min(self.reconnect_max_delay,
+                   self.reconnect_initial_delay * 2 ** (failures - 1))
+
+    def _reconnect(self):
+        """フレーム取得に失敗したとき、指数バックオフで待ってからストリームを開き直す"""
+        self._read_failures += 1
+        delay = self._reconnect_delay(self._read_failures)
+        self.log(f'フレームの取得に失敗しました。{delay:.1f} 秒後に再接続します...')
+        if self._stop_event.wait(delay):
             return
+        self.capture.release()
+        self.capture = cv2.VideoCapture(self.url)
+        if self.capture.isOpened():
+            self.log('ストリームに再接続しました')
 
-        print('ストリーム接続成功。動体検知を開始します...')
+    def _report_metrics(self):
+        """キューの長さや破棄したフレーム数をゲージとして記録する"""
+        self.telemetry.gauge('detect_pool_pending', self.detect_pool.qsize(), **self.labels)
+        self.telemetry.gauge('dropped_detections', self.dropped_detections, **self.labels)
+        self.telemetry.gauge('dropped_frames', self.dropped_frames, **self.labels)
+        self.telemetry.gauge(
+            'clip_writer_queue', self._writer._queue.qsize() if self._writer else 0,
+            **self.labels)
+        self.telemetry.gauge('dropped_clips', self.dropped_clips, **self.labels)
+        self.telemetry.gauge('clip_writers_active', self.clip_slots.in_use)
 
-        while True:
+    def _should_detect(self, now):
+        """クールダウン期間中は検知しない（録画中は動体の矩形を記録するために検知する）"""
+        in_cooldown = (now - self.last_detection_time) < self.cooldown_period
+        return not in_cooldown or self._track is not None
+
+    def _read_main(self):
+        """
+        メインストリームから 1 フレーム読み、(成功したか, リングバッファ上のフレーム) を返す
+
+        プリロールが不要で録画もしていない間は grab() だけで読み進め、フレームは
+        返さない（プレビュー用に 1 秒に 1 回だけ retrieve() する）。
+        """
+        if not self.main_preroll and self._writer is None:
+            if not self.capture.grab():
+                return False, None
+            if self._frame_index % self.fps == 0:
+                ret, frame = self.capture.retrieve()
+                if ret:
+                    self._latest_frame = frame
+            return True, None
+
+        # リングバッファの次のスロットへ直接読み込む
+        slot = self.frame_buffer.next_slot()
+        if slot is not None:
+            ret, frame = self.capture.read(image=slot)
+        else:
             ret, frame = self.capture.read()
-            
+        if not ret:
+            return False, None
+
+        # フレームバッファの管理（満杯なら最も古いスロットを上書き）
+        frame = self.frame_buffer.commit(frame)
+        if (self.frame_width, self.frame_height) != (frame.shape[1], frame.shape[0]):
+            self.frame_height, self.frame_width = frame.shape[:2]
+        self._latest_frame = frame
+        return True, frame
+
+    def _detect_capture_loop(self):
+        """サブストリームを読み、検知ワーカーへ渡す（detect_url を指定した場合のスレッド）"""
+        failures = 0
+        detect_index = 0
+        while not self._stop_event.is_set():
+            started = time.perf_counter()
+            ret, frame = self.detect_capture.read()
+            self.telemetry.observe(
+                'detect_capture_read_seconds', time.perf_counter() - started, **self.labels)
             if not ret:
-                print('フレームの取得に失敗しました。再試行します...')
-                time.sleep(1)
+                failures += 1
+                delay = self._reconnect_delay(failures)
+                self.log(f'検知用ストリームのフレームの取得に失敗しました。{delay:.1f} 秒後に再接続します...')
+                if self._stop_event.wait(delay):
+                    return
+                self.detect_capture.release()
+                self.detect_capture = cv2.VideoCapture(self.detect_url)
                 continue
+            failures = 0
 
-            # クールダウン期間中かチェック
+            current_time = time.time()
+            detect_index += 1
+            if self._should_detect(current_time) and detect_index % self.detect_every == 0:
+                self._offer_detection(frame, current_time)
+
+    def _capture_loop(self):
+        while not self._stop_event.is_set():
+            started = time.perf_counter()
+            ret, frame = self._read_main()
+            self.telemetry.observe(
+                'capture_read_seconds', time.perf_counter() - started, **self.labels)
+
+            if not ret:
+                self._reconnect()
+                continue
+            self._read_failures = 0
+
+            # 録画中は到着したフレームをそのままライターへ渡す
+            if self._writer is not None and frame is not None and not self._writer.write(frame):
+                self.dropped_frames += 1
+
+            # 動体検知（detect_every フレームごと。サブストリームで検知する場合は別スレッド）
             current_time = time.time()
             in_cooldown = (current_time - self.last_detection_time) < self.cooldown_period
-            
-            # 動体検知（クールダウン期間中は検知しない）
-            if not in_cooldown:
-                current_motion = self.detect_motion(frame)
-            else:
-                current_motion = False
-            
-            # フレームバッファの管理
-            self.frame_buffer.append(frame)
-            if len(self.frame_buffer) > self.fps * self.buffer_seconds:
-                self.frame_buffer.pop(0)
-            
+            self._frame_index += 1
+            if self._frame_index % self.fps == 0:
+                self._report_metrics()
+            if (self.detect_capture is None and self._should_detect(current_time)
+                    and self._frame_index % self.detect_every == 0):
+                self._offer_detection(frame, current_time)
+            if in_cooldown:
+                self.current_motion = False
+
+            # 検知ワーカーからの結果を反映
+            while True:
+                try:
+                    timestamp, score, boxes = self._detection_results.get_nowait()
+                except queue.Empty:
+                    break
+                self._on_detection(timestamp, score, boxes)
+
             # 動体検知状態の管理
-            if current_motion:
-                self.last_motion_time = time.time()
-                if not self.motion_detected:
-                    print('動体を検知しました')
-                    self.motion_detected = True
-                    self.last_detection_time = current_time  # 検知時刻を更新
-                    print(f'次の検知可能まで {self.cooldown_period} 秒待機します')
-            elif self.motion_detected:
+            if self.motion_detected and not self.current_motion:
                 if time.time() - self.last_motion_time > self.buffer_seconds:
-                    print('動体検知が終了しました')
-                    self.save_buffer()
+                    self.log('動体検知が終了しました')
+                    self._stop_recording()
                     self.motion_detected = False
-                    self.frame_buffer.clear()
-            
-            # 動体検知範囲を表示（デバッグ用）
-            cv2.putText(frame, 
-                       f'Motion: {"Detected" if current_motion else "None"}',
-                       (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-            
+
+    def start(self):
+        """キャプチャスレッドを開始する"""
+        self._stop_event.clear()
+        self._capture_thread = threading.Thread(
+            target=self._capture_loop, name=f'capture-{self.camera_id or 0}', daemon=True)
+        self._capture_thread.start()
+        if self.detect_capture is not None:
+            self._detect_capture_thread = threading.Thread(
+                target=self._detect_capture_loop, name=f'detect-capture-{self.camera_id or 0}',
+                daemon=True)
+            self._detect_capture_thread.start()
+
+    def stop(self):
+        """キャプチャを停止し、録画中・アップロード待ちのクリップを処理し終えるまで待つ"""
+        self._stop_event.set()
+        if self._capture_thread is not None:
+            self._capture_thread.join()
+            self._capture_thread = None
+        if self._detect_capture_thread is not None:
+            self._detect_capture_thread.join()
+            self._detect_capture_thread = None
+        self._stop_recording()
+        for writer in self._finished_writers:
+            writer.join()
+        self._finished_writers = []
+        if self._owns_detect_pool:
+            self.detect_pool.shutdown()
+        if self._owns_upload_queue:
+            # すぐに送れるものは送ってから止める（残りは次回起動時に再開される）
+            self.upload_queue.join(timeout=30)
+            self.upload_queue.stop()
+        self.capture.release()
+        if self.detect_capture is not None:
+            self.detect_capture.release()
+
+    def annotated_frame(self):
+        """最新のフレームに検知状態を描画したコピーを返す（まだフレームがなければ None）"""
+        frame = self._latest_frame
+        if frame is None:
+            return None
+
+        # 動体検知範囲を表示（デバッグ用）
+        # バッファ上のフレームに描画しないようコピーに描画する
+        frame = frame.copy()
+        for x, y, w, h in self._latest_boxes:
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 2)
+        cv2.putText(frame,
+                   f'Motion: {"Detected" if self.current_motion else "None"}',
+                   (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+        return frame
+
+    def _display_loop(self):
+        while self._capture_thread.is_alive():
+            frame = self.annotated_frame()
+            if frame is None:
+                time.sleep(0.01)
+                continue
+
             try:
                 cv2.imshow('Motion Detection', frame)
             except cv2.error as e:
-                print(f'表示エラー: {e}')
+                self.log(f'表示エラー: {e}')
                 break
-            
+
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
 
-        self.capture.release()
-        cv2.destroyAllWindows()
+    def _wait_headless(self):
+        try:
+            while self._capture_thread.is_alive():
+                self._capture_thread.join(timeout=1)
+        except KeyboardInterrupt:
+            self.log('停止します...')
+
+    def run(self, headless=False, preview_port=None):
+        """
+        動体検知を開始し、停止するまでブロックする
+
+        Args:
+            headless: True の場合はウィンドウ表示（imshow/waitKey）を行わない。
+                ディスプレイのないサーバーではこちらを使う
+            preview_port: 指定した場合、検知状態を描画したプレビューを
+                このポートから MJPEG で配信する
+        """
+        if not self.capture.isOpened():
+            self.log(f'Error: カメラストリームを開けませんでした。URL: {self.url}')
+            return
+
+        self.log('ストリーム接続成功。動体検知を開始します...')
+        self.start()
+
+        preview = None
+        try:
+            # ポートを使えずにプレビューの起動に失敗した場合も、開始したスレッドは finally で止める
+            if preview_port:
+                preview = PreviewServer(self.annotated_frame, port=preview_port).start()
+            if headless:
+                self._wait_headless()
+            else:
+                self._display_loop()
+        finally:
+            if preview is not None:
+                preview.stop()
+            self.stop()
+            if not headless:
+                cv2.destroyAllWindows()
 
 # メイン処理
 if __name__ == '__main__':
     url = os.getenv('NEXT_PUBLIC_IP_CAMERA_URL')  # Get URL from environment variable
     if not url:
         raise ValueError('NEXT_PUBLIC_IP_CAMERA_URL environment variable is not set')
-    detector = MotionDetector(url)
-    detector.run()
-
-capture.release()
-cv2.destroyAllWindows()
+    # ディスプレイのないサーバーでは MOTION_HEADLESS=1 を設定する
+    headless = os.getenv('MOTION_HEADLESS', '').lower() in ('1', 'true', 'yes')
+    preview_port = int(os.getenv('MOTION_PREVIEW_PORT', '0')) or None
+    # カメラのサブストリームで検知する場合は MOTION_DETECT_URL を設定する
+    # （MOTION_MAIN_PREROLL=0 で録画していない間のメインストリームの変換を省く）
+    detect_url = os.getenv('MOTION_DETECT_URL') or None
+    main_preroll = os.getenv('MOTION_MAIN_PREROLL', '1').lower() not in ('0', 'false', 'no')
+    # 検知の方式（mog2 / knn / frame_diff）
+    backend = os.getenv('MOTION_BACKEND', 'mog2')
+    detector = MotionDetector(url, detect_url=detect_url, main_preroll=main_preroll,
+                              backend=backend)
+    detector.run(headless=headless, preview_port=preview_port)
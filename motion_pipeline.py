@@ -0,0 +1,126 @@
+import queue
+import threading
+import traceback
+
+_STOP = object()
+
+
+class WorkerPool:
+    """
+    固定数のワーカースレッドと有界キューを持つプール
+
+    キューが満杯のときは try_submit() が即座に False を返すため、
+    呼び出し側（キャプチャスレッドなど）がブロックされることはない。
+    どのタスクを捨てるかは呼び出し側のドロップポリシーで決める。
+    """
+
+    def __init__(self, name, workers=1, max_pending=8):
+        if workers <= 0:
+            raise ValueError('workers must be positive')
+        self.name = name
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'{name}-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        self._started = False
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def try_submit(self, fn, *args, **kwargs):
+        """タスクを投入する。キューが満杯なら投入せずに False を返す"""
+        self.start()
+        try:
+            self._queue.put_nowait((fn, args, kwargs))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def submit(self, fn, *args, timeout=None, **kwargs):
+        """タスクを投入する。キューが満杯なら空くまで待つ（timeout 経過で False）"""
+        self.start()
+        try:
+            self._queue.put((fn, args, kwargs), timeout=timeout)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                fn, args, kwargs = item
+                fn(*args, **kwargs)
+            except Exception:
+                print(f'[{self.name}] タスク実行中にエラーが発生しました')
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def shutdown(self, wait=True):
+        """投入済みのタスクを処理し終えてからワーカーを停止する"""
+        if not self._started:
+            return
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class BoundedSlots:
+    """
+    同時に実行する処理の数の上限（複数カメラで共有できる）
+
+    クリップライターのように処理ごとに専用スレッドを持つものの数を抑える。
+    try_acquire() は空きがなければ待たずに False を返すので、呼び出し側
+    （キャプチャスレッドなど）がブロックされることはない。
+    """
+
+    def __init__(self, name, limit):
+        if limit <= 0:
+            raise ValueError('limit must be positive')
+        self.name = name
+        self.limit = limit
+        self._semaphore = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self.dropped = 0
+
+    @property
+    def in_use(self):
+        with self._lock:
+            return self._in_use
+
+    def try_acquire(self):
+        """空きがあれば 1 つ確保して True、なければ False を返す"""
+        if not self._semaphore.acquire(blocking=False):
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self._in_use += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self._in_use -= 1
+        self._semaphore.release()
@@ -0,0 +1,153 @@
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import storage
+
+from motion_detect import MotionDetector
+from motion_pipeline import BoundedSlots, WorkerPool
+from upload_queue import GCSUploadBackend, UploadQueue
+from preview_server import PreviewServer
+
+# カメラ設定で MotionDetector にそのまま渡せる項目
+DETECTOR_OPTIONS = (
+    'buffer_seconds', 'min_area', 'max_pending_clips',
+    'detect_width', 'roi_polygons', 'detect_every',
+    'reconnect_initial_delay', 'reconnect_max_delay', 'segment_seconds',
+    'detect_url', 'main_preroll', 'backend', 'backend_options',
+)
+
+
+def load_camera_config(path):
+    """
+    カメラ設定ファイル（JSON）を読み込む
+
+    形式:
+        {
+            "workers": {"detect": 4, "clip": 4, "upload": 2},
+            "bucket": "my_video_bucket-1",
+            "defaults": {"detect_width": 320, "detect_every": 2},
+            "cameras": [
+                {"id": "gate", "url": "rtsp://...", "min_area": 300},
+                {"id": "yard", "url": "http://.../video.mjpg", "preview_port": 8091},
+                {"id": "dock", "url": "rtsp://.../main", "detect_url": "rtsp://.../sub",
+                 "main_preroll": false},
+                {"id": "fence", "url": "rtsp://...", "backend": "frame_diff",
+                 "backend_options": {"alpha": 0.05, "threshold": 25}}
+            ]
+        }
+
+    "defaults" の項目は各カメラの設定で上書きできる。"workers" の "clip" は全カメラで
+    同時に動かすクリップライター（エンコード）の数の上限（既定はカメラ数 + 2）。"backend" は動体検知の方式
+    （"mog2"（既定）、"knn"、"frame_diff"。motion_backends.py 参照）。
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+
+    cameras = config.get('cameras') or []
+    if not cameras:
+        raise ValueError(f'No cameras configured in {path}')
+    seen = set()
+    for camera in cameras:
+        if not camera.get('id') or not camera.get('url'):
+            raise ValueError(f'Each camera needs "id" and "url": {camera}')
+        if camera['id'] in seen:
+            raise ValueError(f'Duplicate camera id: {camera["id"]}')
+        seen.add(camera['id'])
+    return config
+
+
+class MotionSupervisor:
+    """
+    複数カメラの MotionDetector をまとめて動かすクラス
+
+    キャプチャはカメラごとのスレッドで行い、動体検知とクリップの
+    アップロードは全カメラで共有するサイズ上限付きのワーカープールと
+    アップロードキューで処理する。同時に動くクリップライターの数も全カメラで
+    共有する枠（clip_slots）で制限する。GCS クライアントも全カメラで共有する。
+    画面表示は行わず（ヘッドレス）、カメラ設定に "preview_port" があれば
+    そのポートからプレビューを配信する。
+    """
+
+    def __init__(self, config, storage_client=None):
+        self.config = config
+        workers = config.get('workers', {})
+        cameras = config['cameras']
+
+        # 各カメラが同時に検知待ちにできるのは 1 フレームまでなので、
+        # 検知キューの長さはカメラ数あれば足りる
+        self.detect_pool = WorkerPool(
+            'detect', workers=workers.get('detect', os.cpu_count() or 1),
+            max_pending=len(cameras))
+        # クリップのエンコードは録画中ずっと続くので、全カメラで同時に動かす数を制限する
+        # （枠が空いていなければそのカメラの動体イベントは破棄される）
+        self.clip_slots = BoundedSlots('clip', workers.get('clip', len(cameras) + 2))
+        self.storage_client = storage_client or storage.Client()
+        self.upload_queue = UploadQueue(
+            config.get('upload_spool_dir', 'motion_clips/.upload_queue'),
+            GCSUploadBackend(config.get('bucket', 'my_video_bucket-1'), self.storage_client),
+            workers=workers.get('upload', 2))
+        self.detectors = []
+        self.previews = []
+        self._stop_event = threading.Event()
+
+    def _create_detector(self, camera):
+        options = dict(self.config.get('defaults', {}))
+        options.update(camera)
+        kwargs = {key: options[key] for key in DETECTOR_OPTIONS if key in options}
+        return MotionDetector(
+            camera['url'],
+            camera_id=camera['id'],
+            storage_client=self.storage_client,
+            detect_pool=self.detect_pool,
+            clip_slots=self.clip_slots,
+            upload_queue=self.upload_queue,
+            **kwargs,
+        )
+
+    def start(self):
+        # VideoCapture の接続はカメラによって数秒かかるため並列に行う
+        cameras = self.config['cameras']
+        with ThreadPoolExecutor(max_workers=len(cameras)) as executor:
+            self.detectors = list(executor.map(self._create_detector, cameras))
+
+        for detector in self.detectors:
+            if not detector.capture.isOpened():
+                detector.log(f'Warning: カメラストリームを開けませんでした。再接続を試みます: {detector.url}')
+            detector.start()
+
+        for camera, detector in zip(cameras, self.detectors):
+            if camera.get('preview_port'):
+                self.previews.append(
+                    PreviewServer(detector.annotated_frame, port=camera['preview_port']).start())
+        print(f'{len(self.detectors)} 台のカメラで動体検知を開始しました')
+
+    def stop(self):
+        self._stop_event.set()
+        for preview in self.previews:
+            preview.stop()
+        for detector in self.detectors:
+            detector.stop()
+        self.detect_pool.shutdown()
+        # 未完了のアップロードはディスクに残り、次回起動時に再開される
+        self.upload_queue.stop()
+
+    def run(self):
+        try:
+            # プレビューのポートを使えないなどで起動に失敗した場合も、開始したカメラは止める
+            self.start()
+            while not self._stop_event.wait(1):
+                pass
+        except KeyboardInterrupt:
+            print('停止します...')
+        finally:
+            self.stop()
+
+
+# メイン処理
+if __name__ == '__main__':
+    config_path = sys.argv[1] if len(sys.argv) > 1 else os.getenv('MOTION_CAMERAS_CONFIG', 'cameras.json')
+    supervisor = MotionSupervisor(load_camera_config(config_path))
+    supervisor.run()
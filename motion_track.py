@@ -0,0 +1,86 @@
+import json
+import os
+import uuid
+
+# フレームに対する面積の割合がこれ以上の矩形は region に含めない
+# （照明の変化や背景モデルの初期化でフレーム全体が動体になった検知）
+FULL_FRAME_RATIO = 0.9
+
+
+def union_boxes(boxes):
+    """矩形 (x, y, w, h) のリストをすべて含む矩形を返す（空なら None）"""
+    boxes = list(boxes)
+    if not boxes:
+        return None
+    left = min(x for x, _, _, _ in boxes)
+    top = min(y for _, y, _, _ in boxes)
+    right = max(x + w for x, _, w, _ in boxes)
+    bottom = max(y + h for _, y, _, h in boxes)
+    return [left, top, right - left, bottom - top]
+
+
+class MotionTrack:
+    """
+    1 回の動体イベントで検知した動体の矩形を記録する
+
+    add() で検知結果ごとの矩形（元の解像度の座標）を追加し、イベントの終了時に
+    write() でサイドカーの JSON に書き出す。
+
+        {
+            "clip_id": "gate/motion_20240101_120000",
+            "frame_size": [1920, 1080],
+            "start": 1704078000.0,          # 動体を検知した時刻（UNIX 時間）
+            "preroll_seconds": 5.0,         # クリップの先頭から start までの長さ
+            "region": [x, y, w, h],         # イベント全体の矩形の和
+            "frames": [{"t": 0.0, "score": 0.012, "boxes": [[x, y, w, h], ...]}, ...]
+        }
+
+    frames の t は start からの経過秒数、score は前景の画素の割合。region にはフレームのほぼ全体を覆う矩形は
+    含めない（それしかない場合を除く）。
+    """
+
+    def __init__(self, clip_id, frame_size, start, preroll_seconds=0.0):
+        self.clip_id = clip_id
+        self.frame_size = list(frame_size)
+        self.start = start
+        self.preroll_seconds = preroll_seconds
+        self.frames = []
+
+    def add(self, timestamp, boxes, score=None):
+        if not boxes:
+            return
+        frame = {
+            't': round(timestamp - self.start, 3),
+            'boxes': [[int(value) for value in box] for box in boxes],
+        }
+        if score is not None:
+            frame['score'] = round(float(score), 4)
+        self.frames.append(frame)
+
+    def region(self):
+        boxes = [box for frame in self.frames for box in frame['boxes']]
+        frame_area = self.frame_size[0] * self.frame_size[1]
+        if frame_area > 0:
+            local = [box for box in boxes if box[2] * box[3] < frame_area * FULL_FRAME_RATIO]
+            if local:
+                boxes = local
+        return union_boxes(boxes)
+
+    def to_dict(self):
+        return {
+            'clip_id': self.clip_id,
+            'frame_size': self.frame_size,
+            'start': self.start,
+            'preroll_seconds': self.preroll_seconds,
+            'region': self.region(),
+            'frames': self.frames,
+        }
+
+    def write(self, path):
+        """サイドカーを書き出す（途中まで書かれたファイルが見えないよう一時ファイル経由）"""
+        path = str(path)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(temp_path, path)
+        return path
@@ -0,0 +1,89 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+
+from frame_broadcaster import JpegFanout
+
+
+class PreviewServer:
+    """
+    ディスプレイのないホスト向けのプレビュー配信サーバー（MJPEG over HTTP）
+
+    frame_source() が返すフレームを fps 間隔で JPEG に変換し、接続中の
+    全クライアントへ同じバイト列を配信する。クライアントがいない間は
+    エンコードしない。遅いクライアントには最新のフレームだけを送るため、
+    他のクライアントや検知処理が待たされることはない。
+    """
+
+    def __init__(self, frame_source, host='0.0.0.0', port=8090, fps=5, quality=70):
+        self.frame_source = frame_source
+        self.fps = fps
+        self.quality = quality
+        self.fanout = JpegFanout()
+        self._stop_event = threading.Event()
+        self._encoder_thread = None
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._server_thread = None
+
+    def _handler_class(self):
+        preview = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/preview'):
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                preview._serve(self.wfile)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _serve(self, wfile):
+        frames = self.fanout.subscribe()
+        try:
+            for jpeg in frames:
+                wfile.write(b'--frame\r\n'
+                            b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            frames.close()
+
+    def _encode_loop(self):
+        interval = 1.0 / self.fps
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        # クライアントがいない間はエンコードしない
+        while self.fanout.wait_for_subscribers():
+            started = time.monotonic()
+            frame = self.frame_source()
+            if frame is not None:
+                ok, buffer = cv2.imencode('.jpg', frame, params)
+                if ok:
+                    self.fanout.publish(buffer.tobytes())
+            self._stop_event.wait(max(0.0, interval - (time.monotonic() - started)))
+
+    def start(self):
+        self._encoder_thread = threading.Thread(
+            target=self._encode_loop, name='preview-encoder', daemon=True)
+        self._encoder_thread.start()
+        self._server_thread = threading.Thread(
+            target=self._server.serve_forever, name='preview-server', daemon=True)
+        self._server_thread.start()
+        host, port = self._server.server_address[:2]
+        print(f'プレビューを配信しています: http://{host}:{port}/preview')
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self.fanout.close()
+        self._server.shutdown()
+        self._server.server_close()
@@ -73,8 +73,8 @@ export async function POST(request: NextRequest) {
         throw new Error(audioResult.error);
       }
 
-      // Convert base64 audio content back to Buffer
-      const audioContent = Buffer.from(audioResult.data, 'base64');
+      // The worker returns binary results as a raw Buffer
+      const audioContent = audioResult.data as Buffer;
       console.log('Audio generated, size:', audioContent.length);
       
       // Return both analysis results and audio content
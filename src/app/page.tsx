@@ -1,8 +1,8 @@
 "use client";
 
-import { useEffect, useState } from 'react';
+import { useEffect, useRef, useState } from 'react';
 import { initializeApp, getApps } from 'firebase/app';
-import { getDatabase, ref, onValue, Database } from 'firebase/database';
+import { getDatabase, ref, onValue, get, Database } from 'firebase/database';
 import ReactMarkdown from 'react-markdown';
 import { ElevenLabsClient } from '../utils/elevenlabs';
 
@@ -12,6 +12,15 @@ interface AnalysisData {
   informative_message: string;
 }
 
+// gemini_latest/<カメラID> の要約（本文は path の先にある）
+interface LatestSummary {
+  clip_id: string;
+  recorded_at: string;
+  analyzed_at: number;
+  informative_message: string;
+  path: string;
+}
+
 // Firebaseの設定
 const firebaseConfig = {
   apiKey: process.env.NEXT_PUBLIC_FIREBASE_API_KEY,
@@ -46,6 +55,8 @@ export default function Home() {
   const [audioUrl, setAudioUrl] = useState<string>('');
   const [isConnected, setIsConnected] = useState<boolean>(false);
   const [elevenLabs] = useState(() => new ElevenLabsClient(process.env.NEXT_PUBLIC_ELEVENLABS_API_KEY || ''));
+  // 表示中の結果のパス（同じ結果で音声を繰り返さないため）
+  const shownPath = useRef<string | null>(null);
 
   // Firebaseの接続状態を監視
   useEffect(() => {
@@ -99,61 +110,73 @@ export default function Home() {
     }
 
     console.log('📝 分析データの監視を開始...');
-    const geminiOutputsRef = ref(database, 'gemini_outputs');
-    console.log('監視パス:', geminiOutputsRef.toString());
+    // カメラごとの最新の要約だけを監視し、最も新しい結果の本文を path から読む
+    // （過去の結果は gemini_index/<日付> を orderByKey() で範囲指定して読む）
+    const latestRef = ref(database, 'gemini_latest');
+    console.log('監視パス:', latestRef.toString());
 
     try {
-      unsubscribe = onValue(geminiOutputsRef, (snapshot) => {
+      unsubscribe = onValue(latestRef, (snapshot) => {
         console.log('📥 データ更新を検出しました');
-        const data = snapshot.val();
-        console.log('受信したデータ:', data);
-
-        if (data) {
-          // 最新のデータを取得
-          const motionFolders = Object.keys(data);
-          if (motionFolders.length > 0) {
-            const latestMotion = motionFolders[motionFolders.length - 1];
-            const motionData = data[latestMotion];
-
-            if (motionData) {
-              console.log('✅ 新しい分析データ:', {
-                timestamp: new Date().toISOString(),
-                folder: latestMotion,
-                environment: motionData["environment"],
-                safety: motionData["safety"],
-                informative_message: motionData["informative_message"]
-              });
-
-              const newData = {
-                environment: motionData["environment"],
-                safety: motionData["safety"],
-                informative_message: motionData["informative_message"]
-              };
-              setAnalysisData(newData);
-
-              // Generate speech for the new informative message
-              if (newData.informative_message) {
-                elevenLabs.generateSpeech(newData.informative_message)
-                  .then(audioData => {
-                    const blob = new Blob([audioData], { type: 'audio/mpeg' });
-                    const url = URL.createObjectURL(blob);
-                    setAudioUrl(url);
-                    const audio = new Audio(url);
-                    audio.play();
-                  })
-                  .catch(error => {
-                    console.error('❌ 音声生成エラー:', error);
-                  });
-              }
-            } else {
-              console.log('⚠️ JSONデータが見つかりません:', latestMotion);
-            }
-          } else {
-            console.log('⚠️ motionフォルダが見つかりません');
-          }
-        } else {
+        const summaries = snapshot.val() as Record<string, LatestSummary> | null;
+
+        if (!summaries) {
           console.log('⚠️ データが空または存在しません');
+          return;
         }
+
+        // 最後に分析されたカメラの結果を表示する
+        const latest = Object.values(summaries).reduce<LatestSummary | null>(
+          (newest, summary) => (!newest || summary.analyzed_at > newest.analyzed_at ? summary : newest),
+          null
+        );
+        if (!latest || latest.path === shownPath.current) {
+          return;
+        }
+        shownPath.current = latest.path;
+
+        get(ref(database, latest.path))
+          .then((resultSnapshot) => {
+            const motionData = resultSnapshot.val();
+            if (!motionData) {
+              console.log('⚠️ JSONデータが見つかりません:', latest.path);
+              return;
+            }
+
+            console.log('✅ 新しい分析データ:', {
+              timestamp: new Date().toISOString(),
+              clip_id: latest.clip_id,
+              recorded_at: latest.recorded_at,
+              environment: motionData["environment"],
+              safety: motionData["safety"],
+              informative_message: motionData["informative_message"]
+            });
+
+            const newData = {
+              environment: motionData["environment"],
+              safety: motionData["safety"],
+              informative_message: motionData["informative_message"]
+            };
+            setAnalysisData(newData);
+
+            // Generate speech for the new informative message
+            if (newData.informative_message) {
+              elevenLabs.generateSpeech(newData.informative_message)
+                .then(audioData => {
+                  const blob = new Blob([audioData], { type: 'audio/mpeg' });
+                  const url = URL.createObjectURL(blob);
+                  setAudioUrl(url);
+                  const audio = new Audio(url);
+                  audio.play();
+                })
+                .catch(error => {
+                  console.error('❌ 音声生成エラー:', error);
+                });
+            }
+          })
+          .catch((error) => {
+            console.error('❌ 分析データの取得エラー:', error);
+          });
       }, (error) => {
         console.error('❌ データ監視エラー:', error);
       });
@@ -0,0 +1,340 @@
+"""
+Gemini の分析結果をローカルに保存するキャッシュ
+
+同じ画像・動画を同じプロンプトで分析した結果を再利用し、モデルの呼び出しを省く。
+キーは「名前空間（分析の種類）・プロンプトのバージョン・内容の SHA-256」から作る。
+プロンプトを変えたときはバージョンを上げれば古い結果は使われなくなる。
+
+perceptual=True にすると、画像の dHash（64 ビットの知覚ハッシュ）を一緒に保存し、
+完全一致しなくてもハミング距離が max_distance 以下の画像の結果を再利用する。
+同じ場面で繰り返し検知されたカメラ画像のような、ほぼ同一のフレームが対象。
+
+保存先は SQLite（SQLiteCacheStore）またはディレクトリ（DiskCacheStore）。
+ttl 秒を過ぎた結果は使わず、max_entries を超えたら最後に使われたのが古い順に消す。
+
+環境変数 ANALYSIS_CACHE にパスを設定すると from_env() がキャッシュを作る
+（拡張子が .sqlite / .sqlite3 / .db なら SQLite、それ以外はディレクトリ）。
+    ANALYSIS_CACHE_TTL: 有効期間（秒、省略時は無期限）
+    ANALYSIS_CACHE_MAX_ENTRIES: 最大件数（省略時は 1000）
+    ANALYSIS_CACHE_PERCEPTUAL: 1 なら知覚ハッシュで近い画像にも一致させる
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+_INT64_MAX = (1 << 63) - 1
+_UINT64_MASK = (1 << 64) - 1
+
+
+def content_hash(content: Union[bytes, str]) -> str:
+    """内容の SHA-256（文字列の場合は gs:// の URI などをそのままハッシュする）"""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def dhash(image_data: bytes, hash_size: int = 8) -> Optional[int]:
+    """
+    画像の dHash を返す（デコードできない場合は None）
+
+    縮小したグレースケール画像で隣り合う画素の明暗を比べたビット列なので、
+    JPEG の再圧縮やわずかなノイズではほとんど変わらない。
+    """
+    import cv2
+    import numpy as np
+
+    image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None
+    small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class SQLiteCacheStore:
+    """SQLite に結果を保存するストア（複数プロセスから同じファイルを使ってよい）"""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS analysis_cache ('
+                ' key TEXT PRIMARY KEY,'
+                ' scope TEXT NOT NULL,'
+                ' phash INTEGER,'
+                ' value TEXT NOT NULL,'
+                ' created REAL NOT NULL,'
+                ' accessed REAL NOT NULL)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS analysis_cache_scope ON analysis_cache (scope, phash)')
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS analysis_cache_accessed ON analysis_cache (accessed)')
+
+    def get(self, key: str, min_created: float) -> Optional[str]:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT value FROM analysis_cache WHERE key = ? AND created >= ?',
+                (key, min_created)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                'UPDATE analysis_cache SET accessed = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def find_similar(self, scope: str, phash: int, max_distance: int,
+                     min_created: float) -> Optional[str]:
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                'SELECT key, phash, value FROM analysis_cache'
+                ' WHERE scope = ? AND phash IS NOT NULL AND created >= ?',
+                (scope, min_created)).fetchall()
+            best = None
+            for key, other, value in rows:
+                distance = hamming_distance(phash, other & _UINT64_MASK)
+                if distance <= max_distance and (best is None or distance < best[0]):
+                    best = (distance, key, value)
+            if best is None:
+                return None
+            self._conn.execute(
+                'UPDATE analysis_cache SET accessed = ? WHERE key = ?', (time.time(), best[1]))
+            return best[2]
+
+    def set(self, key: str, scope: str, value: str, phash: Optional[int] = None):
+        now = time.time()
+        # SQLite の INTEGER は符号付き 64 ビットなので、上位ビットが立つ値は負数で保存する
+        if phash is not None and phash > _INT64_MAX:
+            phash -= 1 << 64
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO analysis_cache'
+                ' (key, scope, phash, value, created, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, scope, phash, value, now, now))
+
+    def evict(self, min_created: float, max_entries: Optional[int]):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM analysis_cache WHERE created < ?', (min_created,))
+            if max_entries is not None:
+                self._conn.execute(
+                    'DELETE FROM analysis_cache WHERE key NOT IN ('
+                    ' SELECT key FROM analysis_cache ORDER BY accessed DESC LIMIT ?)',
+                    (max_entries,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class DiskCacheStore:
+    """
+    ディレクトリに 1 件 1 ファイルの JSON として結果を保存するストア
+
+    最後に使った時刻はファイルの更新時刻で管理する。
+    find_similar() はすべてのファイルを読んで比べるので、件数（max_entries）に
+    比例して遅くなる。知覚ハッシュを使う場合や件数が多い場合は SQLiteCacheStore を使うこと。
+    """
+
+    def __init__(self, root_dir: Union[str, Path]):
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.root_dir / f'{key}.json'
+
+    @staticmethod
+    def _load(path: Path) -> Optional[dict]:
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _touch(path: Path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def get(self, key: str, min_created: float) -> Optional[str]:
+        path = self._path(key)
+        entry = self._load(path)
+        if entry is None or entry['created'] < min_created:
+            return None
+        self._touch(path)
+        return entry['value']
+
+    def find_similar(self, scope: str, phash: int, max_distance: int,
+                     min_created: float) -> Optional[str]:
+        best = None
+        for path in self.root_dir.glob('*.json'):
+            entry = self._load(path)
+            if (entry is None or entry.get('scope') != scope or entry.get('phash') is None
+                    or entry['created'] < min_created):
+                continue
+            distance = hamming_distance(phash, entry['phash'])
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, path, entry['value'])
+        if best is None:
+            return None
+        self._touch(best[1])
+        return best[2]
+
+    def set(self, key: str, scope: str, value: str, phash: Optional[int] = None):
+        path = self._path(key)
+        entry = {'scope': scope, 'phash': phash, 'value': value, 'created': time.time()}
+        # 書きかけのファイルを読まないよう、一時ファイル経由で置き換える
+        temp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+    def evict(self, min_created: float, max_entries: Optional[int]):
+        entries = []
+        for path in self.root_dir.glob('*.json'):
+            entry = self._load(path)
+            if entry is None or entry['created'] < min_created:
+                path.unlink(missing_ok=True)
+                continue
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                pass
+        if max_entries is not None and len(entries) > max_entries:
+            entries.sort(reverse=True)
+            for _, path in entries[max_entries:]:
+                path.unlink(missing_ok=True)
+
+    def close(self):
+        pass
+
+
+class AnalysisCache:
+    """分析結果のキャッシュ（get_or_compute() で分析関数の前に挟む）"""
+
+    def __init__(self, store, ttl: Optional[float] = None, max_entries: Optional[int] = 1000,
+                 perceptual: bool = False, max_distance: int = 4, evict_every: int = 50):
+        self.store = store
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.perceptual = perceptual
+        self.max_distance = max_distance
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+    @classmethod
+    def from_env(cls) -> Optional['AnalysisCache']:
+        """環境変数 ANALYSIS_CACHE からキャッシュを作る（未設定なら None）"""
+        path = os.getenv('ANALYSIS_CACHE')
+        if not path:
+            return None
+        if path.lower().endswith(SQLITE_SUFFIXES):
+            store = SQLiteCacheStore(path)
+        else:
+            store = DiskCacheStore(path)
+        ttl = os.getenv('ANALYSIS_CACHE_TTL')
+        return cls(
+            store,
+            ttl=float(ttl) if ttl else None,
+            max_entries=int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', '1000')),
+            perceptual=os.getenv('ANALYSIS_CACHE_PERCEPTUAL') == '1',
+        )
+
+    def _min_created(self) -> float:
+        return time.time() - self.ttl if self.ttl else 0.0
+
+    def _use_perceptual(self, content, perceptual: Optional[bool]) -> bool:
+        enabled = self.perceptual if perceptual is None else perceptual
+        return enabled and isinstance(content, bytes)
+
+    @staticmethod
+    def _key(content: Union[bytes, str], scope: str) -> str:
+        return content_hash(f'{scope}:{content_hash(content)}')
+
+    def _lookup(self, key: str, scope: str, content: Union[bytes, str],
+                perceptual: Optional[bool]):
+        """
+        (結果, 知覚ハッシュ) を返す
+
+        知覚ハッシュは完全一致しなかった場合にだけ計算する（計算しなかった、または
+        デコードできなかった場合は None）。put() し直すときにそのまま使える。
+        """
+        min_created = self._min_created()
+        value = self.store.get(key, min_created)
+        phash = None
+        if value is None and self._use_perceptual(content, perceptual):
+            phash = dhash(content)
+            if phash is not None:
+                value = self.store.find_similar(scope, phash, self.max_distance, min_created)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value, phash
+
+    def _store(self, key: str, scope: str, value: str, phash: Optional[int]):
+        self.store.set(key, scope, value, phash)
+        # 1 回だけ呼ばれて終わるプロセスでも消されるよう、最初の書き込みでも実行する
+        if self._writes % self.evict_every == 0:
+            self.store.evict(self._min_created(), self.max_entries)
+        self._writes += 1
+
+    def get(self, content: Union[bytes, str], namespace: str, version: str,
+            perceptual: Optional[bool] = None) -> Optional[str]:
+        """キャッシュされた結果を返す（なければ None）"""
+        scope = f'{namespace}:{version}'
+        return self._lookup(self._key(content, scope), scope, content, perceptual)[0]
+
+    def put(self, content: Union[bytes, str], value: str, namespace: str, version: str,
+            perceptual: Optional[bool] = None):
+        """結果を保存する（evict_every 件ごとに期限切れ・超過分を消す）"""
+        scope = f'{namespace}:{version}'
+        phash = dhash(content) if self._use_perceptual(content, perceptual) else None
+        self._store(self._key(content, scope), scope, value, phash)
+
+    def get_or_compute(self, content: Union[bytes, str], compute: Callable[[], str],
+                       namespace: str, version: str, perceptual: Optional[bool] = None) -> str:
+        """
+        キャッシュにあればその結果を、なければ compute() の結果を保存して返す
+
+        Args:
+            content: 分析対象の画像・動画のバイト列（または gs:// の URI）
+            compute: キャッシュにない場合に呼ぶ分析関数（文字列を返す）
+            namespace: 分析の種類（"image:structured" など）
+            version: プロンプトのバージョン
+            perceptual: 知覚ハッシュで近い画像にも一致させるか（省略時はコンストラクタの指定）
+        """
+        scope = f'{namespace}:{version}'
+        key = self._key(content, scope)
+        # キーと知覚ハッシュ（画像のデコード）は検索と保存で 1 回ずつだけ計算する
+        value, phash = self._lookup(key, scope, content, perceptual)
+        if value is None:
+            value = compute()
+            self._store(key, scope, value, phash)
+        return value
+
+    def evict(self):
+        self.store.evict(self._min_created(), self.max_entries)
+
+    def close(self):
+        self.store.close()
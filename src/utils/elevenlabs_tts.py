@@ -1,55 +1,229 @@
-import requests
+import hashlib
+import json
 import os
-from typing import Dict, Optional
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from .telemetry import get_telemetry
+except ImportError:
+    from telemetry import get_telemetry
+
+
+class TTSCache:
+    """
+    合成した音声をディスクに保存するキャッシュ
+
+    キーはテキスト・音声ID・モデル・音声設定から作る。合計サイズが max_bytes を
+    超えたら、最後に使われたのが古いファイルから消す。
+    """
+
+    def __init__(self, cache_dir, max_bytes: int = 100 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str, voice_id: str, model_id: str, voice_settings: Dict) -> str:
+        payload = json.dumps([text, voice_id, model_id, voice_settings],
+                             ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.mp3'
+
+    def get(self, key: str) -> Optional[Path]:
+        """キャッシュされたファイルのパスを返す（なければ None）"""
+        path = self.path(key)
+        try:
+            # 最後に使った時刻を更新する（削除する順番に使う）
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def temp_path(self, key: str) -> Path:
+        """書き込み途中のファイルのパス（commit() で置き換えるまで get() からは見えない）"""
+        return self.cache_dir / f'.{key}.{uuid.uuid4().hex}.tmp'
+
+    def commit(self, key: str, temp_path: Path) -> Path:
+        path = self.path(key)
+        os.replace(temp_path, path)
+        self.evict()
+        return path
+
+    def put(self, key: str, data: bytes) -> Path:
+        temp_path = self.temp_path(key)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        return self.commit(key, temp_path)
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for path in self.cache_dir.glob('*.mp3'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+
 
 class ElevenLabsClient:
     """ElevenLabs APIクライアント"""
-    
-    def __init__(self, api_key: Optional[str] = None):
+
+    def __init__(self, api_key: Optional[str] = None, model_id: str = "eleven_multilingual_v2",
+                 voice_settings: Optional[Dict] = None, cache_dir: Optional[str] = None,
+                 cache_max_bytes: int = 100 * 1024 * 1024):
+        """
+        Args:
+            cache_dir: 合成した音声のキャッシュ先。省略時は環境変数 ELEVENLABS_CACHE_DIR、
+                それも未設定なら一時ディレクトリ配下を使う。空文字ならキャッシュしない
+            cache_max_bytes: キャッシュの合計サイズの上限
+        """
         self.api_key = api_key or os.getenv('ELEVENLABS_API_KEY')
         if not self.api_key:
             raise ValueError("ElevenLabs API key is required")
-        
+
         self.base_url = "https://api.elevenlabs.io/v1"
         self.headers = {
             "Accept": "audio/mpeg",
             "Content-Type": "application/json",
             "xi-api-key": self.api_key
         }
-        
+        self.model_id = model_id
+
         # デフォルトの音声設定
-        self.voice_settings = {
+        self.voice_settings = voice_settings or {
             "stability": 0.5,
             "similarity_boost": 0.8,
             "style": 0.3
         }
-    
+
+        # 接続を使い回す（呼び出しごとに TLS のハンドシェイクをしない）
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+        if cache_dir is None:
+            cache_dir = os.getenv('ELEVENLABS_CACHE_DIR') or os.path.join(
+                tempfile.gettempdir(), 'elevenlabs_tts_cache')
+        self.cache = TTSCache(cache_dir, cache_max_bytes) if cache_dir else None
+
+    def _request_body(self, text: str) -> Dict:
+        return {
+            "model_id": self.model_id,
+            "text": text,
+            "voice_settings": self.voice_settings
+        }
+
+    def cache_key(self, text: str, voice_id: str) -> str:
+        return TTSCache.key(text, voice_id, self.model_id, self.voice_settings)
+
     def generate_speech(self, text: str, voice_id: str = "iP95p4xoKVk53GoZ742B") -> bytes:
         """
         テキストを音声に変換
-        
+
         Args:
             text: 音声化するテキスト
             voice_id: 使用する音声のID（デフォルトは「Rachel」）
-        
+
         Returns:
             音声データ（バイナリ）
         """
-        url = f"{self.base_url}/text-to-speech/{voice_id}"
-        
-        data = {
-            "model_id": "eleven_multilingual_v2",
-            "text": text,
-            "voice_settings": self.voice_settings
-        }
-        
-        response = requests.post(url, headers=self.headers, json=data)
-        
-        if response.status_code == 200:
-            return response.content
-        else:
+        key = self.cache_key(text, voice_id)
+        with get_telemetry().span('tts_synthesize', chars=len(text)) as span:
+            if self.cache is not None:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    data = cached.read_bytes()
+                    span.set(cached=True, bytes=len(data))
+                    return data
+
+            url = f"{self.base_url}/text-to-speech/{voice_id}"
+            response = self.session.post(url, json=self._request_body(text))
+
+            if response.status_code == 200:
+                span.set(cached=False, bytes=len(response.content))
+                if self.cache is not None:
+                    self.cache.put(key, response.content)
+                return response.content
+            else:
+                raise Exception(f"Error generating speech: {response.status_code} - {response.text}")
+
+    def stream_speech(self, text: str, voice_id: str = "iP95p4xoKVk53GoZ742B",
+                      chunk_size: int = 4096) -> Iterator[bytes]:
+        """
+        テキストを音声に変換し、届いた順に MP3 のチャンクを返すジェネレーター
+
+        合成が終わるのを待たずに再生を始められる。キャッシュにあればファイルから返し、
+        なければ最後まで受信できたときにキャッシュへ保存する。
+
+        最初のチャンクが届くまでの時間を tts_first_chunk_seconds として記録する。
+        """
+        key = self.cache_key(text, voice_id)
+        telemetry = get_telemetry()
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                telemetry.counter('tts_cache_hits')
+                with open(cached, 'rb') as f:
+                    while True:
+                        chunk = f.read(chunk_size)
+                        if not chunk:
+                            return
+                        yield chunk
+
+        span = telemetry.span('tts_stream', chars=len(text))
+        started = time.perf_counter()
+        url = f"{self.base_url}/text-to-speech/{voice_id}/stream"
+        response = self.session.post(url, json=self._request_body(text), stream=True)
+        if response.status_code != 200:
+            span.end(status='error', http_status=response.status_code)
             raise Exception(f"Error generating speech: {response.status_code} - {response.text}")
 
+        temp_path = self.cache.temp_path(key) if self.cache is not None else None
+        cache_file = open(temp_path, 'wb') if temp_path is not None else None
+        completed = False
+        received = 0
+        try:
+            with response:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        if received == 0:
+                            telemetry.observe('tts_first_chunk_seconds', time.perf_counter() - started)
+                        received += len(chunk)
+                        if cache_file is not None:
+                            cache_file.write(chunk)
+                        yield chunk
+            completed = True
+        finally:
+            span.end(status='ok' if completed else 'error', bytes=received)
+            if cache_file is not None:
+                cache_file.close()
+                # 途中で切断された場合は不完全なファイルをキャッシュに残さない
+                if completed:
+                    self.cache.commit(key, temp_path)
+                else:
+                    temp_path.unlink(missing_ok=True)
+
+
 if __name__ == '__main__':
     # テスト用コード
     client = ElevenLabsClient()
@@ -6,16 +6,112 @@ from dotenv import load_dotenv
 env_path = Path(__file__).resolve().parent.parent.parent / '.env.local'
 load_dotenv(env_path)
 
-import base64
-from typing import Dict, Optional
+import asyncio
+import hashlib
+import json
+import threading
+from typing import List, Optional
 
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import GenerationConfig, GenerativeModel, Part
+
+try:
+    from .analysis_cache import AnalysisCache
+    from .telemetry import get_telemetry
+except ImportError:
+    from analysis_cache import AnalysisCache
+    from telemetry import get_telemetry
+
+# プロンプトを変更したら上げる（キャッシュされた古い結果を使わないようにするため）
+PROMPT_VERSION = "1"
+
+# 作業内容・環境の分析
+ENVIRONMENT_PROMPT = """
+        あなたは、画像から作業内容およびその周辺環境を抽出することに特化したエージェントです。
+        与えられた画像に基づき、写っている活動や作業、そしてその環境について以下の各項目に沿って、簡潔かつ明確に説明してください。
+
+        【出力形式】
+
+        作業内容： 画像内で実施されている具体的な作業や活動を記述してください。
+        場所： 画像から推測される場所や環境（屋内、屋外、特定の施設など）を記述してください。
+        広さ： 画像に映っている空間の広がりや、狭さについて記述してください。
+        天候： 屋外の場合、画像から読み取れる天候（例：晴れ、曇り、雨など）を記述してください。
+
+        """
+
+# 危険性の分析（{environment} に作業内容・環境の分析結果が入る）
+SAFETY_PROMPT = """
+        あなたは、画像から抽出された作業内容や環境情報に基づき、作業中に潜在する危険性を評価・抽出することに特化したエージェントです。
+        以下の「作業内容・環境」情報（{environment}）に基づいて、この状況下で作業を行う場合に考えられる具体的な危険を、簡潔かつ明確に説明してください。
+
+        【出力形式】
+
+        潜在危険： 画像の作業内容や環境から推測される、具体的な危険要因やリスク（例：転倒、機械的事故、感電、滑りやすい床、悪天候による視界不良など）を記述してください。
+        理由： それぞれの危険が発生する可能性の背景や理由を、簡潔に説明してください。
+
+        """
+
+# 危険性の分析（画像のみから。作業内容・環境の分析と並行して実行する）
+STANDALONE_SAFETY_PROMPT = """
+        あなたは、画像に写っている作業内容や環境から、作業中に潜在する危険性を評価・抽出することに特化したエージェントです。
+        与えられた画像に基づいて、この状況下で作業を行う場合に考えられる具体的な危険を、簡潔かつ明確に説明してください。
+
+        【出力形式】
+
+        潜在危険： 画像の作業内容や環境から推測される、具体的な危険要因やリスク（例：転倒、機械的事故、感電、滑りやすい床、悪天候による視界不良など）を記述してください。
+        理由： それぞれの危険が発生する可能性の背景や理由を、簡潔に説明してください。
+
+        """
+
+# 注意点の分析（{safety} に危険性の分析結果が入る）
+INFORMATIVE_PROMPT = """
+        あなたは、抽出された危険性情報に基づき、優しい口調でこの状況下で気をつけるべきことを一言で提案するエージェントです。
+        以下の「危険性」情報（{safety}）を踏まえて、シンプルかつ親しみやすい一言で安全対策を提案してください。
+        """
+
+# 3 項目を 1 回の呼び出しで得るためのプロンプト
+STRUCTURED_PROMPT = """
+        あなたは、作業現場の画像から作業内容・環境と潜在する危険性を分析し、安全のための一言を提案するエージェントです。
+        与えられた画像に基づき、以下の 3 項目を JSON で出力してください。
+
+        environment:
+            作業内容： 画像内で実施されている具体的な作業や活動を記述してください。
+            場所： 画像から推測される場所や環境（屋内、屋外、特定の施設など）を記述してください。
+            広さ： 画像に映っている空間の広がりや、狭さについて記述してください。
+            天候： 屋外の場合、画像から読み取れる天候（例：晴れ、曇り、雨など）を記述してください。
+        safety:
+            environment の内容に基づいて、この状況下で作業を行う場合に考えられる具体的な危険を、簡潔かつ明確に説明してください。
+            潜在危険： 具体的な危険要因やリスク（例：転倒、機械的事故、感電、滑りやすい床、悪天候による視界不良など）を記述してください。
+            理由： それぞれの危険が発生する可能性の背景や理由を、簡潔に説明してください。
+        informative_message:
+            safety の内容を踏まえて、優しい口調でシンプルかつ親しみやすい一言で安全対策を提案してください。
+        """
+
+# 複数フレームをまとめて分析するときに各プロンプトの前に付ける説明
+FRAMES_PREAMBLE = """
+        以下の画像は、同じ動画から時系列順に切り出した複数のフレームです。
+        1 枚ずつではなく、フレーム全体を通して起きていることを踏まえて回答してください。
+        """
+
+RESULT_KEYS = ("environment", "safety", "informative_message")
+
+# 構造化出力のスキーマ（OpenAPI のサブセット）
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {key: {"type": "string"} for key in RESULT_KEYS},
+    "required": list(RESULT_KEYS),
+}
 
 class GeminiAnalyzer:
     """Geminiを使用して画像分析を行うクラス"""
     
-    def __init__(self, project_id: Optional[str] = None, location: str = "us-central1"):
+    def __init__(self, project_id: Optional[str] = None, location: str = "us-central1",
+                 cache: Optional[AnalysisCache] = None):
+        """
+        Args:
+            cache: 分析結果のキャッシュ。省略時は環境変数 ANALYSIS_CACHE の設定に従う
+                （未設定ならキャッシュしない）
+        """
         self.project_id = project_id or os.getenv('GOOGLE_CLOUD_PROJECT')
         if not self.project_id:
             raise ValueError(
@@ -28,75 +124,203 @@ class GeminiAnalyzer:
         # Vertex AIの初期化
         vertexai.init(project=self.project_id, location=self.location)
         self.model = GenerativeModel("gemini-1.5-flash-002")
-    
-    def _analyze_with_prompt(self, image_data: bytes, prompt: str) -> str:
-        """指定されたプロンプトで画像分析を実行"""
-        response = self.model.generate_content(
-            [
-                prompt,
-                Part.from_data(image_data, mime_type='image/jpeg')
-            ]
+        self.structured_config = GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=RESPONSE_SCHEMA,
         )
+        self.cache = cache if cache is not None else AnalysisCache.from_env()
+    
+    @staticmethod
+    def _image_part(image_data) -> Part:
+        """画像データを Part に変換する（作成済みの Part はそのまま返す）"""
+        if isinstance(image_data, Part):
+            return image_data
+        return Part.from_data(image_data, mime_type='image/jpeg')
+    
+    def _image_parts(self, image_data) -> List[Part]:
+        """1 枚の画像または画像のリストを Part のリストに変換する"""
+        if isinstance(image_data, (list, tuple)):
+            return [self._image_part(image) for image in image_data]
+        return [self._image_part(image_data)]
+    
+    def _analyze_with_prompt(self, image_data, prompt: str, name: str = "") -> str:
+        """指定されたプロンプトで画像分析を実行（image_data は画像のリストでもよい）"""
+        image_parts = self._image_parts(image_data)
+        with get_telemetry().span('gemini_call', prompt=name, images=len(image_parts)) as span:
+            response = self.model.generate_content(
+                [
+                    prompt,
+                    *image_parts
+                ]
+            )
+            span.set(response_chars=len(response.text))
+        
+        return response.text
+    
+    async def _analyze_with_prompt_async(self, image_data, prompt: str, name: str = "") -> str:
+        """_analyze_with_prompt の非同期版"""
+        image_parts = self._image_parts(image_data)
+        with get_telemetry().span('gemini_call', prompt=name, images=len(image_parts)) as span:
+            response = await self.model.generate_content_async(
+                [
+                    prompt,
+                    *image_parts
+                ]
+            )
+            span.set(response_chars=len(response.text))
         
         return response.text
     
-    def analyze_image(self, image_data: bytes) -> str:
+    @staticmethod
+    def _to_json(environment: str, safety: str, informative_message: str) -> str:
+        result = {
+            "environment": environment.strip(),
+            "safety": safety.strip(),
+            "informative_message": informative_message.strip()
+        }
+        return json.dumps(result, ensure_ascii=False)
+    
+    def analyze_image(self, image_data: bytes, mode: str = "structured") -> str:
         """
         画像を分析し、作業内容、環境、注意点を抽出
         
         Args:
             image_data: 分析する画像のバイナリデータ
+            mode: "structured" は 3 項目を 1 回の呼び出し（JSON スキーマ指定）で取得する。
+                "chained" は従来どおり 3 回の呼び出しで、前の結果を次のプロンプトに渡す
             
         Returns:
-            JSON形式の分析結果
+            JSON形式の分析結果（キー: "environment", "safety", "informative_message"）
         """
-        import json
-
-        # 作業内容・環境の分析
-        environment_prompt = """
-        あなたは、画像から作業内容およびその周辺環境を抽出することに特化したエージェントです。
-        与えられた画像に基づき、写っている活動や作業、そしてその環境について以下の各項目に沿って、簡潔かつ明確に説明してください。
-
-        【出力形式】
-
-        作業内容： 画像内で実施されている具体的な作業や活動を記述してください。
-        場所： 画像から推測される場所や環境（屋内、屋外、特定の施設など）を記述してください。
-        広さ： 画像に映っている空間の広がりや、狭さについて記述してください。
-        天候： 屋外の場合、画像から読み取れる天候（例：晴れ、曇り、雨など）を記述してください。
-
+        if mode not in ("structured", "chained"):
+            raise ValueError(f"Unknown analysis mode: {mode}")
+        with get_telemetry().span('gemini_analyze', mode=mode, images=1) as span:
+            if self.cache is None or not isinstance(image_data, bytes):
+                return self._analyze_image(image_data, mode)
+            span.set(cached=True)
+            return self.cache.get_or_compute(
+                image_data,
+                lambda: self._analyze_image(image_data, mode, span=span),
+                namespace=f"image:{mode}",
+                version=PROMPT_VERSION,
+            )
+    
+    def analyze_images(self, images: List[bytes], mode: str = "structured") -> str:
         """
-        environment = self._analyze_with_prompt(image_data, environment_prompt)
+        同じ動画から切り出した複数のフレームを 1 回のリクエストにまとめて分析する
         
-        # 危険性の分析
-        safety_prompt = f"""
-        あなたは、画像から抽出された作業内容や環境情報に基づき、作業中に潜在する危険性を評価・抽出することに特化したエージェントです。
-        以下の「作業内容・環境」情報（{environment}）に基づいて、この状況下で作業を行う場合に考えられる具体的な危険を、簡潔かつ明確に説明してください。
-
-        【出力形式】
-
-        潜在危険： 画像の作業内容や環境から推測される、具体的な危険要因やリスク（例：転倒、機械的事故、感電、滑りやすい床、悪天候による視界不良など）を記述してください。
-        理由： それぞれの危険が発生する可能性の背景や理由を、簡潔に説明してください。
-
+        Args:
+            images: 時系列順に並べた JPEG 画像のバイナリデータのリスト
+            mode: analyze_image と同じ
+            
+        Returns:
+            JSON形式の分析結果（キーは analyze_image と同じ）
         """
-        safety = self._analyze_with_prompt(image_data, safety_prompt)
+        if mode not in ("structured", "chained"):
+            raise ValueError(f"Unknown analysis mode: {mode}")
+        if not images:
+            raise ValueError("At least one image is required")
+        images = list(images)
+        with get_telemetry().span('gemini_analyze', mode=mode, images=len(images)) as span:
+            if self.cache is None or not all(isinstance(image, bytes) for image in images):
+                return self._analyze_image(images, mode, FRAMES_PREAMBLE)
+            # フレームの並びごとにキャッシュする（各フレームのハッシュを連結したものをキーにする）
+            content = b"".join(hashlib.sha256(image).digest() for image in images)
+            span.set(cached=True)
+            return self.cache.get_or_compute(
+                content,
+                lambda: self._analyze_image(images, mode, FRAMES_PREAMBLE, span=span),
+                namespace=f"images:{mode}",
+                version=PROMPT_VERSION,
+                perceptual=False,
+            )
+    
+    def _analyze_image(self, image_data, mode: str, preamble: str = "", span=None) -> str:
+        # キャッシュを使う場合、ここに来るのはキャッシュになかったとき
+        if span is not None:
+            span.set(cached=False)
+        # Part は 1 回だけ作り、すべてのプロンプトで使い回す
+        image_parts = self._image_parts(image_data)
+        if mode == "structured":
+            result = self._analyze_structured(image_parts, preamble)
+            if result is not None:
+                return result
         
-        # 注意点の分析
-        informative_prompt = f"""
-        あなたは、抽出された危険性情報に基づき、優しい口調でこの状況下で気をつけるべきことを一言で提案するエージェントです。
-        以下の「危険性」情報（{safety}）を踏まえて、シンプルかつ親しみやすい一言で安全対策を提案してください。
+        return self._analyze_chained(image_parts, preamble)
+    
+    def _analyze_structured(self, image_parts: List[Part], preamble: str = "") -> Optional[str]:
+        """3 項目を 1 回の呼び出しで取得する（応答が不正な場合は None）"""
+        with get_telemetry().span('gemini_call', prompt='structured', images=len(image_parts)) as span:
+            response = self.model.generate_content(
+                [preamble + STRUCTURED_PROMPT, *image_parts],
+                generation_config=self.structured_config,
+            )
+            span.set(response_chars=len(response.text))
+        try:
+            data = json.loads(response.text)
+            return self._to_json(*(data[key] for key in RESULT_KEYS))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+    
+    def _analyze_chained(self, image_parts: List[Part], preamble: str = "") -> str:
+        """3 回の呼び出しで順に分析する"""
+        environment = self._analyze_with_prompt(
+            image_parts, preamble + ENVIRONMENT_PROMPT, 'environment')
+        safety = self._analyze_with_prompt(
+            image_parts, preamble + SAFETY_PROMPT.format(environment=environment), 'safety')
+        informative_message = self._analyze_with_prompt(
+            image_parts, preamble + INFORMATIVE_PROMPT.format(safety=safety), 'informative')
+        return self._to_json(environment, safety, informative_message)
+    
+    async def analyze_image_async(self, image_data: bytes) -> str:
         """
-        informative_message = self._analyze_with_prompt(image_data, informative_prompt)
+        analyze_image の非同期版
         
-        # 結果をJSON文字列として返す
-        result = {
-            "environment": environment.strip(),
-            "safety": safety.strip(),
-            "informative_message": informative_message.strip()
-        }
-        return json.dumps(result, ensure_ascii=False)
+        互いに依存しない「作業内容・環境」と「危険性」のプロンプトを並行して実行し、
+        危険性の結果から注意点を生成する（往復 2 回分の待ち時間）。
+        出力のキーは analyze_image と同じ。
+        """
+        use_cache = self.cache is not None and isinstance(image_data, bytes)
+        with get_telemetry().span('gemini_analyze', mode='async', images=1) as span:
+            if use_cache:
+                cached = self.cache.get(image_data, namespace="image:async", version=PROMPT_VERSION)
+                span.set(cached=cached is not None)
+                if cached is not None:
+                    return cached
+            
+            image_part = self._image_part(image_data)
+            environment, safety = await asyncio.gather(
+                self._analyze_with_prompt_async(image_part, ENVIRONMENT_PROMPT, 'environment'),
+                self._analyze_with_prompt_async(image_part, STANDALONE_SAFETY_PROMPT, 'safety'),
+            )
+            informative_message = await self._analyze_with_prompt_async(
+                image_part, INFORMATIVE_PROMPT.format(safety=safety), 'informative')
+            result = self._to_json(environment, safety, informative_message)
+            if use_cache:
+                self.cache.put(image_data, result, namespace="image:async", version=PROMPT_VERSION)
+            return result
+
+
+_analyzers = {}
+_analyzers_lock = threading.Lock()
+
+
+def get_analyzer(project_id: Optional[str] = None, location: str = "us-central1") -> GeminiAnalyzer:
+    """
+    プロセス内で共有する GeminiAnalyzer を返す（初回の呼び出しで作成する）
+
+    vertexai.init() とモデルの作成、接続の確立を呼び出しごとに繰り返さないよう、
+    Cloud Functions などの常駐プロセスではこちらを使う。
+    """
+    key = (project_id or os.getenv('GOOGLE_CLOUD_PROJECT'), location)
+    with _analyzers_lock:
+        analyzer = _analyzers.get(key)
+        if analyzer is None:
+            analyzer = _analyzers[key] = GeminiAnalyzer(project_id=key[0], location=location)
+        return analyzer
+
 
 if __name__ == '__main__':
-    import json
     import sys
 
     # テスト用コード
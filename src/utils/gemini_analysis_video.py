@@ -1,7 +1,7 @@
 import os
 import json
 import logging
-import tempfile
+import threading
 from pathlib import Path
 
 # プロジェクトルートの.env.localを読み込む（必要に応じて調整）
@@ -9,17 +9,43 @@ from dotenv import load_dotenv
 env_path = Path(__file__).resolve().parent.parent / '.env.local'
 load_dotenv(env_path)
 
-import base64
-from typing import Optional
+from typing import Optional, Union
 
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import GenerationConfig, GenerativeModel, Part
 from google.cloud import storage
 
+try:
+    from .analysis_cache import AnalysisCache
+    from .telemetry import clip_context, clip_id_from_path, get_telemetry
+except ImportError:
+    from analysis_cache import AnalysisCache
+    from telemetry import clip_context, clip_id_from_path, get_telemetry
+
+# プロンプトを変更したら上げる（キャッシュされた古い結果を使わないようにするため）
+PROMPT_VERSION = "1"
+
 # ロギング設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+RESULT_KEYS = ("作業内容", "危険性", "メッセージ")
+
+# 3 項目を 1 回の呼び出しで得る場合の構造化出力スキーマ
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {key: {"type": "string"} for key in RESULT_KEYS},
+    "required": list(RESULT_KEYS),
+}
+
+STRUCTURED_PROMPT = (
+    "あなたは、映像から作業内容・危険性・メッセージを抽出するエージェントです。\n"
+    "与えられた動画について、以下の 3 項目を JSON で出力してください。\n"
+    "作業内容： 実施されている具体的な作業や活動内容を簡潔かつ明確に記述してください。\n"
+    "危険性： 作業環境に潜む具体的な危険要因やリスクを簡潔かつ明確に記述してください。\n"
+    "メッセージ： 映像が伝えようとしている主なメッセージを一言で表現してください。"
+)
+
 # === GeminiAnalyzer クラス（動画解析版） ===
 class GeminiAnalyzer:
     """
@@ -27,7 +53,13 @@ class GeminiAnalyzer:
     （※元コードは画像用ですが、ここでは MIME タイプやプロンプトを調整して動画を対象としています）
     """
     
-    def __init__(self, project_id: Optional[str] = None, location: str = "us-central1"):
+    def __init__(self, project_id: Optional[str] = None, location: str = "us-central1",
+                 cache: Optional[AnalysisCache] = None):
+        """
+        Args:
+            cache: 分析結果のキャッシュ。省略時は環境変数 ANALYSIS_CACHE の設定に従う
+                （未設定ならキャッシュしない）
+        """
         self.project_id = project_id or os.getenv('GOOGLE_CLOUD_PROJECT')
         if not self.project_id:
             raise ValueError(
@@ -38,28 +70,94 @@ class GeminiAnalyzer:
         vertexai.init(project=self.project_id, location=self.location)
         # ※ここではGemini 1.5 Flash-002（安定版例）を使用していますが、必要に応じて変更してください
         self.model = GenerativeModel("gemini-1.5-flash-002")
+        self.cache = cache if cache is not None else AnalysisCache.from_env()
     
-    def _analyze_with_prompt(self, video_data: bytes, prompt: str) -> str:
+    @staticmethod
+    def _video_part(video: Union[bytes, str, Part]) -> Part:
+        """
+        動画を Part に変換する
+
+        "gs://" で始まる文字列は GCS 上のオブジェクトへの参照として渡す
+        （動画のバイト列をリクエストに含めない）。作成済みの Part はそのまま返す。
+        """
+        if isinstance(video, Part):
+            return video
+        if isinstance(video, str):
+            if not video.startswith('gs://'):
+                raise ValueError(f"GCS の URI（gs://...）を指定してください: {video}")
+            return Part.from_uri(video, mime_type='video/mp4')
+        return Part.from_data(video, mime_type='video/mp4')
+    
+    def _analyze_with_prompt(self, video: Union[bytes, str, Part], prompt: str, name: str = "") -> str:
         """指定されたプロンプトで動画解析を実行（動画の MIME は "video/mp4" とする）"""
-        response = self.model.generate_content(
-            [
-                prompt,
-                Part.from_data(video_data, mime_type='video/mp4')
-            ]
-        )
+        with get_telemetry().span('gemini_call', prompt=name) as span:
+            response = self.model.generate_content(
+                [
+                    prompt,
+                    self._video_part(video)
+                ]
+            )
+            span.set(response_chars=len(response.text))
         return response.text.strip()
     
-    def analyze_video(self, video_data: bytes) -> str:
+    def _analyze_structured(self, video_part: Part) -> Optional[dict]:
+        """3 項目を 1 回の呼び出しで取得する（応答が不正な場合は None）"""
+        with get_telemetry().span('gemini_call', prompt='structured') as span:
+            response = self.model.generate_content(
+                [STRUCTURED_PROMPT, video_part],
+                generation_config=GenerationConfig(
+                    response_mime_type="application/json",
+                    response_schema=RESPONSE_SCHEMA,
+                ),
+            )
+            span.set(response_chars=len(response.text))
+        try:
+            data = json.loads(response.text)
+            return {key: data[key].strip() for key in RESULT_KEYS}
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.warning("構造化出力を解析できなかったため、プロンプトを順に実行します。")
+            return None
+    
+    def analyze_video(self, video: Union[bytes, str], mode: str = "chained") -> str:
         """
         動画を解析し、作業内容、危険性、メッセージを抽出して JSON 文字列で返す
         
         Args:
-            video_data: 解析対象動画のバイナリデータ（動画に音声は含まれていない）
+            video: 解析対象動画のバイナリデータ、または GCS 上の URI（gs://bucket/name）
+                （動画に音声は含まれていない）
+            mode: "chained" は 3 つのプロンプトを個別に実行する。
+                "structured" は 3 項目を 1 回の呼び出し（JSON スキーマ指定）で取得する
         
         Returns:
             JSON 形式の文字列（キー: "作業内容", "危険性", "メッセージ"）
+
+        URI を渡した場合のキャッシュのキーは URI そのもの（同じ名前で上書きされた
+        オブジェクトは同じ動画とみなす）。
         """
-        import json
+        if mode not in ("chained", "structured"):
+            raise ValueError(f"Unknown analysis mode: {mode}")
+        with get_telemetry().span('gemini_analyze', mode=mode) as span:
+            if self.cache is None or isinstance(video, Part):
+                return self._analyze_video(video, mode)
+            span.set(cached=True)
+            return self.cache.get_or_compute(
+                video,
+                lambda: self._analyze_video(video, mode, span=span),
+                namespace=f"video:{mode}",
+                version=PROMPT_VERSION,
+                perceptual=False,
+            )
+    
+    def _analyze_video(self, video: Union[bytes, str, Part], mode: str, span=None) -> str:
+        # キャッシュを使う場合、ここに来るのはキャッシュになかったとき
+        if span is not None:
+            span.set(cached=False)
+        # 動画への参照は 1 つだけ作り、すべてのプロンプトで使い回す
+        video_part = self._video_part(video)
+        if mode == "structured":
+            result = self._analyze_structured(video_part)
+            if result is not None:
+                return json.dumps(result, ensure_ascii=False, indent=2)
 
         # ① 作業内容の抽出
         work_prompt = (
@@ -67,7 +165,7 @@ class GeminiAnalyzer:
             "与えられた動画から、実施されている具体的な作業や活動内容を簡潔かつ明確に記述してください。\n"
             "【出力形式】\n作業内容： ・・・"
         )
-        work_content = self._analyze_with_prompt(video_data, work_prompt)
+        work_content = self._analyze_with_prompt(video_part, work_prompt, 'environment')
         
         # ② 危険性の抽出
         danger_prompt = (
@@ -75,7 +173,7 @@ class GeminiAnalyzer:
             "与えられた動画から、作業環境に潜む具体的な危険要因やリスクを簡潔かつ明確に記述してください。\n"
             "【出力形式】\n危険性： ・・・"
         )
-        danger_content = self._analyze_with_prompt(video_data, danger_prompt)
+        danger_content = self._analyze_with_prompt(video_part, danger_prompt, 'safety')
         
         # ③ メッセージの抽出
         message_prompt = (
@@ -83,7 +181,7 @@ class GeminiAnalyzer:
             "与えられた動画から、映像が伝えようとしている主なメッセージを一言で表現してください。\n"
             "【出力形式】\nメッセージ： ・・・"
         )
-        message_content = self._analyze_with_prompt(video_data, message_prompt)
+        message_content = self._analyze_with_prompt(video_part, message_prompt, 'informative')
         
         result = {
             "作業内容": work_content,
@@ -92,6 +190,28 @@ class GeminiAnalyzer:
         }
         return json.dumps(result, ensure_ascii=False, indent=2)
 
+# === インスタンス内で使い回すクライアント ===
+# 呼び出しごとに vertexai.init() やモデル・接続を作り直さないよう、最初に必要になったときに作る
+_analyzer = None
+_storage_client = None
+_clients_lock = threading.Lock()
+
+
+def get_analyzer() -> GeminiAnalyzer:
+    global _analyzer
+    with _clients_lock:
+        if _analyzer is None:
+            _analyzer = GeminiAnalyzer()
+        return _analyzer
+
+
+def get_storage_client() -> storage.Client:
+    global _storage_client
+    with _clients_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+        return _storage_client
+
 # === Cloud Function ハンドラー ===
 def analyze_video_to_json(event, context):
     """
@@ -99,6 +219,13 @@ def analyze_video_to_json(event, context):
     動画ファイルから Gemini API を使い、作業内容・危険性・メッセージの３項目を抽出し、
     結果を JSON ファイルとして同じバケットに保存します。
     """
+    # 処理全体をクリップ ID 付きのスパンとして記録する（カメラ側の記録と突き合わせるため）
+    with clip_context(clip_id_from_path(event.get("name", ""))):
+        with get_telemetry().span('handler', function='analyze_video_to_json'):
+            _handle_event(event)
+
+
+def _handle_event(event):
     try:
         bucket_name = event["bucket"]
         file_name = event["name"]
@@ -112,31 +239,15 @@ def analyze_video_to_json(event, context):
         logger.info("対象ファイルは mp4 ではないため、処理をスキップします。")
         return
 
-    # GCS から動画ファイルを /tmp にダウンロード
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file_name)
-    temp_dir = tempfile.gettempdir()
-    local_video_path = os.path.join(temp_dir, os.path.basename(file_name))
-    try:
-        blob.download_to_filename(local_video_path)
-        logger.info(f"動画ファイルを {local_video_path} にダウンロードしました。")
-    except Exception as e:
-        logger.error(f"動画ファイルのダウンロードに失敗しました: {e}")
-        return
+    bucket = get_storage_client().bucket(bucket_name)
 
-    # 動画ファイルをバイナリデータとして読み込む
-    try:
-        with open(local_video_path, "rb") as f:
-            video_data = f.read()
-    except Exception as e:
-        logger.error(f"動画ファイルの読み込みに失敗しました: {e}")
-        return
+    # 動画はダウンロードせず、GCS 上の URI を Gemini に渡す
+    video_uri = f"gs://{bucket_name}/{file_name}"
 
     # GeminiAnalyzer を使って動画解析（動画に音声はない前提）
     try:
-        analyzer = GeminiAnalyzer()
-        analysis_result_json = analyzer.analyze_video(video_data)
+        analysis_result_json = get_analyzer().analyze_video(
+            video_uri, mode=os.getenv('GEMINI_ANALYSIS_MODE', 'chained'))
         logger.info(f"解析結果: {analysis_result_json}")
     except Exception as e:
         logger.error(f"動画解析中にエラーが発生しました: {e}")
@@ -146,10 +257,11 @@ def analyze_video_to_json(event, context):
     output_file_name = file_name.rsplit('.', 1)[0] + ".json"
     output_blob = bucket.blob(output_file_name)
     try:
-        output_blob.upload_from_string(
-            analysis_result_json,
-            content_type="application/json"
-        )
+        with get_telemetry().span('result_upload', bytes=len(analysis_result_json.encode('utf-8'))):
+            output_blob.upload_from_string(
+                analysis_result_json,
+                content_type="application/json"
+            )
         logger.info(f"JSON 結果ファイルをアップロードしました: {output_file_name}")
     except Exception as e:
         logger.error(f"JSON 結果ファイルのアップロードに失敗しました: {e}")
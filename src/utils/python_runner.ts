@@ -1,8 +1,5 @@
-import { spawn } from 'child_process';
+import { spawn, ChildProcess } from 'child_process';
 import { join } from 'path';
-import { writeFileSync, unlinkSync } from 'fs';
-import { tmpdir } from 'os';
-import { v4 as uuidv4 } from 'uuid';
 
 interface PythonResponse {
   success: boolean;
@@ -10,95 +7,301 @@ interface PythonResponse {
   error?: string;
 }
 
-export async function runPythonScript(
-  scriptPath: string,
-  functionName: string,
-  args: any[]
-): Promise<PythonResponse> {
-  const tempFiles: string[] = [];
-
-  // 大きなバイナリデータを一時ファイルに保存
-  const processedArgs = args.map((arg) => {
-    if (arg instanceof Buffer || (arg instanceof Uint8Array)) {
-      const tempPath = join(tmpdir(), `${uuidv4()}.tmp`);
-      writeFileSync(tempPath, arg);
-      tempFiles.push(tempPath);
-      return { __temp_file__: tempPath };
+interface PendingCall {
+  id: number;
+  resolve: (response: PythonResponse) => void;
+  reject: (error: Error) => void;
+  timer?: NodeJS.Timeout;
+}
+
+const HEADER_SIZE = 4;
+// これより長いヘッダーは壊れた応答とみなす（標準出力に混ざった文字列を長さと読んだ場合など）
+const MAX_HEADER_LENGTH = 64 * 1024 * 1024;
+const WORKER_SCRIPT = join(process.cwd(), 'src/utils/python_worker.py');
+// 1 回の呼び出しの上限（ミリ秒）。応答のないワーカーは終了させて起動し直す（0 で無制限）
+const CALL_TIMEOUT_MS = Number(process.env.PYTHON_CALL_TIMEOUT_MS || 120000);
+
+// JSON に含められないバイナリを {"__buffer__": i} に置き換え、本体を buffers に追加する
+function encodeArgs(value: any, buffers: Buffer[]): any {
+  if (value instanceof Buffer || value instanceof Uint8Array) {
+    buffers.push(Buffer.from(value.buffer, value.byteOffset, value.byteLength));
+    return { __buffer__: buffers.length - 1 };
+  }
+  if (Array.isArray(value)) {
+    return value.map((item) => encodeArgs(item, buffers));
+  }
+  if (value !== null && typeof value === 'object') {
+    return Object.fromEntries(
+      Object.entries(value).map(([key, item]) => [key, encodeArgs(item, buffers)])
+    );
+  }
+  return value;
+}
+
+function decodeResult(value: any, buffers: Buffer[]): any {
+  if (Array.isArray(value)) {
+    return value.map((item) => decodeResult(item, buffers));
+  }
+  if (value !== null && typeof value === 'object') {
+    const keys = Object.keys(value);
+    if (keys.length === 1 && keys[0] === '__buffer__') {
+      return buffers[value.__buffer__];
     }
-    return arg;
-  });
-
-  return new Promise((resolve, reject) => {
-    // Python実行コマンドの準備
-    const pythonProcess = spawn('python3', [
-      '-c',
-      `
-import sys
-import json
-import base64
-sys.path.append('${join(process.cwd(), 'src/utils')}')
-from ${scriptPath} import *
-
-def load_temp_file(arg):
-    if isinstance(arg, dict) and '__temp_file__' in arg:
-        with open(arg['__temp_file__'], 'rb') as f:
-            return f.read()
-    return arg
-
-try:
-    # 引数の処理
-    args = json.loads('${JSON.stringify(processedArgs)}')
-    args = [load_temp_file(arg) for arg in args]
-    
-    # 関数の実行
-    result = ${functionName}(*args)
-    
-    # バイナリデータの場合はbase64エンコード
-    if isinstance(result, bytes):
-        result = base64.b64encode(result).decode('utf-8')
-    
-    # 結果の出力
-    print(json.dumps({'success': True, 'data': result}))
-except Exception as e:
-    print(json.dumps({'success': False, 'error': str(e)}))
-      `
-    ]);
-
-    let outputData = '';
-    let errorData = '';
-
-    // 標準出力の処理
-    pythonProcess.stdout.on('data', (data) => {
-      outputData += data.toString();
+    return Object.fromEntries(
+      Object.entries(value).map(([key, item]) => [key, decodeResult(item, buffers)])
+    );
+  }
+  return value;
+}
+
+// [ヘッダー長 4 バイト][JSON ヘッダー][バイナリ...] の形式でメッセージを作る
+function encodeMessage(header: Record<string, any>, buffers: Buffer[]): Buffer {
+  const json = Buffer.from(
+    JSON.stringify({ ...header, buffers: buffers.map((buffer) => buffer.length) }),
+    'utf-8'
+  );
+  const length = Buffer.alloc(HEADER_SIZE);
+  length.writeUInt32BE(json.length);
+  return Buffer.concat([length, json, ...buffers]);
+}
+
+/**
+ * 常駐する Python ワーカー 1 プロセス（同時に処理するリクエストは 1 件）
+ */
+class PythonWorker {
+  private process: ChildProcess;
+  private received: Buffer = Buffer.alloc(0);
+  private pending: PendingCall | null = null;
+  private nextId = 0;
+  private exited = false;
+  alive = true;
+
+  constructor(private onExit: (worker: PythonWorker) => void) {
+    // スクリプトのディレクトリ（src/utils）が sys.path に入るので、モジュールはそのまま import できる
+    this.process = spawn('python3', [WORKER_SCRIPT], {
+      stdio: ['pipe', 'pipe', 'inherit'],
     });
 
-    // エラー出力の処理
-    pythonProcess.stderr.on('data', (data) => {
-      errorData += data.toString();
+    this.process.stdout!.on('data', (chunk: Buffer) => {
+      this.received = Buffer.concat([this.received, chunk]);
+      this.processReceived();
     });
 
-    // プロセス終了時の処理
-    pythonProcess.on('close', (code) => {
-      // 一時ファイルの削除
-      tempFiles.forEach((file) => {
-        try {
-          unlinkSync(file);
-        } catch (error) {
-          console.error(`Failed to delete temp file ${file}:`, error);
-        }
-      });
+    // 終了したプロセスへの書き込みのエラー（EPIPE など）は exit / error で扱う
+    this.process.stdin!.on('error', () => {});
+
+    this.process.on('exit', (code) => {
+      this.terminate(new Error(`Python worker exited with code ${code}`));
+    });
+
+    // 起動に失敗した場合（python3 がないなど）は exit が発生せず error だけが発生する
+    this.process.on('error', (error) => {
+      this.terminate(error);
+    });
+  }
+
+  // 実行中の呼び出しを失敗させ、プールから取り除く（exit と error の両方が発生しても 1 回だけ）
+  private terminate(error: Error) {
+    this.alive = false;
+    this.failPending(error);
+    if (!this.exited) {
+      this.exited = true;
+      this.onExit(this);
+    }
+  }
 
-      if (code !== 0) {
-        reject(new Error(`Python process exited with code ${code}\n${errorData}`));
+  private failPending(error: Error) {
+    const pending = this.pending;
+    this.pending = null;
+    if (pending) {
+      clearTimeout(pending.timer);
+      pending.reject(error);
+    }
+  }
+
+  // 応答を解釈できないワーカーは以降のメッセージの区切りも分からないので終了させる
+  // （exit でプールから取り除かれ、待っている呼び出しには新しいワーカーを起動する）
+  private abort(error: Error) {
+    this.failPending(error);
+    this.received = Buffer.alloc(0);
+    this.alive = false;
+    this.process.kill('SIGKILL');
+  }
+
+  private processReceived() {
+    // 受信したデータから完全なメッセージを取り出す
+    while (this.alive && this.received.length >= HEADER_SIZE) {
+      const headerLength = this.received.readUInt32BE(0);
+      if (headerLength > MAX_HEADER_LENGTH) {
+        this.abort(new Error(`Python worker sent an invalid response header length: ${headerLength}`));
         return;
       }
-
+      if (this.received.length < HEADER_SIZE + headerLength) {
+        return;
+      }
+      let header: any;
       try {
-        const result = JSON.parse(outputData);
-        resolve(result);
+        header = JSON.parse(
+          this.received.subarray(HEADER_SIZE, HEADER_SIZE + headerLength).toString('utf-8')
+        );
       } catch (error) {
-        reject(new Error(`Failed to parse Python output: ${outputData}\n${errorData}`));
+        // モジュールが標準出力に直接書いた場合など
+        this.abort(new Error(`Python worker sent an invalid response header: ${error}`));
+        return;
+      }
+      const sizes: number[] = header.buffers || [];
+      const total = HEADER_SIZE + headerLength + sizes.reduce((sum, size) => sum + size, 0);
+      if (this.received.length < total) {
+        return;
+      }
+
+      const buffers: Buffer[] = [];
+      let offset = HEADER_SIZE + headerLength;
+      for (const size of sizes) {
+        // 後続のデータと切り離すためにコピーする
+        buffers.push(Buffer.from(this.received.subarray(offset, offset + size)));
+        offset += size;
       }
+      this.received = this.received.subarray(total);
+
+      const pending = this.pending;
+      if (!pending || header.id !== pending.id) {
+        this.abort(
+          new Error(`Python worker sent a response for request ${header.id}, expected ${pending?.id}`)
+        );
+        return;
+      }
+      this.pending = null;
+      clearTimeout(pending.timer);
+      pending.resolve({
+        success: header.success,
+        data: decodeResult(header.data, buffers),
+        error: header.error,
+      });
+    }
+  }
+
+  call(moduleName: string, functionName: string, args: any[]): Promise<PythonResponse> {
+    return new Promise((resolve, reject) => {
+      if (!this.alive) {
+        reject(new Error('Python worker is not running'));
+        return;
+      }
+      const id = this.nextId++;
+      this.pending = { id, resolve, reject };
+      if (CALL_TIMEOUT_MS > 0) {
+        // 応答しないワーカーは終了させる
+        this.pending.timer = setTimeout(() => {
+          this.abort(
+            new Error(`Python worker did not respond within ${CALL_TIMEOUT_MS} ms: ${moduleName}.${functionName}`)
+          );
+        }, CALL_TIMEOUT_MS);
+      }
+      const buffers: Buffer[] = [];
+      const header = {
+        id,
+        module: moduleName,
+        function: functionName,
+        args: encodeArgs(args, buffers),
+      };
+      this.process.stdin!.write(encodeMessage(header, buffers));
     });
-  });
+  }
+
+  kill() {
+    this.alive = false;
+    this.process.kill();
+  }
+}
+
+/**
+ * Python ワーカーのプール
+ *
+ * ワーカーは最初の呼び出しで起動し、以降のリクエストで使い回す。
+ * 空いているワーカーがなければ、size 個までは新しく起動し、それ以上は空くまで待つ。
+ */
+class PythonWorkerPool {
+  private idle: PythonWorker[] = [];
+  private workers = new Set<PythonWorker>();
+  private waiting: ((worker: PythonWorker) => void)[] = [];
+
+  constructor(private size: number) {}
+
+  private acquire(): Promise<PythonWorker> {
+    const worker = this.idle.pop();
+    if (worker) {
+      return Promise.resolve(worker);
+    }
+    if (this.workers.size < this.size) {
+      const created = new PythonWorker((exited) => this.remove(exited));
+      this.workers.add(created);
+      return Promise.resolve(created);
+    }
+    return new Promise((resolve) => this.waiting.push(resolve));
+  }
+
+  private release(worker: PythonWorker) {
+    if (!worker.alive) {
+      return;
+    }
+    const next = this.waiting.shift();
+    if (next) {
+      next(worker);
+    } else {
+      this.idle.push(worker);
+    }
+  }
+
+  private remove(worker: PythonWorker) {
+    this.workers.delete(worker);
+    this.idle = this.idle.filter((item) => item !== worker);
+    // 終了したワーカーの代わりを起動して、待っている呼び出しに渡す
+    const next = this.waiting.shift();
+    if (next) {
+      const created = new PythonWorker((exited) => this.remove(exited));
+      this.workers.add(created);
+      next(created);
+    }
+  }
+
+  async call(moduleName: string, functionName: string, args: any[]): Promise<PythonResponse> {
+    const worker = await this.acquire();
+    try {
+      return await worker.call(moduleName, functionName, args);
+    } finally {
+      this.release(worker);
+    }
+  }
+
+  shutdown() {
+    this.workers.forEach((worker) => worker.kill());
+    this.workers.clear();
+    this.idle = [];
+  }
+}
+
+// 開発サーバーのホットリロードでモジュールが読み直されてもプールを共有する
+const globalForPython = globalThis as unknown as { pythonWorkerPool?: PythonWorkerPool };
+
+function getPool(): PythonWorkerPool {
+  if (!globalForPython.pythonWorkerPool) {
+    const pool = new PythonWorkerPool(Number(process.env.PYTHON_WORKERS || 2));
+    globalForPython.pythonWorkerPool = pool;
+    process.once('exit', () => pool.shutdown());
+  }
+  return globalForPython.pythonWorkerPool;
+}
+
+/**
+ * src/utils の Python モジュールの関数を常駐ワーカーで実行する
+ *
+ * functionName は関数名、または "クラス名().メソッド名"（インスタンスはワーカー内で使い回す）。
+ * Buffer / Uint8Array の引数と、bytes の戻り値（data に Buffer として入る）はそのまま受け渡す。
+ */
+export async function runPythonScript(
+  scriptPath: string,
+  functionName: string,
+  args: any[]
+): Promise<PythonResponse> {
+  return getPool().call(scriptPath, functionName, args);
 }
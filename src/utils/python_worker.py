@@ -0,0 +1,136 @@
+"""
+常駐して src/utils のモジュールを呼び出す Python ワーカー（python_runner.ts から起動する）
+
+リクエストごとにインタープリターを起動し直さないため、モジュールの import や
+クライアントの初期化は最初の呼び出しの 1 回だけで済む。
+
+標準入出力でフレーム単位にメッセージをやり取りする。
+
+    [ヘッダー長: 4 バイト（ビッグエンディアン）][ヘッダー: UTF-8 の JSON][バイナリ...]
+
+ヘッダーの "buffers" に続くバイナリの長さを並べる。JSON の中の
+{"__buffer__": i} は i 番目のバイナリ（bytes）を表す。バイナリを base64 や
+一時ファイルに変換せずにそのまま受け渡すためのもの。
+
+リクエスト: {"id": ..., "module": "gemini_analysis",
+             "function": "GeminiAnalyzer().analyze_image", "args": [...], "buffers": [...]}
+レスポンス: {"id": ..., "success": true, "data": ..., "buffers": [...]}
+            {"id": ..., "success": false, "error": "..."}
+
+function は関数名、または "クラス名().メソッド名"。後者のインスタンスはモジュールと
+クラスごとに 1 つ作って使い回す。
+"""
+import importlib
+import json
+import struct
+import sys
+import traceback
+
+# 呼び出しを許可するモジュール
+ALLOWED_MODULES = ('gemini_analysis', 'vision_analysis', 'elevenlabs_tts')
+
+_HEADER = struct.Struct('>I')
+_instances = {}
+
+
+def read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+
+def read_message(stream):
+    """メッセージを 1 つ読み、(ヘッダー, バイナリのリスト) を返す"""
+    (length,) = _HEADER.unpack(read_exact(stream, _HEADER.size))
+    header = json.loads(read_exact(stream, length).decode('utf-8'))
+    buffers = [read_exact(stream, size) for size in header.pop('buffers', [])]
+    return header, buffers
+
+
+def encode_message(header, buffers=()):
+    """メッセージを書き込む部分（バイト列）のリストにする（JSON にできない値は TypeError など）"""
+    header = dict(header, buffers=[len(buffer) for buffer in buffers])
+    encoded = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    return [_HEADER.pack(len(encoded)), encoded, *buffers]
+
+
+def write_message(stream, header, buffers=()):
+    write_parts(stream, encode_message(header, buffers))
+
+
+def write_parts(stream, parts):
+    for part in parts:
+        stream.write(part)
+    stream.flush()
+
+
+def decode_args(value, buffers):
+    """{"__buffer__": i} をバイナリに置き換える"""
+    if isinstance(value, dict):
+        if set(value) == {'__buffer__'}:
+            return buffers[value['__buffer__']]
+        return {key: decode_args(item, buffers) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_args(item, buffers) for item in value]
+    return value
+
+
+def encode_result(value, buffers):
+    """bytes を {"__buffer__": i} に置き換え、本体を buffers に追加する"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        buffers.append(bytes(value))
+        return {'__buffer__': len(buffers) - 1}
+    if isinstance(value, dict):
+        return {key: encode_result(item, buffers) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_result(item, buffers) for item in value]
+    return value
+
+
+def resolve(module_name, function):
+    if module_name not in ALLOWED_MODULES:
+        raise ValueError(f'Module not allowed: {module_name}')
+    module = importlib.import_module(module_name)
+    if '().' in function:
+        class_name, method_name = function.split('().', 1)
+        key = (module_name, class_name)
+        instance = _instances.get(key)
+        if instance is None:
+            instance = _instances[key] = getattr(module, class_name)()
+        return getattr(instance, method_name)
+    if '.' in function or function.startswith('_'):
+        raise ValueError(f'Invalid function: {function}')
+    return getattr(module, function)
+
+
+def handle(header, buffers):
+    """リクエストを処理し、レスポンスのメッセージ（encode_message() の戻り値）を返す"""
+    try:
+        function = resolve(header['module'], header['function'])
+        result = function(*decode_args(header.get('args', []), buffers))
+        result_buffers = []
+        data = encode_result(result, result_buffers)
+        # 戻り値を JSON にできない場合もエラーのレスポンスを返せるよう、ここでエンコードする
+        return encode_message({'id': header.get('id'), 'success': True, 'data': data}, result_buffers)
+    except Exception as e:
+        traceback.print_exc()
+        return encode_message({'id': header.get('id'), 'success': False, 'error': str(e)})
+
+
+def main():
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    # モジュール内の print() がプロトコルのストリームに混ざらないよう、標準出力を標準エラーへ向ける
+    sys.stdout = sys.stderr
+
+    while True:
+        try:
+            header, buffers = read_message(stdin)
+        except EOFError:
+            return
+        write_parts(stdout, handle(header, buffers))
+
+
+if __name__ == '__main__':
+    main()
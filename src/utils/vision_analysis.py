@@ -1,26 +1,34 @@
 from google.cloud import vision
 import json
-import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 
-def analyze_image(image_content: bytes) -> Dict:
-    """
-    Google Cloud Vision APIを使用して画像を分析
-    """
-    client = vision.ImageAnnotatorClient()
-    
-    image = vision.Image(content=image_content)
-    
-    # 画像分析の実行
-    response = client.annotate_image({
-        'image': image,
-        'features': [
-            {'type_': vision.Feature.Type.OBJECT_LOCALIZATION},
-            {'type_': vision.Feature.Type.LABEL_DETECTION},
-            {'type_': vision.Feature.Type.SAFE_SEARCH_DETECTION},
-        ]
-    })
-    
+# batch_annotate_images の 1 リクエストあたりの上限
+MAX_BATCH_SIZE = 16
+# リクエスト本体は 10MB まで（base64 で約 4/3 倍になるため、画像の合計はこれ以下に抑える）
+MAX_BATCH_BYTES = 7 * 1024 * 1024
+
+FEATURES = [
+    {'type_': vision.Feature.Type.OBJECT_LOCALIZATION},
+    {'type_': vision.Feature.Type.LABEL_DETECTION},
+    {'type_': vision.Feature.Type.SAFE_SEARCH_DETECTION},
+]
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> vision.ImageAnnotatorClient:
+    """プロセス内で共有する ImageAnnotatorClient（初回の呼び出しで作成する）"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = vision.ImageAnnotatorClient()
+        return _client
+
+
+def _to_result(response) -> Dict:
     # 検出されたオブジェクトと確信度を取得
     objects = [
         obj.name.lower()
@@ -43,6 +51,70 @@ def analyze_image(image_content: bytes) -> Dict:
         }
     }
 
+
+def _chunks(images: List[bytes], batch_size: int) -> List[List[bytes]]:
+    """枚数と合計サイズの上限を超えないように画像を分ける"""
+    chunks = []
+    current = []
+    current_bytes = 0
+    for image in images:
+        if current and (len(current) >= batch_size or current_bytes + len(image) > MAX_BATCH_BYTES):
+            chunks.append(current)
+            current = []
+            current_bytes = 0
+        current.append(image)
+        current_bytes += len(image)
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _annotate_batch(images: List[bytes]) -> List[Dict]:
+    requests = [
+        {'image': vision.Image(content=content), 'features': FEATURES}
+        for content in images
+    ]
+    response = get_client().batch_annotate_images(requests=requests)
+    results = []
+    for image_response in response.responses:
+        if image_response.error.message:
+            # 失敗した画像だけエラーを返し、他の画像の結果は使えるようにする
+            results.append({'error': image_response.error.message})
+        else:
+            results.append(_to_result(image_response))
+    return results
+
+
+def analyze_images(images: List[bytes], batch_size: int = MAX_BATCH_SIZE,
+                   max_concurrency: int = 4) -> List[Dict]:
+    """
+    複数の画像をまとめて分析し、入力と同じ順番で結果を返す
+
+    batch_size 枚（上限 16）ずつ batch_annotate_images にまとめ、最大
+    max_concurrency 件のリクエストを並行して送る。分析に失敗した画像の結果は
+    {'error': メッセージ} になる。
+    """
+    images = list(images)
+    if not images:
+        return []
+    chunks = _chunks(images, min(batch_size, MAX_BATCH_SIZE))
+    if len(chunks) == 1:
+        return _annotate_batch(chunks[0])
+
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(chunks))) as executor:
+        # map() は投入した順に結果を返す
+        return [result for batch in executor.map(_annotate_batch, chunks) for result in batch]
+
+
+def analyze_image(image_content: bytes) -> Dict:
+    """
+    Google Cloud Vision APIを使用して画像を分析
+    """
+    result = analyze_images([image_content])[0]
+    if 'error' in result:
+        raise Exception(f"Error analyzing image: {result['error']}")
+    return result
+
 if __name__ == '__main__':
     # テスト用コード
     with open('test_image.jpg', 'rb') as image_file:
@@ -0,0 +1,237 @@
+"""
+ASGI で動くカメラ映像の配信サーバー
+
+    uvicorn stream_server:app --host 0.0.0.0 --port 5000
+
+/video_feed はイベントループ上で配信するため、視聴者ごとにスレッドを消費しない。
+それ以外のパスは app.py の Flask アプリへ渡す。
+
+/video_feed のクエリパラメータ:
+    width: 画像幅（320/480/640/960/1280/1920 のいずれかに丸める。省略時は元の解像度）
+    quality: JPEG 画質（30〜95、省略時は 80）
+    fps: 最大フレームレート（省略時は制限なし）
+
+クライアントへの送信が詰まる（ソケットの送信バッファが空くのを待つ時間が長い）
+場合は、画質→画像幅の順に段階を下げ、余裕が戻れば指定値まで戻す。
+"""
+import asyncio
+import contextlib
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import CAMERA_URL, app as flask_app
+from frame_broadcaster import VARIANT_WIDTHS, MIN_QUALITY, get_broadcaster, normalize_variant
+
+BOUNDARY = b'frame'
+QUALITY_STEP = 10
+# 1 フレームの送信にフレーム間隔のこの割合以上かかったら詰まっているとみなす
+SLOW_RATIO = 0.8
+FAST_RATIO = 0.2
+# 段階を変えるまでに連続して観測するフレーム数
+ADAPT_AFTER = 5
+
+
+def _query_number(query, name, cast):
+    values = query.get(name)
+    if not values:
+        return None
+    try:
+        return cast(values[0])
+    except ValueError:
+        return None
+
+
+class AdaptiveStream:
+    """視聴者 1 人分の配信設定（送信にかかった時間から画質・幅を調整する）"""
+
+    def __init__(self, width=None, quality=None, max_fps=None, default_quality=80):
+        self.requested = normalize_variant(width, quality or default_quality)
+        self.width, self.quality = self.requested
+        self.interval = 1.0 / max_fps if max_fps else 0.0
+        self._slow = 0
+        self._fast = 0
+
+    def observe(self, send_seconds, frame_interval, source_width=None):
+        """
+        1 フレームの送信時間を記録し、段階を変えるべきなら True を返す
+
+        frame_interval はフレームの到着間隔（平均）。fps の指定があれば
+        その間隔との長い方を 1 フレームの送信に使える時間とする。
+        source_width はカメラの画像幅（幅の段階を元の解像度より小さいものに限るため）。
+        """
+        budget = max(self.interval, frame_interval)
+        if send_seconds > budget * SLOW_RATIO:
+            self._slow += 1
+            self._fast = 0
+        elif send_seconds < budget * FAST_RATIO:
+            self._fast += 1
+            self._slow = 0
+        else:
+            self._slow = self._fast = 0
+
+        if self._slow >= ADAPT_AFTER:
+            self._slow = 0
+            return self._degrade(source_width)
+        if self._fast >= ADAPT_AFTER * 4:
+            self._fast = 0
+            return self._upgrade(source_width)
+        return False
+
+    def _degrade(self, source_width=None):
+        if self.quality - QUALITY_STEP >= MIN_QUALITY:
+            self.quality -= QUALITY_STEP
+            return True
+        # 元の解像度（width が None）の場合は、カメラの画像幅より小さい段階から下げる
+        current = self.width if self.width is not None else source_width
+        smaller = [w for w in VARIANT_WIDTHS if current is None or w < current]
+        if smaller:
+            self.width = smaller[-1]
+            return True
+        return False
+
+    def _upgrade(self, source_width=None):
+        requested_width, requested_quality = self.requested
+        if self.width != requested_width:
+            larger = [w for w in VARIANT_WIDTHS if w > self.width]
+            if requested_width is not None:
+                larger = [w for w in larger if w <= requested_width]
+            elif source_width is not None:
+                # カメラの画像幅以上の段階は元の解像度と変わらないので飛ばす
+                larger = [w for w in larger if w < source_width]
+            self.width = larger[0] if larger else requested_width
+            return True
+        if self.quality < requested_quality:
+            self.quality = min(requested_quality, self.quality + QUALITY_STEP)
+            return True
+        return False
+
+
+async def video_feed(scope, receive, send):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    stream = AdaptiveStream(
+        width=_query_number(query, 'width', int),
+        quality=_query_number(query, 'quality', int),
+        max_fps=_query_number(query, 'fps', float),
+    )
+    broadcaster = get_broadcaster(CAMERA_URL)
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'multipart/x-mixed-replace; boundary=' + BOUNDARY),
+            (b'cache-control', b'no-cache'),
+        ],
+    })
+
+    # 切断は receive() で通知される（send() は切断後もエラーにならない場合がある）
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        await _stream_frames(broadcaster, stream, send, disconnected)
+    finally:
+        watcher.cancel()
+
+
+async def _next_frame(frames, disconnect):
+    """
+    次のフレームを返す（切断された場合や配信が終わった場合は None）
+
+    カメラが止まっていてフレームが届かなくても切断に気づけるよう、
+    次のフレームと切断の通知のうち先に来た方を待つ。
+    """
+    next_frame = asyncio.ensure_future(frames.__anext__())
+    await asyncio.wait({next_frame, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    if not next_frame.done():
+        # 待機中のジェネレーターを止める（finally で購読が解除される）
+        next_frame.cancel()
+        with contextlib.suppress(asyncio.CancelledError, StopAsyncIteration):
+            await next_frame
+        return None
+    try:
+        return next_frame.result()
+    except StopAsyncIteration:
+        return None
+
+
+async def _stream_frames(broadcaster, stream, send, disconnected):
+    last_sent = 0.0
+    last_frame = time.monotonic()
+    frame_interval = None  # フレーム到着間隔の移動平均
+    disconnect = asyncio.ensure_future(disconnected.wait())
+    try:
+        while True:
+            frames = broadcaster.aframes(stream.width, stream.quality)
+            try:
+                while True:
+                    jpeg = await _next_frame(frames, disconnect)
+                    if jpeg is None:
+                        return
+                    now = time.monotonic()
+                    elapsed = now - last_frame
+                    last_frame = now
+                    if frame_interval is None:
+                        frame_interval = elapsed
+                    else:
+                        frame_interval = 0.9 * frame_interval + 0.1 * elapsed
+                    # 最大フレームレートを超える分は送らない
+                    if now - last_sent < stream.interval:
+                        continue
+                    last_sent = now
+
+                    # send() はソケットの送信バッファに空きができるまで待つので、
+                    # 待ち時間がそのまま回線の詰まり具合になる
+                    await send({
+                        'type': 'http.response.body',
+                        'body': (b'--' + BOUNDARY + b'\r\n'
+                                 b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n'),
+                        'more_body': True,
+                    })
+                    if stream.observe(time.monotonic() - now, frame_interval,
+                                      broadcaster.frame_width):
+                        break
+            except OSError:
+                # クライアントが切断した
+                return
+            finally:
+                # 購読を解除する（視聴者がいなくなればカメラとの接続も閉じられる）
+                await frames.aclose()
+    finally:
+        disconnect.cancel()
+
+
+class StreamingApp:
+    """/video_feed だけを非同期で処理し、それ以外を Flask アプリへ渡す ASGI アプリ"""
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['path'] == '/video_feed':
+            await video_feed(scope, receive, send)
+            return
+        await self.fallback(scope, receive, send)
+
+    @staticmethod
+    async def _lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = StreamingApp(WsgiToAsgi(flask_app))
@@ -0,0 +1,269 @@
+import heapq
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+
+from src.utils.telemetry import clip_id_from_path, get_telemetry
+
+
+class GCSUploadBackend:
+    """
+    GCS へのアップロード
+
+    chunk_size を設定した Blob はレジューマブルアップロードになり、チャンク単位で
+    送信・リトライされる。STORAGE_EMULATOR_HOST を設定すると
+    google-cloud-storage がフェイクの GCS サーバーへ接続する。
+    """
+
+    def __init__(self, bucket_name, storage_client=None, chunk_size=8 * 1024 * 1024):
+        self.bucket_name = bucket_name
+        self.chunk_size = chunk_size
+        self._storage_client = storage_client
+        self._bucket = None
+
+    def _get_bucket(self):
+        if self._bucket is None:
+            if self._storage_client is None:
+                from google.cloud import storage
+                self._storage_client = storage.Client()
+            self._bucket = self._storage_client.bucket(self.bucket_name)
+        return self._bucket
+
+    def upload(self, local_path, blob_name):
+        # chunk_size は 256KB の倍数である必要がある
+        blob = self._get_bucket().blob(blob_name, chunk_size=self.chunk_size)
+        blob.upload_from_filename(local_path)
+
+    def __str__(self):
+        return f'gs://{self.bucket_name}'
+
+
+class LocalUploadBackend:
+    """ローカルディレクトリをバケットに見立てたアップロード先（テスト・オフライン用）"""
+
+    def __init__(self, root_dir):
+        self.root_dir = Path(root_dir)
+
+    def upload(self, local_path, blob_name):
+        destination = self.root_dir / blob_name
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        # 途中まで書かれたファイルが見えないよう、一時ファイル経由で置き換える
+        temp_path = destination.with_name(f'.{destination.name}.{uuid.uuid4().hex}.tmp')
+        shutil.copyfile(local_path, temp_path)
+        os.replace(temp_path, destination)
+
+    def __str__(self):
+        return str(self.root_dir)
+
+
+class UploadQueue:
+    """
+    ディスクに永続化されるアップロードキュー
+
+    ジョブは spool_dir に 1 件 1 ファイルの JSON として保存され、アップロードに
+    成功したときに削除される。プロセスを再起動しても start() 時に未完了の
+    ジョブを読み込んで再開する。同時に転送するのは workers 件までで、失敗した
+    ジョブは指数バックオフ（ジッター付き）で再試行する。
+
+    転送ごとに clip_upload スパン（サイズ・試行回数・キューでの待ち時間付き）を、
+    待ちジョブ数を upload_queue_pending ゲージとして記録する。
+    """
+
+    def __init__(self, spool_dir, backend, workers=2, initial_delay=2.0, max_delay=300.0,
+                 max_attempts=None, delete_after_upload=False, log=print):
+        self.spool_dir = Path(spool_dir)
+        self.backend = backend
+        self.workers = workers
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.delete_after_upload = delete_after_upload
+        self.log = log
+
+        self._condition = threading.Condition()
+        self._heap = []  # (次の試行時刻, 連番, ジョブID)
+        self._jobs = {}
+        self._in_flight = 0
+        self._counter = 0
+        self._threads = []
+        self._stopping = False
+        self.uploaded = 0
+        self.failed = 0
+        self.telemetry = get_telemetry()
+
+    def start(self):
+        """スプールに残っているジョブを読み込み、ワーカーを開始する"""
+        if self._threads:
+            return self
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        restored = 0
+        for job_path in sorted(self.spool_dir.glob('*.json')):
+            try:
+                with open(job_path, encoding='utf-8') as f:
+                    job = json.load(f)
+            except (OSError, ValueError) as e:
+                self.log(f'Warning: アップロードジョブを読み込めませんでした: {job_path}: {e}')
+                continue
+            self._schedule(job)
+            restored += 1
+        if restored:
+            self.log(f'未完了のアップロード {restored} 件を再開します')
+
+        self._stopping = False
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'upload-{i}', daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def enqueue(self, local_path, blob_name):
+        """アップロードを予約する（ジョブをディスクに書いてから返す）"""
+        job = {
+            'id': uuid.uuid4().hex,
+            'local_path': str(local_path),
+            'blob_name': blob_name,
+            'attempts': 0,
+            'next_attempt': time.time(),
+            'created': time.time(),
+        }
+        self._write_job(job)
+        self._schedule(job)
+        return job['id']
+
+    def pending(self):
+        with self._condition:
+            return len(self._jobs)
+
+    def join(self, timeout=None):
+        """キューが空になるまで待つ（タイムアウトしたら False）"""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._jobs, timeout=timeout)
+
+    def stop(self, wait=True):
+        """
+        ワーカーを停止する。転送中のジョブは完了まで待ち、
+        未処理のジョブはディスクに残して次回の start() で再開する
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def _job_path(self, job_id):
+        return self.spool_dir / f'{job_id}.json'
+
+    def _write_job(self, job):
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        path = self._job_path(job['id'])
+        temp_path = path.with_suffix('.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+    def _remove_job(self, job):
+        try:
+            self._job_path(job['id']).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _schedule(self, job):
+        with self._condition:
+            self._jobs[job['id']] = job
+            self._counter += 1
+            heapq.heappush(self._heap, (job['next_attempt'], self._counter, job['id']))
+            self._condition.notify()
+            pending = len(self._jobs)
+        self.telemetry.gauge('upload_queue_pending', pending)
+
+    def _next_job(self):
+        """次に実行できるジョブを取り出す（停止時は None）"""
+        with self._condition:
+            while not self._stopping:
+                if self._heap:
+                    due, _, job_id = self._heap[0]
+                    delay = due - time.time()
+                    if delay <= 0:
+                        heapq.heappop(self._heap)
+                        self._in_flight += 1
+                        return self._jobs[job_id]
+                    self._condition.wait(timeout=delay)
+                else:
+                    self._condition.wait()
+            return None
+
+    def _finish(self, job):
+        with self._condition:
+            self._in_flight -= 1
+            self._jobs.pop(job['id'], None)
+            self._condition.notify_all()
+            pending = len(self._jobs)
+        self.telemetry.gauge('upload_queue_pending', pending)
+
+    def _backoff(self, attempts):
+        delay = min(self.max_delay, self.initial_delay * 2 ** (attempts - 1))
+        return delay * (0.5 + random.random() / 2)
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            local_path = job['local_path']
+            if not os.path.exists(local_path):
+                self.log(f'Error: アップロード対象のファイルがありません: {local_path}')
+                self._remove_job(job)
+                self.failed += 1
+                self._finish(job)
+                continue
+
+            size = os.path.getsize(local_path)
+            upload_span = self.telemetry.span(
+                'clip_upload', clip_id=clip_id_from_path(job['blob_name']),
+                bytes=size, attempt=job['attempts'] + 1,
+                queued_seconds=time.time() - job['created'])
+            try:
+                self.backend.upload(local_path, job['blob_name'])
+            except Exception as e:
+                upload_span.end(status='error', error=str(e))
+                job['attempts'] += 1
+                if self.max_attempts is not None and job['attempts'] >= self.max_attempts:
+                    self.log(f'Error uploading {local_path} to {self.backend}: {e}（再試行を打ち切ります）')
+                    self._remove_job(job)
+                    self.failed += 1
+                    self._finish(job)
+                    continue
+                delay = self._backoff(job['attempts'])
+                job['next_attempt'] = time.time() + delay
+                self.log(f'Error uploading {local_path} to {self.backend}: {e}（{delay:.1f} 秒後に再試行）')
+                try:
+                    self._write_job(job)
+                except OSError:
+                    traceback.print_exc()
+                with self._condition:
+                    self._in_flight -= 1
+                self._schedule(job)
+                continue
+
+            upload_span.end()
+            self.telemetry.counter('upload_bytes', size)
+            self.log(f'Successfully uploaded {local_path} to {self.backend}')
+            self._remove_job(job)
+            self.uploaded += 1
+            if self.delete_after_upload:
+                try:
+                    os.remove(local_path)
+                except OSError:
+                    pass
+            self._finish(job)